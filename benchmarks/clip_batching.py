@@ -0,0 +1,64 @@
+# CPU throughput of CLIP text encoding by batch size, and of the MicroBatcher under concurrent load
+# needs sentence_transformers (downloads the CLIP model on first run)
+# usage: python -m benchmarks.clip_batching --texts 256 --concurrency 64
+import time
+import asyncio
+import argparse
+
+from pinecone_query import MicroBatcher
+
+BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64]
+PROMPTS = ['mountain sunset', 'brutalist architecture', 'wedding dress lace detail', 'minimal living room',
+           'neon city at night', 'vintage poster typography', 'forest path in fog', 'ceramic vase still life']
+
+def texts(count: int):
+    return [PROMPTS[i % len(PROMPTS)] + ' ' + str(i) for i in range(count)]
+
+def encode_throughput(model, count: int):
+    queries = texts(count)
+    model.encode(queries[:8]) # warm up
+    for batch_size in BATCH_SIZES:
+        start = time.perf_counter()
+        for i in range(0, count, batch_size):
+            model.encode(queries[i:i + batch_size], batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        print(f'batch {batch_size:>3}: {count / elapsed:8.1f} texts/s  {elapsed / count * 1000:6.2f} ms/text')
+
+# concurrent single-text requests, as TextEmbeddingModel.query sees them with concurrent inputs
+async def micro_batch_throughput(model, count: int, concurrency: int, max_batch: int, max_wait: float):
+    batcher = MicroBatcher(lambda queries: model.encode(queries, batch_size=max_batch), max_batch, max_wait)
+    queue = texts(count)
+    latencies = []
+
+    async def worker():
+        while queue:
+            text = queue.pop()
+            start = time.perf_counter()
+            await batcher.submit(text)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f'micro-batch (max {max_batch}, wait {max_wait * 1000:.0f} ms, {concurrency} concurrent): '
+          f'{count / elapsed:8.1f} texts/s  p50 {latencies[len(latencies) // 2] * 1000:6.1f} ms  '
+          f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:6.1f} ms')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='sentence-transformers/clip-ViT-B-32')
+    parser.add_argument('--texts', type=int, default=256)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    import sentence_transformers
+    model = sentence_transformers.SentenceTransformer(args.model, device='cpu')
+
+    encode_throughput(model, args.texts)
+    for max_batch in [1, 8, 32, 64]:
+        asyncio.run(micro_batch_throughput(model, args.texts, args.concurrency, max_batch, args.max_wait_ms / 1000))
+
+if __name__ == '__main__':
+    main()
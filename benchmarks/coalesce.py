@@ -0,0 +1,136 @@
+# load test for request coalescing (coalesce.py): bursts of identical web_search requests (a trending
+# topic) against cold caches, with every Modal function spread over several simulated containers
+# (same harness as benchmarks/load_test.py, where a container only takes concurrent inputs if its function is
+# declared concurrent), counting the upstream and OpenAI calls each level saves
+#   none: every request plans and searches on its own
+#   local: concurrent misses for the same sub-query or plan share one call within a container
+#   shared: ... and across containers, through lock entries in the shared cache store
+#   requests: ... and identical requests in a web_search container share one run of the whole search
+# also checks that a search waiting on a stalled leader in another container gives up within its share of
+# the engine budget, polling the store with backoff
+# usage: python -m benchmarks.coalesce --topics 3 --copies 12 --containers 4
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+import chain_search
+import coalesce
+import dispatch
+import engines
+import result_cache
+import tracing
+from benchmarks import fixtures, local_modal
+from benchmarks.fake_openai import FakeOpenAI
+from benchmarks.load_test import ThreadOutput, container_setup, run_pass, percentile
+
+MODES = ['none', 'local', 'shared', 'requests']
+
+def run_mode(args, mode: str, topics: list, replay, vectors, output: ThreadOutput):
+    with tempfile.TemporaryDirectory() as directory, FakeOpenAI(args.openai_ms / 1000, args.token_ms / 1000) as fake:
+        cache_store = result_cache.SQLiteStore(os.path.join(directory, 'cache.sqlite'))
+        limit_store = result_cache.SQLiteStore(os.path.join(directory, 'limits.sqlite'))
+        setup = container_setup(replay, fake.url, cache_store, limit_store,
+                                flights='shared' if mode == 'requests' else mode)
+        coalesce.ENABLED = mode == 'requests'
+        replay.reset()
+        vectors.calls = vectors.misses = 0
+        functions, counts, restore = local_modal.install(chain_search, hop=args.hop_ms / 1000, setup=setup,
+                                                         containers=args.containers, per_container=('request_flights',))
+        try:
+            outcomes, elapsed = run_pass(args, topics, output)
+        finally:
+            restore()
+        upstream = sum(replay.counts.values()) + vectors.calls
+        latencies = [seconds for seconds, shown in outcomes]
+        assert all(shown for seconds, shown in outcomes), mode + ': pages without results'
+        # Modal calls below web_search: planner, fan-out and engine functions
+        calls = sum(count for name, count in counts.items() if name != 'web_search')
+        return {'upstream': upstream, 'openai': fake.calls, 'calls': calls,
+                'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95), 'elapsed': elapsed}
+
+# a store whose reads are counted
+class CountingStore(result_cache.SQLiteStore):
+    reads = 0
+
+    def get_sync(self, key: str):
+        self.reads += 1
+        return super().get_sync(key)
+
+# another container holds the lock for a search and never finishes: the search gives up waiting on it
+# after COALESCE_SHARE of its budget and fetches in what's left
+async def check_stalled_leader(directory: str):
+    store = CountingStore(os.path.join(directory, 'stalled.sqlite'))
+    await store.put('lock:' + result_cache.ResultCache().key('Wikipedia', 'stalled'), (time.time(), 'other container'))
+    cache = result_cache.ResultCache(store, flights=coalesce.SingleFlight(store))
+    dispatcher = dispatch.Dispatcher(client=object(), cache=cache, budgets={'Wikipedia': 1.0}, hedge=False)
+    async def fetch(engine, query, options, budget=None):
+        return ['result within ' + str(round(budget, 1))]
+    dispatcher.fetch = fetch
+    start = time.perf_counter()
+    results = await dispatcher.search('Wikipedia', 'stalled')
+    elapsed = time.perf_counter() - start
+    assert elapsed < 1.0 * dispatch.COALESCE_SHARE + 0.2 and results == ['result within 0.5'], (elapsed, results)
+    assert store.reads < 20, store.reads # 50 ms polling would have read it about 20 times
+    return elapsed, store.reads
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--topics', type=int, default=3, help='distinct trending topics in the burst')
+    parser.add_argument('--copies', type=int, default=12, help='identical requests per topic, all at once')
+    parser.add_argument('--containers', type=int, default=4, help='simulated containers per Modal function')
+    parser.add_argument('--fanout', choices=['modal', 'async'], default='modal')
+    parser.add_argument('--fixtures', default=fixtures.FIXTURE_PATH)
+    parser.add_argument('--hop-ms', type=float, default=30)
+    parser.add_argument('--openai-ms', type=float, default=300)
+    parser.add_argument('--token-ms', type=float, default=10)
+    args = parser.parse_args()
+    # run_pass options: plain web_search requests at a concurrency that sends the whole burst at once
+    args.entry, args.stream, args.one_call, args.speculative, args.stream_plan = 'web_search', False, False, False, False
+    args.concurrency = args.topics * args.copies
+
+    if not os.path.exists(args.fixtures):
+        print('No fixtures at', args.fixtures + ', recording them against the mock upstreams')
+        fixtures.record(args.fixtures, mock=True)
+    records = fixtures.read_fixtures(args.fixtures)
+    for key in ['REDDIT_USER', 'REDDIT_AGENT', 'REDDIT_KEY', 'TADDY_USER', 'TADDY_KEY', 'UNSPLASH_ACCESS']:
+        os.environ.setdefault(key, 'replay')
+    topics = fixtures.corpus()[:args.topics] * args.copies
+
+    replay = fixtures.ReplayTransport(records)
+    vectors = fixtures.VectorFixtures(records)
+    saved = (engines.vector_model['instance'], tracing.tracer.sinks, coalesce.ENABLED, sys.stdout)
+    engines.vector_model['instance'] = vectors
+    tracing.tracer.sinks = []
+    output = ThreadOutput()
+    sys.stdout = output
+    results = {}
+    try:
+        for mode in MODES:
+            results[mode] = run_mode(args, mode, topics, replay, vectors, output)
+        with tempfile.TemporaryDirectory() as directory:
+            stalled, reads = asyncio.run(check_stalled_leader(directory))
+    finally:
+        engines.vector_model['instance'], tracing.tracer.sinks, coalesce.ENABLED, sys.stdout = saved
+
+    print(f'{len(topics)} requests at once ({args.topics} topics x {args.copies}), '
+          f'{args.containers} containers per function, fanout={args.fanout}')
+    print(f'{"":>10} {"upstream":>9} {"saved":>6} {"OpenAI":>7} {"fn calls":>9} {"p50 ms":>8} {"p95 ms":>8}')
+    for mode, result in results.items():
+        saved_calls = results['none']['upstream'] - result['upstream']
+        print(f'{mode:>10} {result["upstream"]:9d} {saved_calls:6d} {result["openai"]:7d} {result["calls"]:9d} '
+              f'{result["p50"] * 1000:8.0f} {result["p95"] * 1000:8.0f}')
+
+    print(f'stalled leader: gave up after {stalled * 1000:.0f} ms of a 1000 ms budget, {reads} store reads')
+
+    none, local, shared, requests = (results[mode] for mode in MODES)
+    assert local['upstream'] <= none['upstream'] and shared['upstream'] <= local['upstream'], results
+    assert shared['upstream'] < none['upstream'] and shared['openai'] < none['openai'], results
+    # one plan (two completions) per topic once misses are shared across containers
+    assert shared['openai'] == requests['openai'] == 2 * args.topics, results
+    assert requests['calls'] < shared['calls'], results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# check request deadlines, per-engine budgets, and hedged requests against local mock upstreams
+#   stalled: one engine never answers, so the page must come back by the deadline with every other
+#            engine's results and the stalled engine marked as timed out
+#   budget: the same stall cut off by a short per-engine budget instead of the request deadline
+#   planned: the same stall for a request that spent half the deadline planning, so its searches get the
+#            other half (the deadline counts from the start of the request)
+#   tail: every engine occasionally answers slowly, compare request latency with and without hedging
+# usage: python -m benchmarks.deadlines --rounds 60 --tail-probability 0.05 --tail-ms 300
+import time
+import asyncio
+import argparse
+import statistics
+
+import dispatch
+import merge
+import render
+from benchmarks.mock_upstreams import MockUpstreams
+from benchmarks.fanout import RESPONSES
+
+# dispatchers share a per-loop client, so build them on the loop they'll run on
+def make_dispatcher(loop, **options):
+    async def make():
+        return dispatch.Dispatcher(**options)
+    return loop.run_until_complete(make())
+
+def run_request(dispatcher, responses: list, loop, started: float = None):
+    async def run():
+        return [batch async for response, batch in dispatcher.run(responses, started=started)]
+    start = time.perf_counter()
+    batches = loop.run_until_complete(run())
+    return batches, time.perf_counter() - start
+
+def check_partial(merged, elapsed: float, limit: float, stalled: str):
+    assert elapsed < limit + 0.3, f'page took {elapsed:.2f}s, limit was {limit}s'
+    assert merged.timeouts == (stalled,), merged.timeouts
+    sources = set(result.source for result in merged.results)
+    assert stalled not in sources and sources == set(['Wikipedia', 'Reddit', 'Podcast', 'Unsplash']) - set([stalled]), sources
+    page = ''.join(render.render_page('scottish history', merged.results, timeouts=merged.timeouts))
+    assert "<div class='timeouts'>No results in time from: " + stalled + "</div>" in page
+    assert page.count("<div class='rowchild'>") == len(merged.results)
+
+def percentiles(latencies: list):
+    latencies = sorted(latencies)
+    pick = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    return statistics.median(latencies) * 1000, pick(0.95), pick(0.99)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=60)
+    parser.add_argument('--latency-ms', type=float, default=20, help='usual upstream latency')
+    parser.add_argument('--tail-probability', type=float, default=0.05, help='chance of a slow response')
+    parser.add_argument('--tail-ms', type=float, default=300, help='latency of a slow response')
+    parser.add_argument('--deadline', type=float, default=0.5, help='request deadline for the stalled check')
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+
+    # a stalled engine and the request deadline
+    with MockUpstreams(latency={'Reddit': 30.0}, default_latency=args.latency_ms / 1000) as upstreams:
+        dispatcher = make_dispatcher(loop, deadline=args.deadline, hedge=False)
+        batches, elapsed = run_request(dispatcher, RESPONSES, loop)
+        merged = merge.merge_batches(batches)
+        check_partial(merged, elapsed, args.deadline, 'Reddit')
+        print(f'stalled (deadline {args.deadline}s): page in {elapsed * 1000:.0f} ms, '
+              f'{len(merged.results)} results, timed out: {", ".join(merged.timeouts)}')
+
+        # the same stall, cut off by a budget well inside the deadline
+        dispatcher = make_dispatcher(loop, budgets={'Reddit': args.deadline / 2}, deadline=10.0, hedge=False)
+        batches, elapsed = run_request(dispatcher, RESPONSES, loop)
+        merged = merge.merge_batches(batches)
+        check_partial(merged, elapsed, args.deadline / 2, 'Reddit')
+        assert dispatcher.stats['timeouts'] == 3, dispatcher.stats
+        print(f'stalled (budget {args.deadline / 2}s): page in {elapsed * 1000:.0f} ms, '
+              f'{len(merged.results)} results, timed out: {", ".join(merged.timeouts)}')
+
+        # the same stall after planning took half the deadline
+        dispatcher = make_dispatcher(loop, deadline=args.deadline, hedge=False)
+        batches, elapsed = run_request(dispatcher, RESPONSES, loop, started=time.time() - args.deadline / 2)
+        merged = merge.merge_batches(batches)
+        check_partial(merged, elapsed, args.deadline / 2, 'Reddit')
+        print(f'stalled (deadline {args.deadline}s, {args.deadline / 2}s of it planning): searches in {elapsed * 1000:.0f} ms, '
+              f'{len(merged.results)} results, timed out: {", ".join(merged.timeouts)}')
+
+    # tail latency with and without hedging (same seed, so both see the same slow-response draws)
+    tail = {engine: (args.tail_probability, args.tail_ms / 1000) for engine in ['Wikipedia', 'Reddit', 'Podcast', 'Unsplash']}
+    print(f'\n{"":>10} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"slow upstream":>14} {"hedges":>7} {"hedge wins":>11}')
+    results = {}
+    for hedge in [False, True]:
+        with MockUpstreams(default_latency=args.latency_ms / 1000, tail=tail, seed=1) as upstreams:
+            dispatcher = make_dispatcher(loop, hedge=hedge)
+            # warm the latency window so hedge delays come from observed percentiles
+            for round in range(dispatch.HEDGE_MIN_SAMPLES // 4 + 1):
+                run_request(dispatcher, [response + ' warmup ' + str(round) for response in RESPONSES], loop)
+            dispatcher.stats.clear()
+            upstreams.reset()
+
+            latencies = []
+            for round in range(args.rounds):
+                batches, elapsed = run_request(dispatcher, [response + ' ' + str(round) for response in RESPONSES], loop)
+                assert not merge.merge_batches(batches).errors
+                latencies.append(elapsed)
+            results[hedge] = percentiles(latencies)
+            p50, p95, p99 = results[hedge]
+            print(f'{"hedged" if hedge else "unhedged":>10} {p50:8.1f} {p95:8.1f} {p99:8.1f} '
+                  f'{sum(upstreams.slow.values()):14d} {dispatcher.stats["hedges"]:7d} {dispatcher.stats["hedge_wins"]:11d}')
+    if args.tail_probability:
+        assert results[True][1] < results[False][1], 'hedging should cut p95'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# a fake OpenAI server: POST /v1/chat/completions answers with mock_openai's canned planner responses
+# over real HTTP (JSON, or server-sent events with stream=true), with configurable latency
+#   call_latency: seconds before the first token, token_latency: seconds per output token (~4 characters)
+# responses carry x-ratelimit-* headers like the real API, so the planner's rate limiter sees them
+# client() returns an AsyncOpenAI pointed at the server (or, without the openai package, a minimal
+# httpx-based client with the same chat.completions.create shape)
+import json
+import time
+import threading
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.mock_openai import answer, token_chunks, completion, chunk
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_headers(self, status: int, headers: dict):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('x-ratelimit-limit-requests', '10000')
+        self.send_header('x-ratelimit-remaining-requests', '9999')
+        self.send_header('x-ratelimit-reset-requests', '6ms')
+        self.end_headers()
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path.rstrip('/') not in ('/v1/chat/completions', '/chat/completions'):
+            self.send_headers(404, {'Content-Length': '0'})
+            return
+
+        json_mode = (body.get('response_format') or {}).get('type') == 'json_object'
+        content = answer(body.get('messages', []), json_mode=json_mode)
+        with server.lock:
+            server.calls += 1
+            server.streams += bool(body.get('stream'))
+        time.sleep(server.call_latency)
+
+        if body.get('stream'):
+            self.send_headers(200, {'Content-Type': 'text/event-stream', 'Transfer-Encoding': 'chunked'})
+            for text in token_chunks(content):
+                time.sleep(server.token_latency * len(text) / 4)
+                event = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                         'model': body.get('model', ''),
+                         'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': text}, 'finish_reason': None}]}
+                self.write_chunk('data: ' + json.dumps(event) + '\n\n')
+            self.write_chunk('data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+            return
+
+        time.sleep(server.token_latency * len(content) / 4)
+        payload = json.dumps({
+            'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model', ''),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': len(content) // 4, 'total_tokens': len(content) // 4},
+        }).encode('utf-8')
+        self.send_headers(200, {'Content-Type': 'application/json', 'Content-Length': str(len(payload))})
+        self.wfile.write(payload)
+
+    def write_chunk(self, text: str):
+        data = text.encode('utf-8')
+        self.wfile.write(format(len(data), 'x').encode('ascii') + b'\r\n' + data + b'\r\n')
+        self.wfile.flush()
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256 # bursts of concurrent planner calls
+
+class FakeOpenAI:
+    def __init__(self, call_latency: float = 0.3, token_latency: float = 0.01, port: int = 0):
+        self.server = FakeServer(('127.0.0.1', port), FakeOpenAIHandler)
+        self.server.lock = threading.Lock()
+        self.server.call_latency = call_latency
+        self.server.token_latency = token_latency
+        self.server.calls = 0
+        self.server.streams = 0
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1]) + '/v1'
+
+    @property
+    def calls(self):
+        return self.server.calls
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+# an OpenAI client for the fake server, wired to the rate limiter's response hook like the planner's own
+def client(url: str):
+    import httpx
+    import rate_limit
+
+    http_client = httpx.AsyncClient(event_hooks={'response': [rate_limit.observe_response]}, timeout=30.0)
+    try:
+        import openai
+    except ImportError:
+        return HTTPClient(url, http_client)
+    return openai.AsyncOpenAI(base_url=url, api_key='fake', http_client=http_client)
+
+# just enough of AsyncOpenAI for the planner: chat.completions.create, plain or streamed
+class HTTPClient:
+    def __init__(self, url: str, http_client):
+        self.url = url
+        self.http_client = http_client
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, stream: bool = False, **kwargs):
+        body = dict(kwargs, stream=stream)
+        if not stream:
+            response = await self.http_client.post(self.url + '/chat/completions', json=body)
+            response.raise_for_status()
+            return completion(response.json()['choices'][0]['message']['content'])
+        return self.stream(body)
+
+    async def stream(self, body: dict):
+        async with self.http_client.stream('POST', self.url + '/chat/completions', json=body) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith('data: ') or line == 'data: [DONE]':
+                    continue
+                yield chunk(json.loads(line[6:])['choices'][0]['delta'].get('content', ''))
@@ -0,0 +1,87 @@
+# compare end-to-end latency of the two fan-out paths against local mock upstreams
+#   modal: each sub-query goes through parse_response -> search_* (two container hops) with a fresh connection
+#   async: every sub-query runs concurrently in one process through dispatch.Dispatcher and a pooled client
+# container hops can't be reproduced locally, so they're simulated with --hop-ms of sleep per hop
+# usage: python -m benchmarks.fanout --rounds 20 --latency-ms 50 --hop-ms 30
+import time
+import asyncio
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import dispatch
+from benchmarks.mock_upstreams import MockUpstreams
+
+# a typical text-topic plan plus the visual-topic engines so every engine is exercised
+RESPONSES = [
+    'Wikipedia: History of Scotland',
+    'Wikipedia: Scottish Wars of Independence',
+    'Reddit: Scottish clan history',
+    'Reddit: Jacobite risings explained',
+    'Reddit: Best books on Scottish history',
+    'Podcast: Mary Queen of Scots',
+    'Podcast: Highland Clearances',
+    'Podcast: Scottish Enlightenment thinkers',
+    'Unsplash: Scottish highlands castle',
+]
+
+# emulate the per-function Modal path: each sub-query in its own "container" with its own client
+def run_modal_path(responses: list, hop: float):
+    import httpx
+
+    def one(response):
+        time.sleep(hop) # parse_response container hop
+        time.sleep(hop) # search_* container hop
+        engine, query = dispatch.split_response(response)
+
+        async def search():
+            async with httpx.AsyncClient() as client:
+                return await dispatch.ENGINES[engine](client, query)
+        return asyncio.run(search())
+
+    with ThreadPoolExecutor(max_workers=len(responses)) as pool:
+        return list(pool.map(one, responses))
+
+# the async dispatcher path: one (simulated) hop into the fan_out container, then everything in-process
+def run_async_path(responses: list, hop: float, loop):
+    async def run():
+        await asyncio.sleep(hop)
+        return [batch.results async for response, batch in dispatch.Dispatcher().run(responses)]
+    return loop.run_until_complete(run())
+
+def summarize(name: str, latencies: list, upstreams: MockUpstreams, rounds: int):
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f'{name:>6}: median {statistics.median(latencies) * 1000:7.1f} ms  '
+          f'p95 {p95 * 1000:7.1f} ms  '
+          f'connections/round {upstreams.connections / rounds:5.1f}  '
+          f'upstream requests {upstreams.counts}')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=50, help='upstream response latency')
+    parser.add_argument('--hop-ms', type=float, default=30, help='simulated Modal container hop')
+    args = parser.parse_args()
+    hop = args.hop_ms / 1000
+
+    with MockUpstreams(default_latency=args.latency_ms / 1000) as upstreams:
+        latencies = []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            run_modal_path(RESPONSES, hop)
+            latencies.append(time.perf_counter() - start)
+        summarize('modal', latencies, upstreams, args.rounds)
+
+        upstreams.reset()
+        loop = asyncio.new_event_loop()
+        latencies = []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            run_async_path(RESPONSES, hop, loop)
+            latencies.append(time.perf_counter() - start)
+        summarize('async', latencies, upstreams, args.rounds)
+        loop.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+# record/replay fixtures for every upstream the engine functions in chain_search.py call
+# (Wikipedia, Reddit and its OAuth, Taddy, Unsplash over HTTP, and the Image Vector Search app)
+# so load tests run offline against real response bodies with their recorded latencies
+#   record: plan each corpus topic (mock planner answers, the same ones fake_openai serves), run every
+#           sub-query plus the speculative raw-topic searches through a dispatcher whose client records
+#           each request and response; --mock records against MockUpstreams and synthetic vector
+#           results instead of the live APIs (which need the engines' secrets and the deployed vector app)
+#   replay: ReplayTransport answers the same requests from the fixture file, sleeping the recorded
+#           latency (times --latency-scale), and counts calls per engine
+# fixtures are one JSON object per line: HTTP exchanges keyed by method, path, sorted params and a
+# hash of the request body (secrets only ever reach the hash), and vector results keyed by query
+# usage: python -m benchmarks.fixtures --mock (or without --mock, for live recording with network access)
+import os
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import argparse
+import threading
+from collections import Counter
+
+import dispatch
+import engines
+import planner
+import rate_limit
+from search_result import SearchResult
+from benchmarks.mock_openai import MockAsyncOpenAI
+from benchmarks.mock_upstreams import MockUpstreams, engine_for
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'upstreams.jsonl')
+
+# response headers worth replaying: content type, redirects, and what the rate limiter reads
+KEPT_HEADERS = ['content-type', 'location', 'retry-after']
+
+# limits high enough that only the fixtures' latency shapes a run
+UNLIMITED = {engine: (1e6, 1e6) for engine in list(rate_limit.ENGINE_LIMITS) + list(dispatch.ENGINES)}
+
+# the corpus: text topics (Wikipedia, Reddit and Podcast plans, see mock_openai.py) alternating with visual
+# ones (Unsplash and Vector plans), so every engine is recorded and replayed
+CORPUS = ['Scottish history', 'Mountain sunset', 'How to repair a bicycle', 'Brutalist architecture',
+          'Learn Python', 'Japanese gardens', 'Why the sky is blue', 'Northern lights',
+          'Small business accounting', 'Art deco posters', 'Sourdough bread guide', 'Tide pools',
+          'Coral reefs explained', 'Minimalist interior design', 'History of the Roman empire', 'Desert dunes at dawn',
+          'What is a black hole', 'Autumn forest', 'How to start a podcast', 'Street photography in Tokyo',
+          'Learn to play chess', 'Mid-century modern furniture', 'Houseplant care guide', 'Lighthouses']
+
+def corpus():
+    return list(CORPUS)
+
+def request_key(method: str, path: str, params, body: bytes):
+    return (method, path, tuple(sorted(params)), hashlib.sha1(body).hexdigest() if body else '')
+
+def read_fixtures(path: str = FIXTURE_PATH):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# appends every exchange (and vector query) to a fixture file
+class FixtureWriter:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'w')
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def write(self, record: dict):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.counts[record['engine']] += 1
+
+    def close(self):
+        self.file.close()
+
+# httpx transport that passes requests through and writes each exchange to the fixture file
+class RecordingTransport:
+    def __init__(self, writer: FixtureWriter, transport=None):
+        import httpx
+        self.writer = writer
+        self.transport = transport or httpx.AsyncHTTPTransport(http2=True)
+
+    async def handle_async_request(self, request):
+        import httpx
+
+        body = await request.aread()
+        start = time.perf_counter()
+        response = await self.transport.handle_async_request(request)
+        content = await response.aread()
+        latency = time.perf_counter() - start
+        try:
+            text, encoding = content.decode('utf-8'), 'utf-8'
+        except UnicodeDecodeError:
+            text, encoding = base64.b64encode(content).decode('ascii'), 'base64'
+        headers = {name: value for name, value in response.headers.items()
+                   if name.lower() in KEPT_HEADERS or name.lower().startswith('x-ratelimit')}
+        method, path, params, body_hash = request_key(request.method, request.url.path, request.url.params.multi_items(), body)
+        self.writer.write({'engine': engine_for(method, path), 'method': method, 'path': path,
+                           'params': [list(param) for param in params], 'body_sha1': body_hash,
+                           'status': response.status_code, 'headers': headers, 'content': text,
+                           'encoding': encoding, 'latency': latency})
+        # the stream has been read, so hand back a response holding the content
+        return httpx.Response(response.status_code, headers=response.headers, content=content,
+                              extensions={key: value for key, value in response.extensions.items() if key != 'network_stream'})
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+# answers engine requests from recorded exchanges, never touching the network
+# a request that wasn't recorded gets a recorded response to the same engine and path (counted as a miss),
+# and Wikipedia title lookups are answered title by title, since batches form differently under load
+class ReplayTransport:
+    def __init__(self, records: list, latency_scale: float = 1.0, fixed_latency: float = None):
+        self.latency_scale = latency_scale
+        self.fixed_latency = fixed_latency
+        self.exchanges = {}
+        self.by_path = {}
+        self.titles = {} # requested Wikipedia title -> page (None for missing)
+        self.title_latency = []
+        for record in records:
+            if record.get('engine') == 'Vector':
+                continue
+            key = (record['method'], record['path'], tuple(tuple(param) for param in record['params']), record['body_sha1'])
+            self.exchanges[key] = record
+            self.by_path.setdefault((record['method'], record['path']), []).append(record)
+            params = dict(key[2])
+            if record['path'].endswith('/api.php') and 'titles' in params and record['status'] == 200:
+                titles = params['titles'].split('|')
+                self.titles.update(engines.parse_wikipedia_pages(json.loads(record['content']), titles))
+                self.title_latency.append(record['latency'])
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.misses = Counter()
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+            self.misses.clear()
+
+    def delay(self, record: dict):
+        if self.fixed_latency is not None:
+            return self.fixed_latency
+        return record['latency'] * self.latency_scale
+
+    async def handle_async_request(self, request):
+        import httpx
+
+        body = await request.aread()
+        key = request_key(request.method, request.url.path, request.url.params.multi_items(), body)
+        engine = engine_for(request.method, request.url.path)
+        params = dict(key[2])
+        record = self.exchanges.get(key)
+        with self.lock:
+            self.counts[engine] += 1
+            if record is None and not (params.get('titles') and self.titles):
+                self.misses[engine] += 1
+
+        if record is None and params.get('titles') and self.titles:
+            return await self.title_response(params['titles'].split('|'))
+        if record is None:
+            candidates = self.by_path.get((request.method, request.url.path))
+            if not candidates:
+                return httpx.Response(404, json={'error': 'no fixture for ' + request.method + ' ' + request.url.path})
+            record = candidates[int(hashlib.sha1(repr(key).encode()).hexdigest(), 16) % len(candidates)]
+
+        await asyncio.sleep(self.delay(record))
+        content = record['content'].encode('utf-8') if record['encoding'] == 'utf-8' else base64.b64decode(record['content'])
+        return httpx.Response(record['status'], headers=record['headers'], content=content)
+
+    # an action=query response for titles, built from every recorded lookup
+    async def title_response(self, titles: list):
+        import httpx
+
+        pages, normalized = [], []
+        for title in titles:
+            page = self.titles.get(title)
+            if page is None:
+                pages.append({'title': title, 'missing': True})
+                continue
+            if page['title'] != title:
+                normalized.append({'from': title, 'to': page['title']})
+            if page not in pages:
+                pages.append(page)
+        latency = sorted(self.title_latency)[len(self.title_latency) // 2] if self.title_latency else 0.0
+        await asyncio.sleep(self.fixed_latency if self.fixed_latency is not None else latency * self.latency_scale)
+        return httpx.Response(200, json={'batchcomplete': True, 'query': {'pages': pages, 'normalized': normalized}})
+
+    async def aclose(self):
+        pass
+
+# stands in for the vector app's TextEmbeddingModel: query.remote.aio(query, num_matches, trace=None)
+class VectorFixtures:
+    def __init__(self, records: list = (), latency_scale: float = 1.0, fixed_latency: float = None, model=None, writer=None):
+        from types import SimpleNamespace
+
+        self.results = {(record['query'], record['num_matches']): record for record in records if record.get('engine') == 'Vector'}
+        self.latency_scale = latency_scale
+        self.fixed_latency = fixed_latency
+        self.model = model # when recording, the model to pass queries to (None for synthetic results)
+        self.writer = writer
+        self.calls = 0
+        self.misses = 0
+        self.query = SimpleNamespace(remote=SimpleNamespace(aio=self.query_aio))
+
+    # later pages (offset) were never recorded, so they're synthetic
+    async def query_aio(self, query: str, num_matches: int = 10, trace: dict = None, offset: int = 0):
+        self.calls += 1
+        if offset:
+            await asyncio.sleep(self.fixed_latency if self.fixed_latency is not None else 0.08 * self.latency_scale)
+            return synthetic_vector_results(query, offset + num_matches)[offset:]
+        if self.writer is not None:
+            return await self.record(query, num_matches, trace)
+        record = self.results.get((query, num_matches))
+        if record is None: # some recorded query's results, relabelled
+            self.misses += 1
+            if not self.results:
+                return []
+            record = list(self.results.values())[int(hashlib.sha1(query.encode()).hexdigest(), 16) % len(self.results)]
+        await asyncio.sleep(self.fixed_latency if self.fixed_latency is not None else record['latency'] * self.latency_scale)
+        return [SearchResult(*fields[:1], query, *fields[2:]) for fields in record['results']]
+
+    async def record(self, query: str, num_matches: int, trace: dict):
+        start = time.perf_counter()
+        if self.model is not None:
+            results = await self.model.query.remote.aio(query, num_matches, trace=trace)
+        else:
+            await asyncio.sleep(0.08)
+            results = synthetic_vector_results(query, num_matches)
+        self.writer.write({'engine': 'Vector', 'query': query, 'num_matches': num_matches,
+                           'results': [result.to_tuple() for result in results], 'latency': time.perf_counter() - start})
+        return results
+
+def synthetic_vector_results(query: str, num_matches: int):
+    slug = hashlib.sha1(query.encode()).hexdigest()[:8]
+    return [SearchResult('Image Vector Search', query, 'https://savee.it/i/' + slug + str(i),
+                         snippet=query + ' image ' + str(i),
+                         thumbnail='https://images.example.com/' + slug + '/' + str(i) + '.jpg',
+                         subsource='Savee', subsource_url='https://savee.it/i/' + slug + str(i))
+            for i in range(num_matches)]
+
+# every planner response the load test can produce for a topic: the plan (the same from the one-call
+# and two-call planners), plus raw-topic searches for speculation
+async def planned_responses(topic: str):
+    responses = await planner.plan_two_call(MockAsyncOpenAI(0, 0), topic)
+    return responses + [engine + ': ' + topic for engine in dispatch.SPECULATIVE_ENGINES]
+
+async def record_topics(topics: list, writer: FixtureWriter, vector_model=None):
+    import httpx
+
+    client = httpx.AsyncClient(transport=RecordingTransport(writer), event_hooks={'response': [rate_limit.observe_response]},
+                               timeout=httpx.Timeout(10.0, connect=3.0))
+    engines.vector_model['instance'] = VectorFixtures(model=vector_model, writer=writer)
+    dispatcher = dispatch.Dispatcher(client=client, hedge=False, deadline=None, limiter=rate_limit.RateLimiter(limits=UNLIMITED))
+    failures = []
+    for topic in topics:
+        responses = await planned_responses(topic)
+        async for response, batch in dispatcher.run(responses):
+            failures += batch.errors
+    await client.aclose()
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mock', action='store_true', help='record MockUpstreams and synthetic vector results, offline')
+    parser.add_argument('--output', default=FIXTURE_PATH)
+    parser.add_argument('--topics', type=int, default=0, help='record only the first n corpus topics')
+    parser.add_argument('--latency-ms', type=float, default=60, help='MockUpstreams latency with --mock')
+    args = parser.parse_args()
+    print(record(args.output, mock=args.mock, topics=args.topics, latency=args.latency_ms / 1000))
+
+# record fixtures for the corpus, returning what was recorded per engine
+def record(path: str = FIXTURE_PATH, mock: bool = True, topics: int = 0, latency: float = 0.06):
+    topics = corpus()[:topics or None]
+    writer = FixtureWriter(path)
+    saved = engines.vector_model['instance']
+    try:
+        if mock:
+            with MockUpstreams(default_latency=latency):
+                failures = asyncio.run(record_topics(topics, writer))
+        else:
+            failures = asyncio.run(record_topics(topics, writer, engines.get_vector_model()))
+    finally:
+        writer.close()
+        engines.vector_model['instance'] = saved
+    for failure in failures:
+        print('Recorded failure:', failure)
+    return {'topics': len(topics), 'exchanges': dict(writer.counts), 'path': path}
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+# offline load test of the whole metasearch path: replays a fixed corpus of text and visual topics
+# at a set concurrency through web_search or main, with chain_search's Modal functions run in-process
+# (benchmarks/local_modal.py), upstreams answered from recorded fixtures (benchmarks/fixtures.py) and
+# the planner talking to a fake OpenAI server (benchmarks/fake_openai.py)
+# each pass reports throughput, latency percentiles, upstream calls per engine, OpenAI calls, Modal
+# function calls and per-stage latencies from the request traces; the corpus runs twice (cold caches,
+# then warm), and the warm pass has to make fewer upstream calls than the cold one; the cold pass has to
+# reach every engine through the fixtures
+# --save writes the report as JSON, --baseline compares against a saved one and fails on regressions
+# (latency or throughput worse than --tolerance, or more upstream calls than the baseline made)
+# usage: python -m benchmarks.load_test --requests 44 --concurrency 8 --fanout async --stream-plan
+import os
+import io
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+import contextlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import chain_search
+import coalesce
+import dispatch
+import engines
+import planner
+import rate_limit
+import result_cache
+import tracing
+from benchmarks import fixtures, local_modal
+from benchmarks.fake_openai import FakeOpenAI, client as openai_client
+
+# stdout per thread, so each request's printed output (main prints its results) can be checked on its own
+# and everything else the containers print is dropped
+class ThreadOutput(io.TextIOBase):
+    def __init__(self):
+        self.local = threading.local()
+
+    def write(self, text: str):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is not None:
+            buffer.write(text)
+        return len(text)
+
+    @contextlib.contextmanager
+    def capture(self):
+        self.local.buffer = io.StringIO()
+        try:
+            yield self.local.buffer
+        finally:
+            self.local.buffer = None
+
+# each simulated container gets its own dispatcher and planner, sharing the stores like Modal containers do
+# flights is how cache misses are coalesced (see coalesce.py): 'none', 'local' (within a container) or
+# 'shared' (across containers too, through the cache store)
+def container_setup(replay, openai_url: str, cache_store, limit_store, rate_limits: bool = False, flights: str = 'shared'):
+    async def setup():
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        limits = None if rate_limits else fixtures.UNLIMITED
+        make_flights = lambda: None if flights == 'none' else coalesce.SingleFlight(cache_store if flights == 'shared' else None)
+        client = httpx.AsyncClient(transport=replay, event_hooks={'response': [rate_limit.observe_response]})
+        cache = result_cache.ResultCache(cache_store, flights=make_flights())
+        dispatch.dispatchers[loop] = dispatch.Dispatcher(client=client, cache=cache,
+                                                         limiter=rate_limit.RateLimiter(limit_store, limits=limits))
+        plan_cache = planner.PlannerCache(result_cache.ResultCache(cache_store, ttls={'Planner': planner.PLAN_TTL},
+                                                                   flights=make_flights()))
+        planner.planners[loop] = planner.Planner(client=openai_client(openai_url), cache=plan_cache,
+                                                 limiter=rate_limit.RateLimiter(limit_store, limits=limits))
+    return setup
+
+def percentile(values: list, p: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+# one request through the chosen entry point, returning (seconds, number of results shown)
+def run_request(args, topic: str, output: ThreadOutput):
+    options = dict(fanout=args.fanout, one_call=args.one_call, speculative=args.speculative, stream_plan=args.stream_plan)
+    start = time.perf_counter()
+    if args.entry == 'main':
+        with output.capture() as buffer:
+            chain_search.main.info.raw_f(topic, **options)
+        return time.perf_counter() - start, buffer.getvalue().count('\nurl: ') + buffer.getvalue().startswith('url: ')
+    response = chain_search.web_search.remote(query=topic, stream=args.stream, **options)
+    if args.stream:
+        async def read(chunks):
+            return ''.join([chunk async for chunk in chunks])
+        html = asyncio.run(read(response.body_iterator))
+    else:
+        html = response.body.decode('utf-8')
+    return time.perf_counter() - start, html.count("<div class='rowchild'>")
+
+def run_pass(args, topics: list, output: ThreadOutput):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        outcomes = list(pool.map(lambda topic: run_request(args, topic, output), topics))
+    return outcomes, time.perf_counter() - start
+
+def report(outcomes: list, elapsed: float, replay, vectors, fake, counts: Counter, stages: dict):
+    latencies = [seconds for seconds, shown in outcomes]
+    upstream = dict(replay.counts)
+    upstream['Vector'] = vectors.calls
+    return {
+        'requests': len(outcomes),
+        'throughput': len(outcomes) / elapsed,
+        'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95), 'p99': percentile(latencies, 0.99),
+        'empty_pages': sum(1 for seconds, shown in outcomes if not shown),
+        'upstream_calls': upstream,
+        'fixture_misses': dict(replay.misses, Vector=vectors.misses),
+        'openai_calls': fake.calls,
+        'function_calls': dict(counts),
+        'stages': stages,
+    }
+
+def print_report(label: str, result: dict):
+    print(f'\n{label}: {result["requests"]} requests, {result["throughput"]:.1f} req/s, '
+          f'p50 {result["p50"] * 1000:.0f} ms, p95 {result["p95"] * 1000:.0f} ms, p99 {result["p99"] * 1000:.0f} ms')
+    print('  upstream calls:', ', '.join(f'{engine} {count}' for engine, count in sorted(result['upstream_calls'].items()) if engine),
+          f'(total {sum(result["upstream_calls"].values())})')
+    print('  OpenAI calls:', result['openai_calls'])
+    print('  Modal function calls:', ', '.join(f'{name} {count}' for name, count in sorted(result['function_calls'].items())))
+    misses = {engine: count for engine, count in result['fixture_misses'].items() if count}
+    if misses:
+        print('  fixture misses:', misses)
+    if result['stages']:
+        print(f'  {"stage":>34} {"count":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+        for stage, values in sorted(result['stages'].items()):
+            print(f'  {stage:>34} {values["count"]:6d} {values["p50"] * 1000:8.1f} '
+                  f'{values["p95"] * 1000:8.1f} {values["p99"] * 1000:8.1f}')
+
+# regressions against a saved report: slower percentiles or throughput beyond the tolerance, or more
+# upstream calls (caching or coalescing stopped working)
+def regressions(result: dict, baseline: dict, tolerance: float):
+    found = []
+    for key in ['p50', 'p95']:
+        if result[key] > baseline[key] * (1 + tolerance):
+            found.append(f'{key} {result[key] * 1000:.0f} ms vs {baseline[key] * 1000:.0f} ms')
+    if result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        found.append(f'throughput {result["throughput"]:.1f} vs {baseline["throughput"]:.1f} req/s')
+    calls, baseline_calls = sum(result['upstream_calls'].values()), sum(baseline['upstream_calls'].values())
+    if calls > baseline_calls:
+        found.append(f'{calls} upstream calls vs {baseline_calls}')
+    return found
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entry', choices=['web_search', 'main'], default='web_search')
+    parser.add_argument('--requests', type=int, default=0, help='requests per pass, cycling the corpus (default: one per topic)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--fanout', choices=['modal', 'async'], default='modal')
+    parser.add_argument('--one-call', action='store_true')
+    parser.add_argument('--speculative', action='store_true')
+    parser.add_argument('--stream-plan', action='store_true')
+    parser.add_argument('--stream', action='store_true', help='stream the web_search page')
+    parser.add_argument('--fixtures', default=fixtures.FIXTURE_PATH, help='recorded with python -m benchmarks.fixtures')
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='multiplier on recorded upstream latencies')
+    parser.add_argument('--containers', type=int, default=1, help='simulated containers per Modal function')
+    parser.add_argument('--hop-ms', type=float, default=30, help='simulated Modal container hop per function call')
+    parser.add_argument('--openai-ms', type=float, default=300, help='fake OpenAI latency before the first token')
+    parser.add_argument('--token-ms', type=float, default=10, help='fake OpenAI latency per output token')
+    parser.add_argument('--rate-limits', action='store_true', help="apply the real per-engine rate limits")
+    parser.add_argument('--save', help='write the warm and cold reports to this JSON file')
+    parser.add_argument('--baseline', help='compare against a JSON file written by --save')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.fixtures):
+        print('No fixtures at', args.fixtures + ', recording them against the mock upstreams')
+        fixtures.record(args.fixtures, mock=True)
+    records = fixtures.read_fixtures(args.fixtures)
+    topics = fixtures.corpus()
+    topics = [topics[i % len(topics)] for i in range(args.requests or len(topics))]
+    for key in ['REDDIT_USER', 'REDDIT_AGENT', 'REDDIT_KEY', 'TADDY_USER', 'TADDY_KEY', 'UNSPLASH_ACCESS']:
+        os.environ.setdefault(key, 'replay')
+
+    replay = fixtures.ReplayTransport(records, args.latency_scale)
+    vectors = fixtures.VectorFixtures(records, args.latency_scale)
+    directory = tempfile.TemporaryDirectory()
+    cache_store = result_cache.SQLiteStore(os.path.join(directory.name, 'cache.sqlite'))
+    limit_store = result_cache.SQLiteStore(os.path.join(directory.name, 'limits.sqlite'))
+    trace_path = os.path.join(directory.name, 'traces.jsonl')
+    saved_model, saved_sinks, saved_stdout = engines.vector_model['instance'], tracing.tracer.sinks, sys.stdout
+    saved_sample_rate = tracing.SAMPLE_RATE
+
+    with FakeOpenAI(args.openai_ms / 1000, args.token_ms / 1000) as fake:
+        setup = container_setup(replay, fake.url, cache_store, limit_store, args.rate_limits,
+                                'shared' if coalesce.ENABLED else 'none')
+        engines.vector_model['instance'] = vectors
+        functions, counts, restore = local_modal.install(chain_search, hop=args.hop_ms / 1000, setup=setup,
+                                                         containers=args.containers, per_container=('request_flights',))
+        engine_functions = {engine: function.name for engine, function in chain_search.engine_functions.items()}
+        output = ThreadOutput()
+        sys.stdout = output
+        results = {}
+        try:
+            for label in ['cold', 'warm']:
+                replay.reset()
+                vectors.calls = vectors.misses = 0
+                fake.server.calls = 0
+                counts.clear()
+                if os.path.exists(trace_path):
+                    os.remove(trace_path)
+                tracing.tracer.sinks = [tracing.JSONLSink(trace_path)]
+                tracing.SAMPLE_RATE = 1.0
+                outcomes, elapsed = run_pass(args, topics, output)
+                time.sleep(0.1) # let searches cancelled at the deadline finish their spans
+                tracing.tracer.flush()
+                stages = tracing.summarize(tracing.read_jsonl(trace_path)) if os.path.exists(trace_path) else {}
+                results[label] = report(outcomes, elapsed, replay, vectors, fake, counts, stages)
+        finally:
+            sys.stdout = saved_stdout
+            restore()
+            engines.vector_model['instance'], tracing.tracer.sinks = saved_model, saved_sinks
+            tracing.SAMPLE_RATE = saved_sample_rate
+            directory.cleanup()
+
+    print(f'{args.entry} with fanout={args.fanout} one_call={args.one_call} speculative={args.speculative} '
+          f'stream_plan={args.stream_plan}, concurrency {args.concurrency}, hop {args.hop_ms:.0f} ms')
+    for label, result in results.items():
+        print_report(label, result)
+
+    cold, warm = results['cold'], results['warm']
+    assert not cold['empty_pages'] and not warm['empty_pages'], 'pages without results'
+    assert sum(warm['upstream_calls'].values()) < sum(cold['upstream_calls'].values()), \
+        'warm pass should be answered from the caches'
+    assert warm['openai_calls'] < cold['openai_calls'] or not cold['openai_calls'], 'warm pass should reuse cached plans'
+    # the corpus covers every engine: each one's upstream calls are answered from the fixtures, and on the
+    # modal path each engine function runs
+    for engine in dispatch.ENGINES:
+        hits = cold['upstream_calls'].get(engine, 0) - cold['fixture_misses'].get(engine, 0)
+        assert hits, f'no {engine} calls answered from the fixtures (re-record them: python -m benchmarks.fixtures --mock)'
+        if args.fanout == 'modal':
+            assert cold['function_calls'].get(engine_functions[engine]), engine_functions[engine] + ' never ran'
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = [label + ': ' + problem for label in results for problem in regressions(results[label], baseline[label], args.tolerance)]
+        for problem in found:
+            print('Regression:', problem)
+        if found:
+            sys.exit(1)
+        print('\nno regressions against', args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+# run a Modal app's functions in this process, for offline benchmarks of the real chain_search code
+# each function gets a "container": a thread running its own event loop, so per-loop state (dispatcher,
+# planner, pooled client, in-process caches) persists across calls like it does in a warm container
+# every call pays a simulated container hop (--hop-ms), and calls are counted per function
+# a container takes one input at a time unless the function is declared concurrent (the app module's
+# concurrent_inputs, see chain_search.concurrent), then up to that many; calls go round-robin over a function's
+# containers (with containers > 1, that many to begin with) and a new container starts when every one is busy
+# module globals named in per_container get a copy per container, as module state is per container on Modal
+# install() swaps the app module's Function objects (and its engine function tables) for local ones
+# supporting the calls chain_search makes: remote, remote.aio, spawn (get/cancel), remote_gen, remote_gen.aio,
+# get_web_url (a made-up http://local-modal/<function> URL)
+import time
+import asyncio
+import inspect
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# the container whose input is running on this thread (container loops, and pool threads running a sync input)
+current = threading.local()
+
+class LocalContainer:
+    def __init__(self, name: str, setup=None):
+        self.inputs = 0 # inputs running, counted under the function's lock
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.run, daemon=True, name=name).start()
+        if setup is not None: # e.g. install a dispatcher with benchmark stores and clients on this loop
+            self.submit(setup()).result()
+
+    def run(self):
+        current.container = self
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+# stands in for a module global, passing attribute lookups to the running container's own instance
+class PerContainer:
+    def __init__(self, factory):
+        self.factory = factory
+        self.instances = {} # by container (None outside any)
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        container = getattr(current, 'container', None)
+        with self.lock:
+            if container not in self.instances:
+                self.instances[container] = self.factory()
+            instance = self.instances[container]
+        return getattr(instance, name)
+
+async def next_item(generator):
+    return await generator.__anext__()
+
+# handle for a spawned call
+class LocalCall:
+    def __init__(self):
+        self.future = None # set once the call is running
+        self.inner = None # the coroutine's future on the container loop, for async functions
+        self.cancelled = False
+
+    def get(self, timeout: float = None):
+        return self.future.result(timeout)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.inner is not None:
+            self.inner.cancel()
+        self.future.cancel()
+
+# a callable with an .aio variant, like modal's remote and remote_gen
+class Method:
+    def __init__(self, call, aio):
+        self.call = call
+        self.aio = aio
+
+    def __call__(self, *args, **kwargs):
+        return self.call(*args, **kwargs)
+
+class LocalFunction:
+    def __init__(self, name: str, function, hop: float, workers: int = 256, setup=None, counts: Counter = None,
+                 containers: int = 1, max_inputs: int = 1):
+        self.name = name
+        self.function = function # the Modal Function, run through its .local
+        self.hop = hop
+        # a pool per function (its containers' worth of inputs), so calls between functions can't starve each other
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.setup = setup
+        self.counts = counts if counts is not None else Counter()
+        self.containers = [None] * containers
+        self.max_inputs = max_inputs
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.remote = Method(lambda *args, **kwargs: self.spawn(*args, **kwargs).get(), self.remote_aio)
+        self.remote_gen = Method(self.generate, self.generate_aio)
+
+    # take an input slot in the next container round-robin with one free, starting a container if none has
+    def acquire(self):
+        with self.lock:
+            first = self.calls % len(self.containers)
+            self.calls += 1
+            for index in list(range(first, len(self.containers))) + list(range(first)):
+                if self.containers[index] is None:
+                    self.containers[index] = LocalContainer(self.name + '-' + str(index), self.setup)
+                if self.containers[index].inputs < self.max_inputs:
+                    container = self.containers[index]
+                    break
+            else:
+                container = LocalContainer(self.name + '-' + str(len(self.containers)), self.setup)
+                self.containers.append(container)
+            container.inputs += 1
+            return container
+
+    def release(self, container: LocalContainer):
+        with self.lock:
+            container.inputs -= 1
+
+    # run the function in the pool (sync functions) or on its container's loop (async ones)
+    def run(self, call: LocalCall, args, kwargs):
+        time.sleep(self.hop)
+        if call.cancelled:
+            raise asyncio.CancelledError()
+        container = self.acquire()
+        current.container = container
+        try:
+            result = self.function.local(*args, **kwargs)
+            if inspect.iscoroutine(result):
+                call.inner = container.submit(result)
+                return call.inner.result()
+            return result
+        finally:
+            current.container = None
+            self.release(container)
+
+    def spawn(self, *args, **kwargs):
+        self.counts[self.name] += 1
+        call = LocalCall()
+        call.future = self.pool.submit(self.run, call, args, kwargs)
+        return call
+
+    def get_web_url(self):
+        return 'http://local-modal/' + self.name
+
+    async def remote_aio(self, *args, **kwargs):
+        return await asyncio.wrap_future(self.spawn(*args, **kwargs).future)
+
+    # iterate an async generator function on its container's loop
+    def generate(self, *args, **kwargs):
+        self.counts[self.name] += 1
+        time.sleep(self.hop)
+        container = self.acquire()
+        generator = self.function.local(*args, **kwargs)
+        try:
+            while True:
+                try:
+                    item = container.submit(next_item(generator)).result()
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            container.submit(generator.aclose()).result()
+            self.release(container)
+
+    async def generate_aio(self, *args, **kwargs):
+        self.counts[self.name] += 1
+        await asyncio.sleep(self.hop)
+        container = self.acquire()
+        generator = self.function.local(*args, **kwargs)
+        try:
+            while True:
+                try:
+                    item = await asyncio.wrap_future(container.submit(next_item(generator)))
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            await asyncio.wrap_future(container.submit(generator.aclose()))
+            self.release(container)
+
+# replace every Modal Function in module (and in its dict-valued tables of them, like engine_functions)
+# with a LocalFunction; setup is run on each new container's loop, and the globals named in per_container
+# (like chain_search's request_flights) become PerContainer copies of their type
+# returns the LocalFunctions by name, a Counter of calls per function, and a function undoing it all
+def install(module, hop: float = 0.03, setup=None, workers: int = 256, containers: int = 1, per_container: tuple = ()):
+    import modal
+
+    counts = Counter()
+    functions, saved = {}, {}
+    limits = getattr(module, 'concurrent_inputs', {})
+    for name, value in list(vars(module).items()):
+        if isinstance(value, modal.Function):
+            functions[name] = LocalFunction(name, value, hop, workers, setup, counts, containers, limits.get(name, 1))
+            saved[name] = value
+            setattr(module, name, functions[name])
+    for name in per_container:
+        saved[name] = getattr(module, name)
+        setattr(module, name, PerContainer(type(saved[name])))
+    tables = {}
+    for name, value in list(vars(module).items()):
+        if type(value) is dict and any(isinstance(item, modal.Function) for item in value.values()):
+            tables[name] = dict(value)
+            for key, item in value.items():
+                if isinstance(item, modal.Function):
+                    value[key] = functions[[other for other, function in saved.items() if function is item][0]]
+
+    def restore():
+        for name, value in saved.items():
+            setattr(module, name, value)
+        for name, value in tables.items():
+            getattr(module, name).update(value)
+        for function in functions.values():
+            for container in function.containers:
+                if container is not None:
+                    container.close()
+            function.pool.shutdown(wait=False, cancel_futures=True)
+    return functions, counts, restore
@@ -0,0 +1,135 @@
+# compare the old list-scan dedup with merge.ResultMerger as the number of results grows
+#   old: what web_search used to do with a plan's results: flatten, shuffle, then drop duplicates with list
+#        scans on raw URLs (missing tracking params and resized thumbnails)
+#   merger cold / warm: with the normalize_url and thumbnail_key caches cleared first, or already holding the URLs
+#   (results repeat across requests once they come from the result cache)
+# also checks the fast path gives the same keys as urlsplit, that tracking params / resized thumbnails
+# are caught, and that ordering is deterministic
+# usage: python -m benchmarks.merge --sizes 50 100 200 1000 5000
+import time
+import random
+import argparse
+
+import merge
+from search_result import SearchResult
+
+SOURCES = ['Wikipedia', 'Reddit', 'Podcast', 'Unsplash']
+
+# result arrays like a plan's searches return, with some repeated URLs and Reddit thumbnails
+def make_results(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    arrays = []
+    made = 0
+    while made < count:
+        source = SOURCES[len(arrays) % len(SOURCES)]
+        size = min(count - made, 10)
+        array = []
+        for _ in range(size):
+            item = rng.randrange(int(count * 0.8) or 1) # ~20% repeats
+            array.append(SearchResult(source, 'query ' + str(len(arrays)),
+                                      'https://example.com/' + source + '/' + str(item),
+                                      title='Result ' + str(item),
+                                      thumbnail='https://img.example.com/' + str(rng.randrange(count)) + '.jpg'))
+        arrays.append(array)
+        made += size
+    return arrays
+
+# the dedup web_search used to run: list membership checks, O(n) each
+def list_scan(arrays):
+    seen_urls = []
+    seen_thumbnails = []
+    kept = []
+    for array in arrays:
+        for result in array:
+            if result.url not in seen_urls and result.thumbnail not in seen_thumbnails:
+                seen_urls.append(result.url)
+                if result.source == 'Reddit' and result.thumbnail not in seen_thumbnails:
+                    seen_thumbnails.append(result.thumbnail)
+                kept.append(result)
+    return kept
+
+# the old web_search results path: a shuffle for ordering, then the list scan
+def old_page(arrays, rng=random.Random(0)):
+    flattened = []
+    for array in arrays:
+        flattened += array
+    rng.shuffle(flattened)
+    return list_scan([flattened])
+
+def merger(arrays):
+    merger = merge.ResultMerger()
+    kept = []
+    for array in arrays:
+        kept += merger.add(array)
+    return kept, merger.ordered()
+
+def cold_merger(arrays):
+    merge.normalize_url.cache_clear()
+    merge.thumbnail_key.cache_clear()
+    return merger(arrays)
+
+# best time per call over repeat rounds of enough calls to take a few milliseconds
+def timed(function, arrays, repeat: int, size: int):
+    number = max(1, 2000 // size)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            output = function(arrays)
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return output, best
+
+def check_normalization():
+    # the fast path agrees with urlsplit wherever it applies
+    for url in ['https://www.Example.com/a/b/', 'http://example.com', 'https://EXAMPLE.com/A?b=1', 'https://a.com/x#y',
+                'https://user@a.com/x', 'https://a.com:8080/x', 'https://a.com:443/x', 'http://[::1]/x', ' https://a.com/x ',
+                'https://a.com/@user/post', 'ftp://a.com/file', 'https://a.com//x//', 'not a url', '']:
+        for keep_query in (True, False):
+            expected = merge.split_key(url.strip(), keep_query)
+            if not keep_query:
+                expected = merge.split_key(url.strip().partition('#')[0].partition('?')[0], keep_query)
+            assert merge.normalize_url(url, keep_query) == expected, (url, keep_query)
+    assert merge.normalize_url('https://www.example.com/a/?utm_source=x&b=2&a=1#top') == \
+        merge.normalize_url('http://example.com/a?a=1&b=2&fbclid=123')
+    assert merge.normalize_url('https://example.com/a?b=2') != merge.normalize_url('https://example.com/a?b=3')
+    assert merge.thumbnail_key('https://upload.wikimedia.org/wikipedia/commons/thumb/a/ab/Peak.jpg/640px-Peak.jpg') == \
+        merge.thumbnail_key('https://upload.wikimedia.org/wikipedia/commons/a/ab/Peak.jpg')
+    assert merge.thumbnail_key('https://preview.redd.it/abc123.jpg?width=640&amp;format=pjpg&amp;s=1') == \
+        merge.thumbnail_key('https://i.redd.it/abc123.jpg')
+
+    # empty/placeholder thumbnails never mark a duplicate
+    merger = merge.ResultMerger()
+    assert len(merger.add([SearchResult('Reddit', 'q', 'https://a.com/1'),
+                           SearchResult('Podcast', 'q', 'https://a.com/2'),
+                           SearchResult('Wikipedia', 'q', 'https://a.com/3')])) == 3
+
+    # weighted round-robin across sources, best-ranked first within each source
+    arrays = [[SearchResult('Reddit', 'q', 'r' + str(i)) for i in range(3)],
+              [SearchResult('Wikipedia', 'q', 'w' + str(i)) for i in range(2)],
+              [SearchResult('Reddit', 'q', 's' + str(i)) for i in range(2)]]
+    order = [result.url for result in merge.merge_results(arrays)]
+    assert order == ['r0', 'w0', 's0', 'w1', 'r1', 's1', 'r2'], order
+    order = [result.url for result in merge.merge_results(arrays, weights={'Reddit': 2})]
+    assert order == ['r0', 's0', 'w0', 'r1', 's1', 'w1', 'r2'], order
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 100, 200, 1000, 5000, 20000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    check_normalization()
+    print(f'{"results":>8} {"old ms":>8} {"merger cold ms":>15} {"merger warm ms":>15} {"kept":>6}')
+    for size in args.sizes:
+        arrays = make_results(size)
+        old, old_time = timed(old_page, arrays, args.repeat, size)
+        (cold, ordered), cold_time = timed(cold_merger, arrays, args.repeat, size)
+        (new, ordered), new_time = timed(merger, arrays, args.repeat, size)
+        assert [result.url for result in new] == [result.url for result in list_scan(arrays)]
+        assert len(ordered) == len(new) and ordered == merger(arrays)[1] # deterministic
+        print(f'{size:8d} {old_time * 1000:8.3f} {cold_time * 1000:15.3f} {new_time * 1000:15.3f} {len(new):6d}')
+        assert new_time < old_time, 'the merger should beat the old list scans from a results page up'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# stand-in for openai.AsyncOpenAI that returns canned planner answers with configurable latency
+# latency = per-call overhead + per-output-token generation time, roughly like the real API
+# stream=True returns the answer as chunks split by a configurable chunker (default ~4 characters a token)
+import json
+import asyncio
+from types import SimpleNamespace
+
+# topics that read as task-oriented get text and link content, everything else is visual
+TEXT_WORDS = ['history', 'how to', 'repair', 'business', 'learn', 'guide', 'explained', 'why', 'what']
+
+def is_text_topic(topic: str):
+    return any(word in topic.lower() for word in TEXT_WORDS)
+
+def topic_from(prompt: str):
+    for marker in ['I am interested in the topic:\n', 'episodes about:\n', 'on the topic of:\n']:
+        if marker in prompt:
+            return prompt.split(marker)[1].split('\n')[0]
+    return prompt
+
+def text_plan(topic: str):
+    return [('Wikipedia', topic), ('Wikipedia', topic + ' overview'),
+            ('Reddit', topic + ' tips'), ('Reddit', topic + ' stories'), ('Reddit', topic + ' questions'),
+            ('Podcast', topic + ' deep dive'), ('Podcast', topic + ' interview'), ('Podcast', topic + ' explained')]
+
+def visual_plan(topic: str):
+    return [('Unsplash', topic + ' at golden hour'), ('Unsplash', topic + ' close up'), ('Unsplash', 'minimal ' + topic),
+            ('Vector', 'soft light on ' + topic), ('Vector', topic + ' in muted tones')]
+
+# canned completion text for whichever planner prompt this is
+def answer(messages: list, json_mode: bool = False):
+    prompt = messages[-1]['content']
+    topic = topic_from(prompt)
+    if json_mode:
+        text = is_text_topic(topic)
+        plan = text_plan(topic) if text else visual_plan(topic)
+        return json.dumps({'content': 'text' if text else 'visual',
+                           'queries': [{'engine': engine, 'query': query} for engine, query in plan]})
+    elif 'Am I more interested in visual content' in prompt:
+        if is_text_topic(topic):
+            return 'You are more interested in text and link based content. This topic is task-oriented.'
+        return 'You are more interested in visual content. This topic is design oriented.'
+    plan = text_plan(topic) if 'three search engines' in prompt else visual_plan(topic)
+    return '\n'.join(str(i + 1) + '. [' + engine + '] "' + query + '"' for i, (engine, query) in enumerate(plan))
+
+# split text into ~4 character "tokens"
+def token_chunks(text: str):
+    return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+def completion(content: str):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(role='assistant', content=content))])
+
+def chunk(content: str):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(role='assistant', content=content))])
+
+class MockCompletions:
+    def __init__(self, parent):
+        self.parent = parent
+
+    async def create(self, model: str, messages: list, temperature: float = 1.0, response_format: dict = None,
+                     stream: bool = False, **kwargs):
+        content = answer(messages, json_mode=bool(response_format and response_format.get('type') == 'json_object'))
+        self.parent.calls += 1
+        if stream:
+            await asyncio.sleep(self.parent.call_latency)
+            return self.stream(content)
+        # rough token count: ~4 characters per token
+        await asyncio.sleep(self.parent.call_latency + self.parent.token_latency * len(content) / 4)
+        return completion(content)
+
+    async def stream(self, content: str):
+        for text in self.parent.chunker(content):
+            await asyncio.sleep(self.parent.token_latency * len(text) / 4)
+            yield chunk(text)
+
+class MockAsyncOpenAI:
+    def __init__(self, call_latency: float = 0.3, token_latency: float = 0.01, chunker=token_chunks):
+        self.call_latency = call_latency
+        self.token_latency = token_latency
+        self.chunker = chunker
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=MockCompletions(self))
@@ -0,0 +1,279 @@
+# local mock versions of the upstream search APIs (Wikipedia, Reddit, Taddy, Unsplash)
+# serves canned responses with configurable latency so benchmarks can run without network access
+# tail adds occasional slow responses per engine: {engine: (probability, seconds)}, drawn from a seeded RNG
+# quota enforces a rate limit per engine: {engine: (requests, window seconds)}, with X-Ratelimit-* headers
+# on every response and a 429 with Retry-After once the window's requests are used up
+# fail makes an engine answer every request with an error status: {engine: status}
+# every query has TOTAL_RESULTS results per engine, paged like the real APIs (Wikipedia gsroffset,
+# Reddit after, Taddy and Unsplash page); every Wikipedia title exists, and a search's top result is the
+# article titled like the query, as it usually is on Wikipedia
+import re
+import json
+import time
+import random
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import engines
+
+TOTAL_RESULTS = 30
+
+# indices of the results on a page starting at start, cut off at TOTAL_RESULTS
+def page_range(start: int, size: int):
+    return range(start, max(start, min(start + size, TOTAL_RESULTS)))
+
+WIKIPEDIA_ARTICLE = """<html><head><title>{title} - Wikipedia</title>
+<meta property="og:image" content="https://upload.wikimedia.org/{slug}.jpg" /></head>
+<body><h1>{title}</h1><p class="hatnote">Not to be confused with something else.</p>
+<p>{title} is a mock article served locally so that benchmarks do not depend on the real Wikipedia, with enough words to count as a paragraph.</p>
+</body></html>"""
+
+# the action=query JSON for the same mock article
+def wikipedia_page(title: str, index: int):
+    slug = urllib.parse.quote(title.replace(' ', '_'))
+    return {
+        'pageid': index + 1,
+        'index': index + 1,
+        'title': title,
+        'fullurl': 'https://en.wikipedia.org/wiki/' + slug,
+        'extract': title + ' is a mock article served locally so that benchmarks do not depend on the real Wikipedia, with enough words to count as a paragraph.',
+        'thumbnail': {'source': 'https://upload.wikimedia.org/' + slug + '.jpg', 'width': 640, 'height': 480},
+    }
+
+# title of a Wikipedia search's result at index (the first is the article titled like the query)
+def wikipedia_search_title(query: str, index: int):
+    return query + ' ' + str(index) if index else query
+
+# which engine a request path belongs to, used for per-engine latency and counters
+def engine_for(method: str, path: str):
+    if path.startswith('/w/') or path.startswith('/wiki/'):
+        return 'Wikipedia'
+    elif path.startswith('/api/v1/access_token'):
+        return 'RedditAuth'
+    elif path.startswith('/search/photos'):
+        return 'Unsplash'
+    elif path.startswith('/search'):
+        return 'Reddit'
+    elif method == 'POST' and path == '/':
+        return 'Podcast'
+    return None
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # allow keep-alive so pooled clients can reuse connections
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body: dict, status: int = 200):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for name, value in self.extra_headers:
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_html(self, body: str, status: int = 200):
+        payload = body.encode('utf-8')
+        self.send_response(status)
+        for name, value in self.extra_headers:
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def handle_request(self, method: str):
+        parsed = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(parsed.query)
+        engine = engine_for(method, parsed.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        with self.server.lock:
+            self.server.counts[engine] = self.server.counts.get(engine, 0) + 1
+            delay = self.server.latency.get(engine, self.server.default_latency)
+            probability, tail_latency = self.server.tail.get(engine, (0, 0))
+            if probability and self.server.rng.random() < probability:
+                delay = tail_latency
+                self.server.slow[engine] = self.server.slow.get(engine, 0) + 1
+        time.sleep(delay)
+
+        self.extra_headers = []
+        if engine in self.server.fail:
+            self.send_json({'error': 'mock failure'}, status=self.server.fail[engine])
+            return
+        if engine in self.server.quota and not self.within_quota(engine):
+            self.send_json({'error': 'rate limited'}, status=429)
+            return
+
+        if engine == 'Wikipedia' and parsed.path == '/w/api.php':
+            if 'titles' in params: # every title exists in the mock
+                titles = params['titles'][0].split('|')
+            else: # generator=search
+                titles = [wikipedia_search_title(params.get('gsrsearch', [''])[0], i)
+                          for i in page_range(int(params.get('gsroffset', ['0'])[0]), int(params.get('gsrlimit', ['2'])[0]))]
+            self.send_json({'batchcomplete': True, 'query': {'pages': [
+                wikipedia_page(title, i) for i, title in enumerate(titles)
+            ]}})
+        elif engine == 'Wikipedia' and parsed.path.startswith('/w/'):
+            # send exact-title searches to the article, like Wikipedia's "Go" behavior
+            title = params.get('search', [''])[0]
+            self.send_response(302)
+            self.send_header('Location', '/wiki/' + urllib.parse.quote(title.replace(' ', '_')))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif engine == 'Wikipedia':
+            title = urllib.parse.unquote(parsed.path[len('/wiki/'):]).replace('_', ' ')
+            self.send_html(WIKIPEDIA_ARTICLE.format(title=title, slug=parsed.path[len('/wiki/'):]))
+        elif engine == 'RedditAuth':
+            self.send_json({'access_token': 'mock-token', 'expires_in': 3600})
+        elif engine == 'Reddit':
+            query = params.get('q', [''])[0]
+            after = params.get('after', ['t3_-1'])[0] # fullname of the last post already seen
+            self.send_json({'data': {'children': [
+                {'data': {
+                    'subreddit_name_prefixed': 'r/mock',
+                    'permalink': '/r/mock/comments/' + str(i) + '/' + urllib.parse.quote(query) + '/',
+                    'title': query + ' post ' + str(i),
+                    'thumbnail': 'self',
+                    'selftext': 'Mock post body about ' + query
+                }} for i in page_range(int(after[len('t3_'):]) + 1, 4)
+            ]}})
+        elif engine == 'Podcast':
+            graphql = json.loads(body)['query']
+            term = graphql.split('term: "')[1].split('"')[0]
+            page = re.search(r'page: (\d+)', graphql)
+            page = int(page.group(1)) if page else 1
+            self.send_json({'data': {'searchForTerm': {'searchId': 'mock', 'podcastEpisodes': [
+                {
+                    'uuid': str(i),
+                    'name': term + ' episode ' + str(i),
+                    'subtitle': 'Mock episode about ' + term,
+                    'websiteUrl': 'https://podcasts.example.com/' + urllib.parse.quote(term) + '/' + str(i),
+                    'audioUrl': 'https://podcasts.example.com/audio/' + str(i) + '.mp3',
+                    'imageUrl': 'https://podcasts.example.com/art/' + str(i) + '.jpg',
+                    'description': '',
+                    'podcastSeries': {'uuid': 'series', 'name': 'Mock Series', 'imageUrl': '', 'websiteUrl': 'https://podcasts.example.com/'}
+                } for i in page_range((page - 1) * 3, 3)
+            ]}}})
+        elif engine == 'Unsplash':
+            query = params.get('query', [''])[0]
+            per_page = int(params.get('per_page', ['10'])[0])
+            page = int(params.get('page', ['1'])[0])
+            self.send_json({'results': [
+                {
+                    'description': query + ' photo ' + str(i),
+                    'links': {'html': 'https://unsplash.com/photos/' + urllib.parse.quote(query) + '-' + str(i)},
+                    'urls': {'regular': 'https://images.unsplash.com/' + urllib.parse.quote(query) + '-' + str(i)},
+                    'user': {'username': 'mock', 'links': {'html': 'https://unsplash.com/@mock'}}
+                } for i in page_range((page - 1) * per_page, per_page)
+            ]})
+        else:
+            self.send_json({'error': 'not found'}, status=404)
+
+    # count a request against its engine's quota window and set the rate limit headers
+    def within_quota(self, engine: str):
+        limit, window = self.server.quota[engine]
+        with self.server.lock:
+            now = time.time()
+            start, used = self.server.windows.get(engine, (now, 0))
+            if now - start >= window:
+                start, used = now, 0
+            allowed = used < limit
+            if allowed:
+                used += 1
+            else:
+                self.server.rejected[engine] = self.server.rejected.get(engine, 0) + 1
+            self.server.windows[engine] = (start, used)
+        reset = max(0.0, window - (now - start))
+        self.extra_headers = [('X-Ratelimit-Limit', str(limit)),
+                              ('X-Ratelimit-Remaining', str(limit - used)),
+                              ('X-Ratelimit-Reset', format(reset, '.2f'))]
+        if not allowed:
+            self.extra_headers.append(('Retry-After', format(reset, '.2f')))
+        return allowed
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # clients hanging up early (cancelled or hedged searches) is expected, not an error
+    def handle_error(self, request, client_address):
+        import sys
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+class MockUpstreams:
+    def __init__(self, latency: dict = None, default_latency: float = 0.05, tail: dict = None, seed: int = 0,
+                 quota: dict = None, fail: dict = None):
+        self.server = MockServer(('127.0.0.1', 0), MockHandler)
+        self.server.lock = threading.Lock()
+        self.server.latency = latency or {}
+        self.server.default_latency = default_latency
+        self.server.tail = tail or {}
+        self.server.rng = random.Random(seed)
+        self.server.counts = {}
+        self.server.slow = {} # requests given tail latency, per engine
+        self.server.quota = quota or {}
+        self.server.windows = {} # engine -> (window start, requests used)
+        self.server.rejected = {} # requests over quota, per engine
+        self.server.fail = fail or {}
+        self.server.connections = 0
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+
+    @property
+    def counts(self):
+        return dict(self.server.counts)
+
+    @property
+    def slow(self):
+        return dict(self.server.slow)
+
+    @property
+    def rejected(self):
+        return dict(self.server.rejected)
+
+    @property
+    def connections(self):
+        return self.server.connections
+
+    def reset(self):
+        with self.server.lock:
+            self.server.counts = {}
+            self.server.slow = {}
+            self.server.windows = {}
+            self.server.rejected = {}
+            self.server.connections = 0
+
+    # start serving and point every engine (and its secrets) at this server
+    def __enter__(self):
+        import os
+
+        self.saved_urls = (engines.wikipedia_url, engines.reddit_auth_url, engines.reddit_api_url,
+                           engines.taddy_url, engines.unsplash_url)
+        engines.wikipedia_url = engines.reddit_auth_url = engines.reddit_api_url = self.url
+        engines.taddy_url = engines.unsplash_url = self.url
+        for key in ['REDDIT_USER', 'REDDIT_AGENT', 'REDDIT_KEY', 'TADDY_USER', 'TADDY_KEY', 'UNSPLASH_ACCESS']:
+            os.environ.setdefault(key, 'mock')
+
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+        (engines.wikipedia_url, engines.reddit_auth_url, engines.reddit_api_url,
+         engines.taddy_url, engines.unsplash_url) = self.saved_urls
@@ -0,0 +1,169 @@
+# "load more" (pagination.py): each topic's results page, then more_results pages by following the
+# "More results" link, with chain_search's Modal functions run in-process (benchmarks/local_modal.py),
+# the planner talking to a fake OpenAI server and the engines to the local mock upstreams
+# checks that more pages make no OpenAI calls, only show results earlier pages didn't, stop once every
+# sub-query has run out, and that bad cursors are turned away; reports latency per page and cursor size
+# also pages through one Wikipedia sub-query whose first page was an exact-title hit, checking every
+# search result shows up once, and that sub-queries whose first page failed or timed out stay in the cursor
+# usage: python -m benchmarks.pagination --topics 4 --pages 4
+import os
+import re
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+import chain_search
+import engines
+import pagination
+import result_cache
+import tracing
+from benchmarks import fixtures, local_modal, mock_upstreams
+from benchmarks.fake_openai import FakeOpenAI
+from benchmarks.load_test import ThreadOutput, container_setup, percentile
+from benchmarks.mock_upstreams import MockUpstreams
+
+# text topics (Wikipedia, Reddit and Podcast plans) and visual ones (Unsplash and Vector), see mock_openai.py
+TOPICS = ['History of Scotland', 'Mountain sunset', 'How to repair a bicycle', 'Minimalist interior design']
+
+card_urls = re.compile("<div class='linkhead'><a href = '([^']*)'").findall
+more_url = re.compile("<div class='more'><a href='([^']*)'").search
+
+def cursor_of(html: str):
+    match = more_url(html)
+    return match.group(1).split('?cursor=')[1] if match else None
+
+def body(response):
+    return response.body.decode('utf-8')
+
+async def read(chunks):
+    return ''.join([chunk async for chunk in chunks])
+
+# a crafted or damaged cursor gets a 400, not a search
+def check_bad_cursors(cursor: str):
+    topic, pages = pagination.decode_cursor(cursor)
+    bad = [
+        cursor[:-6], # cut short
+        'not a cursor',
+        pagination.encode_cursor(topic, [['Bing: ' + topic, {'page': 2}]]), # unknown engine
+        pagination.encode_cursor(topic, [['Reddit: ' + topic, {'page': 2}]]), # wrong option
+        pagination.encode_cursor(topic, [['Unsplash: ' + topic, {'page': 10 ** 6}]]), # too far
+        pagination.encode_cursor(topic, [['Wikipedia: ' + topic, {'offset': 2}]] * (pagination.MAX_PAGES + 1)),
+        pagination.encode_cursor(topic, [['Wikipedia: ' + topic, {'offset': 0, 'exclude': 'x' * 256}]]), # too long
+    ]
+    for cursor in bad:
+        try:
+            pagination.decode_cursor(cursor)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('accepted bad cursor ' + cursor)
+    assert chain_search.more_results.remote(cursor=bad[0]).status_code == 400
+
+# every page of a Wikipedia sub-query: the exact-title article first, then every other search result once
+async def check_wikipedia_pages(query: str):
+    import httpx
+
+    async with httpx.AsyncClient() as client:
+        titles, options = [], {}
+        while options is not None:
+            results = await engines.search_wikipedia(client, query, **options)
+            titles += [result.title for result in results]
+            options = pagination.next_options('Wikipedia', options, results)
+    expected = [mock_upstreams.wikipedia_search_title(query, i) for i in range(mock_upstreams.TOTAL_RESULTS)]
+    assert titles == expected, titles
+
+# a first page's errors and timeouts are asked for again (as first pages) by the next page
+def check_unanswered():
+    import pickle
+    from search_result import SearchBatch, SearchError, failed, timed_out
+
+    found = fixtures.synthetic_vector_results('vector', 10)
+    batches = [SearchBatch(found, []),
+               pickle.loads(pickle.dumps(failed('Reddit: hiking', SearchError('Reddit', 'hiking', 'HTTP 503')))),
+               timed_out('Wikipedia: mountains', 'Wikipedia'),
+               timed_out('Vector: vector', 'Vector')] # the query also has results, so it pages on from them
+    pages = pagination.first_pages(batches)
+    assert pages == [['Vector: vector', {'offset': 10}], ['Reddit: hiking', {}], ['Wikipedia: mountains', {}]], pages
+    pagination.decode_cursor(pagination.encode_cursor('topic', pages))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--topics', type=int, default=len(TOPICS))
+    parser.add_argument('--pages', type=int, default=4, help='more pages to follow per topic')
+    parser.add_argument('--fanout', choices=['modal', 'async'], default='async')
+    parser.add_argument('--hop-ms', type=float, default=30)
+    parser.add_argument('--latency-ms', type=float, default=50, help='mock upstream latency')
+    parser.add_argument('--openai-ms', type=float, default=300)
+    parser.add_argument('--token-ms', type=float, default=10)
+    args = parser.parse_args()
+    check_unanswered()
+
+    topics = (TOPICS * args.topics)[:args.topics]
+    # vector results for any query (first pages relabel this one, later pages are synthetic)
+    vectors = fixtures.VectorFixtures([{'engine': 'Vector', 'query': 'vector', 'num_matches': 10, 'latency': 0.08,
+                                        'results': [result.to_tuple() for result in fixtures.synthetic_vector_results('vector', 10)]}])
+    saved = (engines.vector_model['instance'], tracing.tracer.sinks, sys.stdout)
+    engines.vector_model['instance'] = vectors
+    tracing.tracer.sinks = []
+    sys.stdout = ThreadOutput()
+    first, more, sizes, shown = [], [], [], []
+    try:
+        with tempfile.TemporaryDirectory() as directory, \
+             MockUpstreams(default_latency=args.latency_ms / 1000) as upstreams, \
+             FakeOpenAI(args.openai_ms / 1000, args.token_ms / 1000) as fake:
+            cache_store = result_cache.SQLiteStore(os.path.join(directory, 'cache.sqlite'))
+            limit_store = result_cache.SQLiteStore(os.path.join(directory, 'limits.sqlite'))
+            setup = container_setup(None, fake.url, cache_store, limit_store) # plain httpx clients, to the mock upstreams
+            functions, counts, restore = local_modal.install(chain_search, hop=args.hop_ms / 1000, setup=setup,
+                                                             per_container=('request_flights',))
+            try:
+                asyncio.run(check_wikipedia_pages(topics[0]))
+                for topic in topics:
+                    start = time.perf_counter()
+                    html = body(chain_search.web_search.remote(query=topic, fanout=args.fanout))
+                    first.append(time.perf_counter() - start)
+                    seen = set(card_urls(html))
+                    cursor = cursor_of(html)
+                    assert seen and cursor, 'no results or no more link for ' + topic
+                    if topic == topics[0]:
+                        check_bad_cursors(cursor)
+                        # streamed pages end with a link to the same pages (in completion order)
+                        chunks = chain_search.web_search.remote(query=topic, stream=True, fanout=args.fanout).body_iterator
+                        streamed = asyncio.run(read(chunks))
+                        assert sorted(pagination.decode_cursor(cursor_of(streamed))[1]) == sorted(pagination.decode_cursor(cursor)[1])
+                    openai_calls = fake.calls
+                    pages = [len(seen)]
+                    for i in range(args.pages):
+                        sizes.append(len(cursor))
+                        start = time.perf_counter()
+                        html = body(chain_search.more_results.remote(cursor=cursor))
+                        more.append(time.perf_counter() - start)
+                        urls = card_urls(html)
+                        assert urls and not seen.intersection(urls), 'page ' + str(i + 2) + ' repeats results: ' + topic
+                        seen.update(urls)
+                        pages.append(len(urls))
+                        cursor = cursor_of(html)
+                        if cursor is None:
+                            break
+                    assert fake.calls == openai_calls, 'more pages called OpenAI'
+                    shown.append((topic, pages, cursor is None))
+
+                # every sub-query runs out eventually (the mock upstreams have a fixed number of results)
+                while cursor is not None:
+                    cursor = cursor_of(body(chain_search.more_results.remote(cursor=cursor)))
+            finally:
+                restore()
+    finally:
+        engines.vector_model['instance'], tracing.tracer.sinks, sys.stdout = saved
+
+    for topic, pages, done in shown:
+        print(f'{topic[:48]:>48}: results per page {pages}' + (' (no more)' if done else ''))
+    print(f'first page p50 {percentile(first, 0.5) * 1000:.0f} ms, more pages p50 {percentile(more, 0.5) * 1000:.0f} ms')
+    print(f'cursor {min(sizes)}-{max(sizes)} characters, {fake.calls} OpenAI calls for {len(topics)} topics, '
+          f'upstream requests {upstreams.counts}')
+    assert percentile(more, 0.5) < percentile(first, 0.5), 'more pages should skip the planner'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# compare planner latency for the two-call chain, the merged one-call plan, and cached/reworded topics
+# checks that rewordings reuse a plan (with the one-shot Wikipedia search rebuilt from the new wording),
+# paraphrases the topic key misses too (through the near-duplicate lookup), and that topics differing by
+# one meaningful word don't
+# uses benchmarks/mock_openai.py so no OpenAI key is needed; latencies scale with --call-ms and --token-ms
+# usage: python -m benchmarks.planner --call-ms 300 --token-ms 10
+import time
+import asyncio
+import argparse
+import statistics
+
+import planner
+import result_cache
+from benchmarks.mock_openai import MockAsyncOpenAI
+
+TOPICS = ['brutalist architecture', 'history of Scotland', 'wedding dresses', 'how to start a business',
+          'mountain sunset', 'home repair guide', 'history of the roman empire in the third century']
+# rewordings of TOPICS that should reuse their plans (same topic key)
+PARAPHRASES = ['Brutalist Architecture!', 'the history of scotland', 'wedding dress', 'start a business: how to',
+               'mountain sunsets', 'home repairs guide', 'the roman empire in the third century: history']
+# paraphrases with a different topic key, found by the near-duplicate lookup
+NEAR_DUPLICATES = ['brutalist architecure', 'histroy of scotland', 'wedding dressses', 'how to start a buisness',
+                   'mountain sun set', 'guide to repairing your home']
+# topics one meaningful word away from TOPICS, which need plans of their own
+DIFFERENT = ['how to sell a business', 'history of the roman empire in the fourth century', 'brutalist furniture',
+             'history of Ireland', 'history of England', 'wedding cakes', 'mountain sunrise', 'home repair tools',
+             'how to start a podcast']
+
+async def timed(coroutine):
+    start = time.perf_counter()
+    await coroutine
+    return time.perf_counter() - start
+
+def report(name: str, latencies: list, calls: int):
+    print(f'{name:>12}: median {statistics.median(latencies) * 1000:7.1f} ms  '
+          f'max {max(latencies) * 1000:7.1f} ms  OpenAI calls/topic {calls / len(latencies):.1f}')
+
+async def run(args):
+    client = MockAsyncOpenAI(call_latency=args.call_ms / 1000, token_latency=args.token_ms / 1000)
+
+    # uncached, both modes
+    uncached = planner.Planner(client=client)
+    for one_call in [False, True]:
+        client.calls = 0
+        latencies = [await timed(uncached.plan(topic, one_call=one_call)) for topic in TOPICS]
+        report('one_call' if one_call else 'two_call', latencies, client.calls)
+
+    # cached: first pass fills the cache, then exact repeats and paraphrases
+    cache = result_cache.ResultCache(ttls={'Planner': planner.PLAN_TTL})
+    cached = planner.Planner(client=client, cache=planner.PlannerCache(cache))
+    for topic in TOPICS:
+        await cached.plan(topic)
+    for name, topics in [('exact hit', TOPICS), ('paraphrase', PARAPHRASES), ('near dup', NEAR_DUPLICATES),
+                         ('different', DIFFERENT)]:
+        client.calls = 0
+        latencies = [await timed(cached.plan(topic)) for topic in topics]
+        report(name, latencies, client.calls)
+        assert client.calls == (2 * len(topics) if name == 'different' else 0), name + ': ' + str(client.calls)
+    print('planner cache:', cache.stats()['Planner'])
+    assert cache.stats()['Planner']['near_duplicate_hits'] == len(NEAR_DUPLICATES), cache.stats()['Planner']
+
+    # a reused text plan searches Wikipedia for the topic as asked, not as first planned
+    responses = await cached.plan('the history of scotland')
+    assert 'Wikipedia: the history of scotland' in responses and 'Wikipedia: history of Scotland' not in responses, responses
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--call-ms', type=float, default=300, help='per-completion overhead')
+    parser.add_argument('--token-ms', type=float, default=10, help='per output token generation time')
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
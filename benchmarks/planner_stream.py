@@ -0,0 +1,84 @@
+# harness for the streaming planner: feeds token-chunked fake streams through plan_stream and checks
+# every chunking (single characters, random sizes, lines split mid-query and mid-JSON-object) yields
+# exactly the plan the non-streaming parser produces, then reports time to first sub-query
+# usage: python -m benchmarks.planner_stream --seed 0 --trials 200
+import time
+import random
+import asyncio
+import argparse
+import statistics
+
+import planner
+from benchmarks.mock_openai import MockAsyncOpenAI
+
+TOPICS = ['brutalist architecture', 'history of Scotland', 'wedding dresses', 'how to start a business']
+
+def single_characters(text: str):
+    return list(text)
+
+def whole(text: str):
+    return [text]
+
+# split right before and after every newline and quote, the spots a naive parser gets wrong
+def around_boundaries(text: str):
+    chunks, start = [], 0
+    for i, character in enumerate(text):
+        if character in '\n"{}':
+            chunks += [text[start:i], character]
+            start = i + 1
+    return [chunk for chunk in chunks + [text[start:]] if chunk]
+
+def random_chunker(rng: random.Random):
+    def chunker(text: str):
+        chunks, start = [], 0
+        while start < len(text):
+            end = start + rng.randint(1, 12)
+            chunks.append(text[start:end])
+            start = end
+        return chunks
+    return chunker
+
+async def streamed(client, topic: str, one_call: bool):
+    return [response async for response in planner.Planner(client=client).plan_stream(topic, one_call=one_call)]
+
+async def check(args):
+    rng = random.Random(args.seed)
+    chunkers = [single_characters, whole, around_boundaries] + [random_chunker(rng) for _ in range(args.trials)]
+    checked = 0
+    for one_call in [False, True]:
+        for topic in TOPICS:
+            expected = await planner.Planner(client=MockAsyncOpenAI(0, 0)).plan(topic, one_call=one_call)
+            assert expected, 'mock planner returned nothing for ' + topic
+            for chunker in chunkers:
+                got = await streamed(MockAsyncOpenAI(0, 0, chunker=chunker), topic, one_call)
+                assert got == expected, (topic, one_call, getattr(chunker, '__name__', ''), got, expected)
+                checked += 1
+    print('streamed plans match non-streamed parse for', checked, 'chunkings')
+
+async def first_response_latency(args):
+    for one_call in [False, True]:
+        to_first, to_last = [], []
+        for topic in TOPICS:
+            client = MockAsyncOpenAI(call_latency=args.call_ms / 1000, token_latency=args.token_ms / 1000)
+            start = time.perf_counter()
+            first = None
+            async for response in planner.Planner(client=client).plan_stream(topic, one_call=one_call):
+                if first is None:
+                    first = time.perf_counter() - start
+            to_first.append(first)
+            to_last.append(time.perf_counter() - start)
+        print(f'{"one_call" if one_call else "two_call":>8}: first sub-query {statistics.median(to_first) * 1000:7.1f} ms  '
+              f'full plan {statistics.median(to_last) * 1000:7.1f} ms')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trials', type=int, default=200, help='random chunkings per topic')
+    parser.add_argument('--call-ms', type=float, default=300)
+    parser.add_argument('--token-ms', type=float, default=10)
+    args = parser.parse_args()
+    asyncio.run(check(args))
+    asyncio.run(first_response_latency(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+# check the rate limiter and circuit breaker (rate_limit.py) on a fake clock, then end to end
+# against mock upstreams that enforce a quota or fail outright
+#   bucket / headers / breaker / shared: fake-clock checks of the limiter on its own
+#   quota: hammer an engine with a small quota, with and without the limiter, and count the 429s
+#   breaker: an engine that always fails stops being called, and searches fall back to cached results
+# usage: python -m benchmarks.rate_limit --seconds 2
+import time
+import asyncio
+import argparse
+from email.utils import formatdate
+
+import dispatch
+import rate_limit
+import result_cache
+from search_result import SearchError, SearchResult, RateLimited, CircuitOpen, Throttled
+from benchmarks.mock_upstreams import MockUpstreams
+
+# time only moves when someone sleeps on it (or the test advances it)
+class FakeClock:
+    def __init__(self, start: float = 1_700_000_000.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    async def sleep(self, seconds: float):
+        self.now += seconds
+        await asyncio.sleep(0)
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+# stands in for the Modal Dict both "containers" share
+class MemoryStore:
+    def __init__(self):
+        self.entries = {}
+
+    async def get(self, key: str):
+        return self.entries.get(key)
+
+    async def put(self, key: str, entry: tuple):
+        self.entries[key] = entry
+
+def fake_limiter(clock, **options):
+    return rate_limit.RateLimiter(clock=clock.time, sleep=clock.sleep, **options)
+
+async def raises(error_type, awaitable):
+    try:
+        await awaitable
+    except error_type:
+        return True
+    return False
+
+async def check_bucket():
+    clock = FakeClock()
+    limiter = fake_limiter(clock, limits={'Podcast': (1.0, 5)})
+    for _ in range(5):
+        await limiter.acquire('Podcast', 'q', max_wait=0)
+    assert await raises(RateLimited, limiter.acquire('Podcast', 'q', max_wait=0))
+    start = clock.time()
+    await limiter.acquire('Podcast', 'q', max_wait=2)
+    assert abs(clock.time() - start - 1.0) < 1e-9, clock.time() - start
+
+    # a minute of callers who'll wait as long as it takes: the burst is spent, then one a second
+    allowed, start = 0, clock.time()
+    while clock.time() - start < 60:
+        await limiter.acquire('Podcast', 'q', max_wait=float('inf'))
+        allowed += 1
+    assert allowed == 60, allowed
+
+async def check_headers():
+    clock = FakeClock()
+    limiter = fake_limiter(clock, limits={'Unsplash': (1.0, 10)})
+
+    # Retry-After in seconds blocks the engine until it's up
+    limiter.observe('Unsplash', 429, {'retry-after': '30'})
+    assert await raises(RateLimited, limiter.acquire('Unsplash', 'q', max_wait=1))
+    clock.advance(30)
+    await limiter.acquire('Unsplash', 'q', max_wait=1)
+
+    # Retry-After as an HTTP date
+    limiter.observe('Unsplash', 503, {'retry-after': formatdate(clock.time() + 120, usegmt=True)})
+    assert 119 <= limiter.report()['Unsplash']['blocked_for'] <= 120
+
+    # X-Ratelimit-Remaining / Reset spread what's left over the rest of the window
+    limiter.observe('Reddit', 200, {'x-ratelimit-remaining': '10', 'x-ratelimit-reset': '100'})
+    assert limiter.bucket('Reddit').rate == 0.1 and limiter.bucket('Reddit').tokens <= 10
+    # OpenAI's header names and duration format
+    limiter.observe('OpenAI', 200, {'x-ratelimit-remaining-requests': '59', 'x-ratelimit-reset-requests': '1m0s'})
+    assert abs(limiter.bucket('OpenAI').rate - 59 / 60) < 1e-9
+    assert rate_limit.parse_duration('6m0s') == 360 and rate_limit.parse_duration('20ms') == 0.02
+    # no window given: Unsplash counts per hour
+    limiter.observe('Unsplash', 200, {'x-ratelimit-limit': '50', 'x-ratelimit-remaining': '36'})
+    assert limiter.bucket('Unsplash').rate == 36 / 3600
+
+    # a bare 429 halves the rate, and successes win it back
+    bucket = limiter.bucket('Wikipedia')
+    limiter.observe('Wikipedia', 429, {})
+    assert bucket.rate == rate_limit.ENGINE_LIMITS['Wikipedia'][0] / 2
+    for _ in range(20):
+        limiter.observe('Wikipedia', 200, {})
+    assert bucket.rate == bucket.base_rate
+
+async def check_breaker():
+    clock = FakeClock()
+    limiter = fake_limiter(clock, failure_threshold=3, cooldown=10)
+    for _ in range(3):
+        await limiter.check('Reddit', 'q')
+        limiter.failure('Reddit')
+    assert await raises(CircuitOpen, limiter.check('Reddit', 'q'))
+
+    # half-open: one trial at a time, and a failed trial reopens it
+    clock.advance(10)
+    await limiter.check('Reddit', 'q')
+    assert await raises(CircuitOpen, limiter.check('Reddit', 'q'))
+    limiter.failure('Reddit')
+    assert await raises(CircuitOpen, limiter.check('Reddit', 'q'))
+
+    # a successful trial closes it
+    clock.advance(10)
+    await limiter.check('Reddit', 'q')
+    limiter.success('Reddit')
+    for _ in range(5):
+        await limiter.check('Reddit', 'q')
+
+async def check_shared():
+    clock = FakeClock()
+    store = MemoryStore()
+    options = {'limits': {'Podcast': (0.001, 10)}, 'sync_interval': 0, 'failure_threshold': 2}
+    first, second = fake_limiter(clock, store=store, **options), fake_limiter(clock, store=store, **options)
+
+    # both containers draw on one bucket (each may be one token ahead of what it has published)
+    allowed = 0
+    for _ in range(20):
+        for limiter in (first, second):
+            if not await raises(RateLimited, limiter.acquire('Podcast', 'q', max_wait=0)):
+                allowed += 1
+    assert 10 <= allowed <= 12, allowed
+
+    # a Retry-After seen by one container holds back the other
+    first.observe('Reddit', 429, {'retry-after': '60'})
+    await asyncio.gather(*first.tasks)
+    assert await raises(RateLimited, second.acquire('Reddit', 'q', max_wait=1))
+
+    # and so does a breaker one container opened
+    first.failure('Unsplash')
+    first.failure('Unsplash')
+    await asyncio.gather(*first.tasks)
+    assert await raises(CircuitOpen, second.check('Unsplash', 'q'))
+
+# search one engine as fast as possible for a while, returning (ok, throttled, failed) counts
+async def hammer(dispatcher, engine: str, seconds: float):
+    counts = {'ok': 0, 'throttled': 0, 'failed': 0}
+    end, i = time.monotonic() + seconds, 0
+    while time.monotonic() < end:
+        i += 1
+        try:
+            await dispatcher.search(engine, 'query ' + str(i))
+            counts['ok'] += 1
+        except Throttled:
+            counts['throttled'] += 1
+        except SearchError:
+            counts['failed'] += 1
+    return counts
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+def check_quota(seconds: float):
+    print(f'{"":>16} {"ok":>5} {"throttled":>10} {"upstream 429s":>14} {"requests":>9}')
+    rejected = {}
+    for limited in [False, True]:
+        # 10 requests a second, reset headers on every response
+        with MockUpstreams(default_latency=0.005, quota={'Unsplash': (10, 1.0)}) as upstreams:
+            async def go():
+                limiter = rate_limit.RateLimiter(limits={'Unsplash': (50 / 3600, 50)}) if limited else None
+                dispatcher = dispatch.Dispatcher(limiter=limiter, hedge=False)
+                return await hammer(dispatcher, 'Unsplash', seconds)
+            counts = run(go())
+            rejected[limited] = upstreams.rejected.get('Unsplash', 0)
+            print(f'{"limited" if limited else "unlimited":>16} {counts["ok"]:5d} {counts["throttled"]:10d} '
+                  f'{rejected[limited]:14d} {upstreams.counts.get("Unsplash", 0):9d}')
+    assert rejected[True] * 10 < rejected[False], rejected
+
+def check_fallback():
+    with MockUpstreams(default_latency=0.005, fail={'Podcast': 503}) as upstreams:
+        async def go():
+            # an old entry that would normally count as a miss
+            cache = result_cache.ResultCache(ttls={'Podcast': 0}, max_stale=0)
+            limiter = rate_limit.RateLimiter(failure_threshold=3, cooldown=60)
+            dispatcher = dispatch.Dispatcher(cache=cache, limiter=limiter, hedge=False)
+            await cache.set('Podcast', 'query', [SearchResult('Podcast', 'query', 'https://podcasts.example.com/old')])
+
+            outcomes = []
+            for _ in range(10):
+                try:
+                    results = await dispatcher.search('Podcast', 'query')
+                    outcomes.append('cached' if results[0].url.endswith('/old') else 'fresh')
+                except SearchError:
+                    outcomes.append('failed')
+            return outcomes, dispatcher.stats['fallbacks']
+        outcomes, fallbacks = run(go())
+        assert outcomes == ['failed'] * 3 + ['cached'] * 7, outcomes
+        assert upstreams.counts.get('Podcast') == 3 and fallbacks == 7, (upstreams.counts, fallbacks)
+        print(f'breaker: {upstreams.counts["Podcast"]} upstream calls for 10 searches, '
+              f'{fallbacks} served from cache while open')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=2.0, help='how long to hammer the quota-limited engine')
+    args = parser.parse_args()
+
+    for check in [check_bucket, check_headers, check_breaker, check_shared]:
+        run(check())
+    print('fake-clock checks passed (bucket, headers, breaker, shared state)\n')
+    check_quota(args.seconds)
+    check_fallback()
+
+if __name__ == '__main__':
+    main()
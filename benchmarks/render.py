@@ -0,0 +1,123 @@
+# compare the template renderer (render.py) on SearchResults with the string concatenation web_search used to do on dicts
+# checks the markup is identical for results with nothing to escape and that hostile fields come out escaped
+# the template renderer is slower (it escapes every field and checks every URL's scheme, which the concatenation
+# never did); this reports what that costs per card
+# usage: python -m benchmarks.render --cards 1000 --repeat 20
+import time
+import argparse
+import statistics
+
+import render
+from search_result import SearchResult
+
+# the concatenation renderer the results page used before render.py
+def concat_render_result(result: dict):
+    html_string = "<div class='rowchild'>"
+
+    if 'title' in result and result['title']:
+        html_string += "<div class='linkhead'><a href = '" + result['url'] + "'>" + result['title'] + "</a></div>"
+    else: 
+        html_string += "<div class='linkhead'><a href = '" + result['url'] + "'>Link</a></div>"
+
+    if 'subsource' in result:
+        if result['source'] in ['Image Vector Search']:
+            html_string += "<div>Source: <a href='" + result['subsource_url'] + "'>" + result['subsource'] + "</a></div>"
+        else:
+            html_string += "<div>Source: <a href='" + result['subsource_url'] + "'>" + result['subsource'] + "</a> <i>(" + result['source'] + ")</i></div>"
+    else:
+        html_string += "<div>Source: <i>" + result['source'] + "</i></div>"
+
+    html_string += "<div class='actualquery'>Actual query: <i>" + result['query'] + "</i></div>"
+
+    if 'snippet' in result and result['snippet']:
+        html_string += "<div class='snippet'>" + result['snippet'] + '</div>'
+    if result['thumbnail'] and result['thumbnail'] != 'None' and type(result['thumbnail']) != dict:
+        if result['source'] == 'Podcast':
+            html_string += "<div class='imagecontainer'><a href='" + result['thumbnail'] + "'><img class='podcast' src='" + result['thumbnail'] + "' loading='lazy' width='200' height='200' /></a></div>"
+        else:
+            html_string += "<div class='imagecontainer'><a href='" + result['thumbnail'] + "'><img src='" + result['thumbnail'] + "' loading='lazy' width='640' height='400' /></a></div>"
+
+    html_string += "</div>"
+    return html_string
+
+def concat_page(query: str, results: list):
+    html_string = "<html>" + render.render_header(query)
+    if results:
+        html_string += "<div class='row'>"
+    for result in results:
+        html_string += concat_render_result(result)
+    html_string += "</div></body></html>"
+    return html_string
+
+# one result per engine shape, cycled to the requested count
+def make_results(count: int):
+    shapes = [
+        {'source': 'Wikipedia', 'url': 'https://en.wikipedia.org/wiki/Mountain_{i}', 'title': 'Mountain {i}',
+         'snippet': 'A mountain is an elevated portion of the crust of the Earth {i}', 'thumbnail': 'None'},
+        {'source': 'Reddit', 'subsource': 'r/hiking/', 'subsource_url': 'https://www.reddit.com/r/hiking/',
+         'url': 'https://www.reddit.com/r/hiking/comments/{i}/', 'title': 'Sunset from the summit {i}',
+         'snippet': 'We hiked up before dawn...(more)', 'thumbnail': 'https://i.redd.it/{i}.jpg'},
+        {'source': 'Podcast', 'subsource': 'Outside Podcast', 'subsource_url': 'https://outsideonline.com/podcast',
+         'url': 'https://podcasts.example.com/{i}', 'title': 'Episode {i}', 'snippet': '', 'thumbnail': 'https://img.example.com/{i}.jpg'},
+        {'source': 'Unsplash', 'subsource': 'photographer', 'subsource_url': 'https://unsplash.com/@photographer',
+         'url': 'https://unsplash.com/photos/{i}', 'snippet': None, 'thumbnail': 'https://images.unsplash.com/photo-{i}'},
+        {'source': 'Image Vector Search', 'subsource': 'Savee', 'subsource_url': 'https://savee.it/i/{i}',
+         'url': 'https://savee.it/i/{i}', 'title': '', 'snippet': 'caption {i}', 'thumbnail': 'https://cdn.savee.it/{i}.jpg'},
+    ]
+    results = []
+    for i in range(count):
+        shape = shapes[i % len(shapes)]
+        result = {key: value.format(i=i) if isinstance(value, str) else value for key, value in shape.items()}
+        result['query'] = 'mountain sunset ' + str(i)
+        results.append(result)
+    return results
+
+# the same result as a SearchResult ('None' and None mean no thumbnail / snippet)
+def to_record(result: dict):
+    return SearchResult(result['source'], result['query'], result['url'],
+                        title=result.get('title') or '',
+                        snippet=result.get('snippet') or '',
+                        thumbnail='' if result['thumbnail'] == 'None' else result['thumbnail'],
+                        subsource=result.get('subsource'),
+                        subsource_url=result.get('subsource_url'))
+
+def check_escaping():
+    hostile = SearchResult('Reddit', 'a & b', 'javascript:alert(1)',
+                           title='<script>alert(1)</script>',
+                           snippet="it's <img src=x onerror=alert(1)>",
+                           thumbnail='https://img.example.com/a.jpg?w=1&h=2',
+                           subsource='r/<b>x</b>/',
+                           subsource_url="https://reddit.com/r/x/' onmouseover='alert(1)")
+    card = render.render_result(hostile)
+    assert '<script>' not in card and '<img src=x' not in card and "' onmouseover" not in card, card
+    assert "href = '#'" in card and 'a &amp; b' in card and 'w=1&amp;h=2' in card, card
+    header = render.render_header("'><script>alert(1)</script>")
+    assert '<script>alert' not in header, header
+
+def timed(function, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = function()
+        timings.append(time.perf_counter() - start)
+    return output, statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cards', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    check_escaping()
+    results = make_results(args.cards)
+    records = [to_record(result) for result in results]
+    old, old_time = timed(lambda: concat_page('mountain sunset', results), args.repeat)
+    new, new_time = timed(lambda: ''.join(render.render_page('mountain sunset', records)), args.repeat)
+    assert old == new, 'markup changed'
+    print(f'{args.cards} cards, {len(new)} bytes, same markup')
+    print(f'concatenation: {old_time * 1000:7.2f} ms (no escaping)')
+    print(f'     template: {new_time * 1000:7.2f} ms (escaping every field), '
+          f'{(new_time - old_time) / args.cards * 1e6:.1f} us more per card')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# measure what a search's results cost to send between containers: each Modal return (engine ->
+# parse_response -> web_search) and each shared cache write pickles one search's results
+# compares, summed over a request's searches:
+#   dicts: the result dicts engines built before SearchResult
+#   records: lists of SearchResult with the dataclass's own pickling
+#   SearchResults: the marshal blob of field tuples Dispatcher.fetch returns (search_result.py)
+# under plain pickle and under Modal's serializer, which deployed payloads go through: it runs a Python
+# hook on every object it writes, so the number of objects in a payload counts for more than its bytes
+# timings are the best of --rounds rounds
+# usage: python -m benchmarks.search_result --searches 9 --repeat 400
+import time
+import pickle
+import argparse
+
+from search_result import SearchResult, SearchResults, SearchBatch, SearchError, failed, field_names
+
+# results like one plan's searches return: per engine, a search's worth of results
+def make_request(searches: int):
+    batches = []
+    for i in range(searches):
+        query = 'scottish highlands castle ' + str(i)
+        results = []
+        for j in range(4):
+            results.append(SearchResult('Reddit', query, 'https://www.reddit.com/r/Scotland/comments/' + str(i) + str(j) + '/castle_at_dawn/',
+                                        title='Eilean Donan at dawn, taken on my trip last spring (' + str(i) + str(j) + ')',
+                                        snippet='We drove up from Inverness before sunrise, stop ' + str(i) + str(j) + ', and had the place to ourselves...(more)',
+                                        thumbnail='https://preview.redd.it/' + str(i) + str(j) + 'abcdef.jpg?width=1080&format=pjpg&auto=webp&s=0123456789abcdef',
+                                        subsource='r/Scotland/',
+                                        subsource_url='https://www.reddit.com/r/Scotland/'))
+        batches.append(SearchBatch(SearchResults(results), []))
+    return batches
+
+# the dicts engines used to build for the same results
+def as_dicts(batches):
+    return [[dict(zip(field_names, result.to_tuple())) for result in batch.results] for batch in batches]
+
+def best_time(function, repeat: int, rounds: int):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(repeat // rounds):
+            function()
+        times.append((time.perf_counter() - start) / (repeat // rounds))
+    return min(times)
+
+# bytes and encode + decode seconds for every payload in payloads, one encode each like a Modal return
+def measure(name: str, encode, decode, payloads: list, repeat: int, rounds: int):
+    data = [encode(payload) for payload in payloads]
+    encode_time = best_time(lambda: [encode(payload) for payload in payloads], repeat, rounds)
+    decode_time = best_time(lambda: [decode(item) for item in data], repeat, rounds)
+    size = sum(len(item) for item in data)
+    print(f'{name:>16}: {size:7d} bytes  encode {encode_time * 1e6:7.1f} us  decode {decode_time * 1e6:7.1f} us')
+    return size, encode_time + decode_time
+
+def check():
+    result = SearchResult('Podcast', 'q', 'https://example.com', thumbnail='https://example.com/a.jpg', subsource='Show', subsource_url='')
+    assert pickle.loads(pickle.dumps(result)) == result
+    assert SearchResult.from_tuple(result.to_tuple()) == result
+    results = pickle.loads(pickle.dumps(SearchResults([result, result])))
+    assert type(results) is SearchResults and results == [result, result]
+    batch = pickle.loads(pickle.dumps(SearchBatch([result], ['error'], ('Podcast',))))
+    assert batch == SearchBatch([result], ['error'], ('Podcast',))
+    error = pickle.loads(pickle.dumps(SearchError('Reddit', 'q', 'auth token failure')))
+    assert failed('Reddit: q', error).errors == ["Reddit search for 'q' failed: auth token failure"]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--searches', type=int, default=9)
+    parser.add_argument('--repeat', type=int, default=400)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    check()
+    batches = make_request(args.searches)
+    payloads = {
+        'dicts': as_dicts(batches),
+        'records': [list(batch.results) for batch in batches],
+        'SearchResults': [batch.results for batch in batches],
+    }
+    serializers = [('pickle', pickle.dumps, pickle.loads)]
+    try:
+        from modal._serialization import serialize, deserialize
+        serializers.append(("Modal's serializer", serialize, lambda data: deserialize(data, None)))
+    except ImportError:
+        print('(modal not installed, measuring plain pickle only)')
+
+    print(f'{args.searches} searches, {sum(len(batch.results) for batch in batches)} results per request')
+    for label, encode, decode in serializers:
+        print(label)
+        measured = {name: measure(name, encode, decode, items, args.repeat, args.rounds) for name, items in payloads.items()}
+        (before_size, before_time), (after_size, after_time) = measured['dicts'], measured['SearchResults']
+        print(f'  dicts -> SearchResults: {before_size} -> {after_size} bytes ({1 - after_size / before_size:.0%} smaller), '
+              f'{before_time * 1e6:.1f} -> {after_time * 1e6:.1f} us of encode + decode ({before_time / after_time:.1f}x)')
+        assert after_size < before_size
+        if label != 'pickle': # what deployed payloads go through
+            assert after_time < before_time, 'SearchResults should be cheaper than dicts under Modal'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# cold-start checks for the worker apps
+#   imports: in a fresh interpreter (like a new container), importing the app modules mustn't pull in
+#   the heavy clients (fastapi, httpx, bs4, openai, PIL) that only some functions need; reports the startup
+#   profiler's import times
+#   clip: the text-only export (text_tower in pinecone_query.py) gives the same embeddings as the full
+#   CLIP model, and compares load time and size of the two on disk (random weights in CLIP ViT-B/32's
+#   shapes, so no download is needed), plus the accuracy of the int8 encoder
+# usage: python -m benchmarks.startup --loads 3
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+# app modules a container imports at startup, and modules none of them should import by themselves
+app_modules = ['chain_search', 'dispatch', 'engines', 'planner']
+lazy_modules = ['fastapi', 'httpx', 'bs4', 'openai', 'PIL']
+
+def check_imports():
+    script = ('import startup, sys, json\n'
+              'import ' + ', '.join(app_modules) + '\n'
+              'print(json.dumps({"loaded": [name for name in ' + repr(lazy_modules) + ' if name in sys.modules],'
+              ' "imports": dict(startup.nested, **startup.imports)}))')
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                            env=dict(os.environ, STARTUP_PROFILE='1'), cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    elapsed = time.perf_counter() - start
+    profile = json.loads(output.stdout.strip().splitlines()[-1])
+    assert not profile['loaded'], 'imported at startup: ' + ', '.join(profile['loaded'])
+    print(f'fresh interpreter importing {", ".join(app_modules)}: {elapsed:.2f}s, none of {", ".join(lazy_modules)} imported')
+    for name, seconds in sorted(profile['imports'].items(), key=lambda item: -item[1])[:8]:
+        print(f'  {name:>24} {seconds * 1000:8.1f}ms')
+
+def directory_size(path: str):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def best_load(load, loads: int):
+    timings = []
+    for _ in range(loads):
+        start = time.perf_counter()
+        load()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def check_clip(loads: int):
+    import torch
+    import transformers
+    from pinecone_query import text_tower
+
+    torch.manual_seed(0)
+    config = transformers.CLIPConfig(
+        text_config={'hidden_size': 512, 'intermediate_size': 2048, 'num_attention_heads': 8, 'num_hidden_layers': 12},
+        vision_config={'hidden_size': 768, 'intermediate_size': 3072, 'num_attention_heads': 12,
+                       'num_hidden_layers': 12, 'patch_size': 32, 'image_size': 224},
+        projection_dim=512,
+    )
+    clip = transformers.CLIPModel(config).eval()
+    text_model = text_tower(clip)
+
+    # same vectors as the full model's text features
+    input_ids = torch.randint(0, config.text_config.vocab_size - 1, (8, 16))
+    input_ids[:, -1] = config.text_config.vocab_size - 1 # CLIP pools at the highest token id (end of text)
+    with torch.inference_mode():
+        expected = clip.get_text_features(input_ids=input_ids)
+        expected = getattr(expected, 'pooler_output', expected) # a model output in newer transformers
+        embeds = text_model(input_ids=input_ids).text_embeds
+    assert torch.allclose(expected, embeds, atol=1e-5), (expected - embeds).abs().max()
+    print('\ntext-only export matches the full model\'s text features')
+
+    with tempfile.TemporaryDirectory() as path:
+        full_path, text_path = os.path.join(path, 'full'), os.path.join(path, 'text')
+        clip.save_pretrained(full_path, safe_serialization=True)
+        text_model.save_pretrained(text_path, safe_serialization=True)
+        full_load = best_load(lambda: transformers.CLIPModel.from_pretrained(full_path), loads)
+        text_load = best_load(lambda: transformers.CLIPTextModelWithProjection.from_pretrained(text_path, use_safetensors=True), loads)
+        print(f'{"":>6} {"on disk":>10} {"load":>9}')
+        print(f'{"full":>6} {directory_size(full_path) / 1e6:8.1f}MB {full_load * 1000:7.0f}ms')
+        print(f'{"text":>6} {directory_size(text_path) / 1e6:8.1f}MB {text_load * 1000:7.0f}ms')
+        assert directory_size(text_path) < directory_size(full_path) / 2
+
+    # int8 (CLIP_ENCODER=text-int8) stays close to float32
+    quantized = torch.ao.quantization.quantize_dynamic(text_model, {torch.nn.Linear}, dtype=torch.qint8)
+    with torch.inference_mode():
+        similarity = torch.nn.functional.cosine_similarity(embeds, quantized(input_ids=input_ids).text_embeds)
+    print(f'int8 text encoder: cosine similarity to float32 min {similarity.min():.4f}, mean {similarity.mean():.4f}')
+    assert similarity.min() > 0.95, similarity
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loads', type=int, default=3, help='loads of each model to take the best time from')
+    parser.add_argument('--skip-clip', action='store_true', help='only check imports (no torch/transformers needed)')
+    args = parser.parse_args()
+
+    check_imports()
+    if not args.skip_clip:
+        check_clip(args.loads)
+
+if __name__ == '__main__':
+    main()
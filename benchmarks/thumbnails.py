@@ -0,0 +1,217 @@
+# page weight of a results page with its images linked directly versus through the thumbnail proxy
+# (thumbnails.py and chain_search.thumbnail), against a local server of synthetic full-size originals:
+# Reddit preview sources and podcast artwork at 3000px, Unsplash regular at 1080px, vector images at 1200px
+# weight is the HTML plus every image the page loads; lazy loading defers everything below the first
+# --fold cards, so the initial load is reported too
+# also checks each image is fetched once (a second page load and concurrent requests make no new fetches),
+# thumbnails fit their card, bad signatures get a 403, unusable images redirect to the original, and the
+# disk cache evicts least recently used files
+# usage: python -m benchmarks.thumbnails --fold 4
+import io
+import os
+import re
+import sys
+import time
+import html
+import asyncio
+import argparse
+import tempfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import chain_search
+import render
+import thumbnails
+from benchmarks.load_test import percentile
+from search_result import SearchResult
+
+# (source, results on the page, original width, height) for a mixed text and visual page
+PAGE = [
+    ('Wikipedia', 2, 640, 480),
+    ('Reddit', 8, 3024, 4032),
+    ('Podcast', 6, 3000, 3000),
+    ('Unsplash', 20, 1080, 720),
+    ('Image Vector Search', 10, 1200, 1600),
+]
+
+# a photo-like JPEG: smooth noise that compresses about like a photograph
+def original(width: int, height: int, seed: int):
+    from PIL import Image
+
+    noise = Image.effect_noise((width // 6, height // 6), 40 + seed % 30).resize((width, height), Image.BICUBIC)
+    image = Image.merge('RGB', [noise, noise.rotate(90 * (seed % 4), expand=False), noise.transpose(Image.FLIP_LEFT_RIGHT)])
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+class ImageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.images.get(self.path)
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.sent += len(data or b'')
+        time.sleep(self.server.latency)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg' if data[:2] == b'\xff\xd8' else 'text/html')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class ImageServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+def start_server(images: dict, latency: float):
+    server = ImageServer(('127.0.0.1', 0), ImageHandler)
+    server.images, server.latency, server.lock, server.requests, server.sent = images, latency, threading.Lock(), 0, 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:' + str(server.server_address[1])
+
+def make_page(base: str, images: dict):
+    results, variants = [], {}
+    for source, count, width, height in PAGE:
+        for i in range(count):
+            # a few distinct originals per source, each under its own URL like separate results
+            key = (width, height, i % 3)
+            if key not in variants:
+                variants[key] = original(width, height, len(variants))
+            path = '/' + source.replace(' ', '-').lower() + '/' + str(i) + '.jpg'
+            images[path] = variants[key]
+            results.append(SearchResult(source, 'mountain sunset', 'https://example.com/' + source + '/' + str(i),
+                                        title=source + ' result ' + str(i), thumbnail=base + path))
+    return results
+
+image_sources = re.compile("<img [^>]*src='([^']*)'").findall
+image_links = re.compile("<div class='imagecontainer'><a href='([^']*)'").findall
+
+# call the thumbnail endpoint for a proxied image URL, returning the response
+async def fetch_thumbnail(src: str):
+    params = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(html.unescape(src)).query))
+    return await chain_search.thumbnail.local(**params)
+
+async def load_proxied(sources: list):
+    start = time.perf_counter()
+    responses = await asyncio.gather(*[timed_thumbnail(src) for src in sources])
+    return responses, time.perf_counter() - start
+
+async def timed_thumbnail(src: str):
+    start = time.perf_counter()
+    response = await fetch_thumbnail(src)
+    return response, time.perf_counter() - start
+
+def direct_weight(sources: list):
+    import httpx
+
+    with httpx.Client() as client:
+        return [len(client.get(html.unescape(src)).content) for src in sources]
+
+def check_cache_eviction(directory: str):
+    cache = thumbnails.DiskCache(directory, max_bytes=3000)
+    for i in range(3):
+        cache.put('image|' + str(i), bytes([i]) * 1000)
+        time.sleep(0.01)
+    assert cache.get('image|0') is not None # most recently used now
+    cache.put('image|3', b'\x03' * 1000)
+    assert cache.get('image|1') is None and cache.get('image|0') is not None and cache.total <= 3000, cache.stats
+    cache.put('image|same', b'\x03' * 1000) # same bytes, same file
+    assert cache.get('image|same')[0] == cache.get('image|3')[0] and cache.total <= 3000
+
+async def checks(base: str, server, results: list):
+    from PIL import Image
+
+    # a thumbnail fits its card
+    for result in results[:1] + [result for result in results if result.source == 'Podcast'][:1]:
+        size = thumbnails.size_for(result)
+        response = await fetch_thumbnail(thumbnails.proxy_url('', result.thumbnail, size))
+        image = Image.open(io.BytesIO(response.body))
+        assert image.format == 'WEBP' and image.width <= thumbnails.SIZES[size][0] and image.height <= thumbnails.SIZES[size][1]
+
+    # concurrent requests for a new image share one fetch
+    server.images['/burst.jpg'] = server.images[results[-1].thumbnail[len(base):]]
+    before = server.requests
+    src = thumbnails.proxy_url('', base + '/burst.jpg', 'image')
+    responses = await asyncio.gather(*[fetch_thumbnail(src) for _ in range(16)])
+    assert all(response.status_code == 200 for response in responses) and server.requests - before == 1
+
+    # signatures are checked, and images that can't be fetched or decoded go to the original
+    url = results[0].thumbnail
+    assert (await chain_search.thumbnail.local(url=url, size='image', sig='0' * 32)).status_code == 403
+    assert (await chain_search.thumbnail.local(url=url + '?x', size='image', sig=thumbnails.sign(url, 'image'))).status_code == 403
+    server.images['/page.jpg'] = b'<html>not an image</html>'
+    for broken in [base + '/missing.jpg', base + '/page.jpg']:
+        response = await chain_search.thumbnail.local(url=broken, size='image', sig=thumbnails.sign(broken, 'image'))
+        assert response.status_code == 302 and response.headers['location'] == broken
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fold', type=int, default=4, help='cards visible before scrolling')
+    parser.add_argument('--latency-ms', type=float, default=20, help='image server latency')
+    args = parser.parse_args()
+    os.environ.setdefault('THUMBNAIL_KEY', 'benchmark') # instead of the key in the Modal Dict
+
+    images = {}
+    server, base = start_server(images, args.latency_ms / 1000)
+    results = make_page(base, images)
+    with tempfile.TemporaryDirectory() as directory:
+        thumbnails.THUMBNAIL_DIR = os.path.join(directory, 'thumbnails')
+        check_cache_eviction(os.path.join(directory, 'eviction'))
+
+        before_html = ''.join(render.render_page('mountain sunset', results))
+        before_sources = image_sources(before_html)
+        before_images = direct_weight(before_sources)
+        after_html = ''.join(render.render_page('mountain sunset', results, thumbnail_src=thumbnails.proxy_src('http://thumbnails.local/')))
+        after_sources = image_sources(after_html)
+        assert after_html.count("loading='lazy'") == len(after_sources) == len(results)
+        assert "width='640' height='400'" in after_html and "width='200' height='200'" in after_html
+        assert image_links(after_html) == image_links(before_html) == before_sources, 'images should link to the originals'
+
+        output, sys.stdout = sys.stdout, io.StringIO() # the endpoint's logs
+        loop = asyncio.new_event_loop()
+        try:
+            server.requests = 0
+            cold, cold_elapsed = loop.run_until_complete(load_proxied(after_sources))
+            fetched = server.requests
+            warm, warm_elapsed = loop.run_until_complete(load_proxied(after_sources))
+            refetched = server.requests - fetched
+            loop.run_until_complete(checks(base, server, results))
+        finally:
+            loop.close()
+            sys.stdout = output
+        cache = thumbnails.get_disk_cache()
+        stored = cache.total
+        files = cache.connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    assert all(response.status_code == 200 for response, seconds in cold + warm)
+    after_images = [len(response.body) for response, seconds in cold]
+    before_weight = len(before_html) + sum(before_images)
+    after_weight = len(after_html) + sum(after_images)
+    before_initial = len(before_html) + sum(before_images) # no lazy loading before, every image loads up front
+    after_initial = len(after_html) + sum(after_images[:args.fold])
+    print(f'{len(results)} results: ' + ', '.join(source + ' ' + str(count) for source, count, width, height in PAGE))
+    print(f'{"":>16} {"HTML":>10} {"images":>12} {"page":>12} {"initial load":>14}')
+    print(f'{"direct":>16} {len(before_html):10,d} {sum(before_images):12,d} {before_weight:12,d} {before_initial:14,d}')
+    print(f'{"proxied":>16} {len(after_html):10,d} {sum(after_images):12,d} {after_weight:12,d} {after_initial:14,d}')
+    print(f'page weight {before_weight / after_weight:.1f}x smaller, initial load {before_initial / after_initial:.1f}x smaller '
+          f'(first {args.fold} cards)')
+    print(f'cold: {fetched} originals fetched, p50 {percentile([s for r, s in cold], 0.5) * 1000:.0f} ms per thumbnail, '
+          f'{cold_elapsed * 1000:.0f} ms for the page')
+    print(f'warm: {refetched} fetched, p50 {percentile([s for r, s in warm], 0.5) * 1000:.1f} ms per thumbnail, '
+          f'{warm_elapsed * 1000:.0f} ms for the page')
+    # results sharing an original share a file too (the page reuses a few originals per source)
+    print(f'disk cache: {files} files, {stored:,d} bytes for {len(results)} images')
+    assert fetched == len(results) and refetched == 0
+    assert after_weight * 5 < before_weight, (before_weight, after_weight)
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
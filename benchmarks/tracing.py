@@ -0,0 +1,193 @@
+# check request tracing (tracing.py) end to end against local mock upstreams
+#   spans: a traced request through the dispatcher has a search span per sub-query, with fetch and
+#          upstream spans under it (hedges tagged, a stalled engine's spans cancelled at the deadline),
+#          and only search spans once the result cache answers
+#   sinks: the JSONL file and an OTLP/HTTP collector (a local server here) get every span, and the
+#          JSONL file summarizes into p50/p95/p99 per stage and engine; a full file is rotated
+#   debug: spans from a "remote" function (resumed from a context dict) reach collect, and the
+#          ?debug=timing waterfall has a row per span with hostile fields escaped
+#   overhead: cost of tracing per cached search
+# usage: python -m benchmarks.tracing --rounds 20
+import os
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import render
+import result_cache
+import tracing
+from benchmarks.mock_upstreams import MockUpstreams
+from benchmarks.fanout import RESPONSES
+from benchmarks.deadlines import make_dispatcher
+
+# a local OpenTelemetry collector that keeps every OTLP/HTTP JSON payload posted to /v1/traces
+class Collector:
+    def __init__(self):
+        self.payloads = []
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if self.path == '/v1/traces':
+                    collector.payloads.append(json.loads(body))
+                self.send_response(200 if self.path == '/v1/traces' else 404)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.endpoint = 'http://127.0.0.1:' + str(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def spans(self):
+        return [span for payload in self.payloads for resource in payload['resourceSpans']
+                for scope in resource['scopeSpans'] for span in scope['spans']]
+
+    def close(self):
+        self.server.shutdown()
+
+# run the responses as one traced request, returning the root span and every span of its trace
+def traced_request(dispatcher, responses: list, loop, debug: bool = False):
+    async def run():
+        with tracing.start_trace('request', debug=debug) as root:
+            batches = [batch async for response, batch in dispatcher.run(responses)]
+        return root, batches
+    root, batches = loop.run_until_complete(run())
+    loop.run_until_complete(asyncio.sleep(0.05)) # let searches cancelled at the deadline unwind
+    tracing.tracer.flush()
+    return root, batches
+
+def children(records: list, span_id: str, name: str = None):
+    return [record for record in records if record['parent_id'] == span_id and (name is None or record['name'] == name)]
+
+def check_spans(loop, path: str, collector: Collector):
+    tail = {engine: (0.3, 0.3) for engine in ['Wikipedia', 'Reddit', 'Podcast', 'Unsplash']}
+    with MockUpstreams(default_latency=0.02, latency={'Podcast': 30.0}, tail=tail, seed=3) as upstreams:
+        cache = result_cache.ResultCache()
+        dispatcher = make_dispatcher(loop, cache=cache, deadline=1.0)
+        dispatcher.latencies.samples.update({engine: [0.02] * 50 for engine in tail}) # hedge after ~20ms
+        root, batches = traced_request(dispatcher, RESPONSES, loop)
+        records = [record for record in tracing.read_jsonl(path) if record['trace_id'] == root.trace_id]
+
+        # a search span per sub-query, right under the root
+        searches = children(records, root.span_id, 'search')
+        assert sorted(record['attributes']['engine'] + ': ' + record['attributes']['query'] for record in searches) == sorted(RESPONSES)
+        for search in searches:
+            fetches = children(records, search['span_id'], 'fetch')
+            assert len(fetches) == 1, search
+            upstream = sorted(children(records, fetches[0]['span_id'], 'upstream'), key=lambda record: record['start'])
+            assert 1 <= len(upstream) <= 2 and not upstream[0]['attributes']['hedge'], upstream
+            if search['attributes']['engine'] == 'Podcast': # stalled past the deadline
+                assert search['status'] == fetches[0]['status'] == 'cancelled', search
+        hedges = [record for record in records if record['name'] == 'upstream' and record['attributes']['hedge']]
+        assert len(hedges) == dispatcher.stats['hedges'] and hedges, (len(hedges), dispatcher.stats)
+        print(f'{len(records)} spans for {len(RESPONSES)} sub-queries '
+              f'({len(hedges)} hedged upstream attempts, Podcast cancelled at the deadline)')
+
+        # the same request again is answered by the cache, so no fetch spans (Podcast is still stalled)
+        cached = [response for response in RESPONSES if not response.startswith('Podcast')]
+        root, batches = traced_request(dispatcher, cached, loop)
+        records = [record for record in tracing.read_jsonl(path) if record['trace_id'] == root.trace_id]
+        assert set(record['name'] for record in records) == set(['request', 'search']), records
+
+    # the collector got the same spans, in OTLP's shape
+    otlp = collector.spans()
+    assert len(otlp) == len(tracing.read_jsonl(path)), (len(otlp), len(tracing.read_jsonl(path)))
+    ids = set(span['spanId'] for span in otlp)
+    assert all(len(span['traceId']) == 32 and len(span['spanId']) == 16 for span in otlp)
+    assert all(span.get('parentSpanId') in ids for span in otlp if 'parentSpanId' in span)
+    assert all(int(span['endTimeUnixNano']) >= int(span['startTimeUnixNano']) for span in otlp)
+    print(f'OTLP collector received {len(otlp)} spans in {len(collector.payloads)} posts')
+
+    summary = tracing.summarize(tracing.read_jsonl(path))
+    print(f'\n{"stage":>20} {"count":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for stage in sorted(summary):
+        values = summary[stage]
+        print(f'{stage:>20} {values["count"]:6d} {values["p50"] * 1000:8.1f} {values["p95"] * 1000:8.1f} {values["p99"] * 1000:8.1f}')
+    assert summary['upstream:Reddit']['count'] >= 3 and summary['search:Wikipedia']['p50'] > 0
+
+def check_debug(loop):
+    # a function in another "container" continues the trace from a context dict, so its spans are
+    # exported (to the debug Queue when deployed) as soon as it returns
+    async def remote_search(trace: dict):
+        with tracing.span('search_reddit', parent=trace):
+            with tracing.span('search', engine='Reddit', query='<script>alert(1)</script>'):
+                await asyncio.sleep(0.01)
+
+    async def run():
+        with tracing.start_trace('web_search', debug=True, query='scottish history') as root:
+            with tracing.span('call', parent=root, engine='Reddit') as call:
+                await remote_search(tracing.context(call))
+            with tracing.span('render'):
+                await asyncio.sleep(0.001)
+            return root, tracing.collect(root)
+    root, spans = loop.run_until_complete(run())
+    names = [span['name'] for span in spans]
+    assert sorted(names) == sorted(['web_search', 'call', 'search_reddit', 'search', 'render']), names
+
+    rows = render.waterfall(spans)
+    assert [depth for depth, span in rows] == [0, 1, 2, 3, 1], rows
+    page = render.render_timing(spans, tracing.summarize(spans))
+    assert page.count("<td class='bar'>") == len(spans)
+    assert '<script>' not in page and '&lt;script&gt;' in page
+    print(f'\ndebug trace: {len(spans)} spans collected, waterfall depths {[depth for depth, span in rows]}')
+
+def check_rotation(directory: str):
+    path = os.path.join(directory, 'rotated.jsonl')
+    sink = tracing.JSONLSink(path, max_bytes=1000)
+    record = {'trace_id': 'a' * 32, 'span_id': 'b' * 16, 'name': 'search', 'attributes': {}}
+    for _ in range(30):
+        sink.export([record])
+    assert os.path.getsize(path) <= 1000 + len(json.dumps(record)) + 1, os.path.getsize(path)
+    assert os.path.getsize(path + '.1') <= 1000 + len(json.dumps(record)) + 1
+    print(f'\nrotation: {os.path.getsize(path)} + {os.path.getsize(path + ".1")} bytes kept for 30 exports of a 1000 byte cap')
+
+def check_overhead(loop, rounds: int):
+    async def searches(count: int):
+        for i in range(count):
+            await dispatcher.search('Wikipedia', 'History of Scotland')
+
+    async def traced(count: int):
+        with tracing.start_trace('request'):
+            await searches(count)
+
+    with MockUpstreams(default_latency=0.001):
+        dispatcher = make_dispatcher(loop, cache=result_cache.ResultCache())
+        loop.run_until_complete(searches(1)) # fill the cache
+        count = rounds * 100
+        timings = {}
+        for label, run in [('untraced', searches), ('traced', traced)]:
+            start = time.perf_counter()
+            loop.run_until_complete(run(count))
+            timings[label] = (time.perf_counter() - start) / count
+    tracing.tracer.flush()
+    print(f'\ncached search: {timings["untraced"] * 1e6:.1f} us untraced, {timings["traced"] * 1e6:.1f} us traced '
+          f'({(timings["traced"] - timings["untraced"]) * 1e6:.1f} us per span)')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=20, help='hundreds of cached searches for the overhead check')
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    tracing.SAMPLE_RATE = 1.0 # every request, rather than the deployed default
+
+    collector = Collector()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'traces.jsonl')
+        tracing.tracer.sinks = [tracing.JSONLSink(path), tracing.OTLPSink(collector.endpoint)]
+        check_spans(loop, path, collector)
+        check_debug(loop)
+        check_rotation(directory)
+        check_overhead(loop, args.rounds)
+    collector.close()
+
+if __name__ == '__main__':
+    main()
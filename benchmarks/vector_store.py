@@ -0,0 +1,62 @@
+# recall and latency of LocalVectorStore exact search vs the approximate IVF index on synthetic
+# 512-d data (clustered like real embeddings, queries are perturbed copies of stored vectors)
+# usage: python -m benchmarks.vector_store --vectors 100000 --queries 200
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from vector_store import LocalVectorStore, normalize_rows
+
+def synthetic(count: int, dim: int, clusters: int, rng):
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(clusters, size=count)] + 0.6 * rng.standard_normal((count, dim)).astype(np.float32)
+    return normalize_rows(vectors)
+
+def timed_queries(store, queries, top_k: int):
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append([match['id'] for match in store.query(query, top_k, include_metadata=False)['matches']])
+        latencies.append(time.perf_counter() - start)
+    return results, sorted(latencies)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--clusters', type=int, default=500)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = synthetic(args.vectors, args.dim, args.clusters, rng)
+    queries = normalize_rows(vectors[rng.integers(args.vectors, size=args.queries)]
+                             + 0.3 * rng.standard_normal((args.queries, args.dim)).astype(np.float32))
+    metadata = [{'caption': str(i)} for i in range(args.vectors)]
+
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        LocalVectorStore.build(path, vectors, metadata, ivf=True)
+        print(f'build (with IVF, {int(np.sqrt(args.vectors))} lists): {time.perf_counter() - start:.1f} s')
+
+        exact = LocalVectorStore(path)
+        truth, latencies = timed_queries(exact, queries, args.top_k)
+        print(f'{"exact":>12}: p50 {latencies[len(latencies) // 2] * 1000:6.2f} ms  '
+              f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:6.2f} ms  recall@{args.top_k} 1.000')
+
+        start = time.perf_counter()
+        exact.query_batch(queries, args.top_k, include_metadata=False)
+        print(f'{"exact batch":>12}: {(time.perf_counter() - start) / args.queries * 1000:6.2f} ms/query')
+
+        for nprobe in [1, 4, 8, 16, 32]:
+            approximate = LocalVectorStore(path, approximate=True, nprobe=nprobe)
+            found, latencies = timed_queries(approximate, queries, args.top_k)
+            recall = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(truth, found)])
+            print(f'{"ivf nprobe " + str(nprobe):>12}: p50 {latencies[len(latencies) // 2] * 1000:6.2f} ms  '
+                  f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:6.2f} ms  recall@{args.top_k} {recall:.3f}')
+
+if __name__ == '__main__':
+    main()
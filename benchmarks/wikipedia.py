@@ -0,0 +1,185 @@
+# compare the Wikipedia HTML scraper with the action=query JSON API path
+#   bytes: raw and gzipped (what actually crosses the wire) size of each response
+#   parse: time to turn each response into results (BeautifulSoup vs json.loads)
+#   requests: upstream requests for a plan with several Wikipedia sub-queries, against the mock server
+# uses saved pages in benchmarks/fixtures/wikipedia if present (save them with --record, needs network),
+# otherwise synthetic pages shaped like a real article/search page (skin chrome, infobox, citations)
+# usage: python -m benchmarks.wikipedia --title "Mountain" --search "mountain sunset colors" --repeat 20
+import os
+import json
+import gzip
+import time
+import asyncio
+import argparse
+import statistics
+
+import engines
+from benchmarks.mock_upstreams import MockUpstreams
+
+fixture_path = os.path.join(os.path.dirname(__file__), 'fixtures', 'wikipedia')
+fixture_files = ['article.html', 'search.html', 'article.json', 'search.json']
+
+# save the live responses each path would make for one article and one search
+def record(title: str, search: str):
+    import httpx
+
+    os.makedirs(fixture_path, exist_ok=True)
+    with httpx.Client(headers=engines.wikipedia_headers, follow_redirects=True) as client:
+        pages = {
+            'article.html': client.get(engines.wikipedia_url + '/wiki/' + title.replace(' ', '_')),
+            'search.html': client.get(engines.wikipedia_url + '/w/index.php',
+                                      params={'title': 'Special:Search', 'search': search, 'fulltext': 1}),
+            'article.json': client.get(engines.wikipedia_url + '/w/api.php',
+                                       params=dict(engines.wikipedia_query_params, titles=title)),
+            'search.json': client.get(engines.wikipedia_url + '/w/api.php',
+                                      params=dict(engines.wikipedia_query_params, generator='search',
+                                                  gsrsearch=search, gsrlimit=2)),
+        }
+    for name, r in pages.items():
+        r.raise_for_status()
+        with open(os.path.join(fixture_path, name), 'wb') as fixture_file:
+            fixture_file.write(r.content)
+    print('saved', ', '.join(pages), 'to', fixture_path)
+
+def paragraph(title: str, i: int):
+    return (f'{title} section {i} covers geology, climate and human history in enough detail to look like '
+            f'a real article, with <a href="/wiki/Link_{i}" title="Link {i}">internal links</a> and '
+            f'citations.<sup id="cite_ref-{i}" class="reference"><a href="#cite_note-{i}">[{i}]</a></sup> ') * 3
+
+# article and search pages with the bulk of real ones: head tags, navigation, infobox, references
+def synthetic_pages(title: str, search: str):
+    slug = title.replace(' ', '_')
+    head = ''.join(f'<link rel="stylesheet" href="/w/load.php?modules=skin.{i}&amp;only=styles">'
+                   f'<script>RLQ.push(["module.{i}", {{"config": "{"x" * 200}"}}]);</script>' for i in range(40))
+    navigation = ''.join(f'<li class="vector-menu-item"><a href="/wiki/Portal:{i}" title="Portal {i}">'
+                         f'<span>Portal {i}</span></a></li>' for i in range(300))
+    infobox = ''.join(f'<tr><th class="infobox-label">Field {i}</th><td class="infobox-data">Value {i}</td></tr>'
+                      for i in range(30))
+    body = ''.join(f'<h2><span class="mw-headline">Section {i}</span></h2><p>{paragraph(title, i)}</p>' for i in range(60))
+    references = ''.join(f'<li id="cite_note-{i}"><span class="reference-text"><cite class="citation book">'
+                         f'Author {i} (2001). <i>Book {i}</i>. Publisher. ISBN 978-0-00-000000-{i % 10}.</cite>'
+                         f'</span></li>' for i in range(200))
+    article_html = (f'<!DOCTYPE html><html><head><title>{title} - Wikipedia</title>{head}'
+                    f'<meta property="og:image" content="https://upload.wikimedia.org/wikipedia/commons/{slug}.jpg"/>'
+                    f'</head><body><nav><ul>{navigation}</ul></nav><h1 id="firstHeading">{title}</h1>'
+                    f'<div class="mw-parser-output"><p class="mw-empty-elt"></p>'
+                    f'<table class="infobox">{infobox}</table>'
+                    f'<p><b>{title}</b> is a large natural elevation of the earth\'s surface rising abruptly '
+                    f'from the surrounding level, used here as the lead paragraph of a synthetic page.</p>'
+                    f'{body}<ol class="references">{references}</ol></div><footer>{navigation}</footer></body></html>')
+
+    hits = ''.join(f'<li class="mw-search-result"><div class="searchResultImage">'
+                   f'<div class="searchResultImage-thumbnail"><a href="/wiki/Result_{i}">'
+                   f'<img src="//upload.wikimedia.org/thumb/Result_{i}.jpg"/></a></div>'
+                   f'<div class="searchResultImage-text"><div class="mw-search-result-heading">'
+                   f'<a href="/wiki/Result_{i}" title="Result {i}">Result {i}</a></div>'
+                   f'<div class="searchresult">{search} result {i} with a <span class="searchmatch">match</span> '
+                   f'in the text of the article</div><div class="mw-search-result-data">12 KB (1,234 words)</div>'
+                   f'</div></div></li>' for i in range(20))
+    search_html = (f'<!DOCTYPE html><html><head><title>Search results - Wikipedia</title>{head}</head><body>'
+                   f'<nav><ul>{navigation}</ul></nav><ul class="mw-search-results">{hits}</ul>'
+                   f'<footer>{navigation}</footer></body></html>')
+
+    lead = (f"{title} is a large natural elevation of the earth's surface rising abruptly "
+            f'from the surrounding level, used here as the lead paragraph of a synthetic page.')
+    article_json = {'batchcomplete': True, 'query': {'pages': [{
+        'pageid': 1, 'ns': 0, 'title': title, 'fullurl': 'https://en.wikipedia.org/wiki/' + slug,
+        'extract': lead + '\n' + lead,
+        'thumbnail': {'source': f'https://upload.wikimedia.org/thumb/{slug}.jpg', 'width': 640, 'height': 427},
+    }]}}
+    search_json = {'batchcomplete': True, 'query': {'pages': [{
+        'pageid': i + 2, 'ns': 0, 'index': i + 1, 'title': f'Result {i}',
+        'fullurl': f'https://en.wikipedia.org/wiki/Result_{i}', 'extract': lead,
+        'thumbnail': {'source': f'https://upload.wikimedia.org/thumb/Result_{i}.jpg', 'width': 640, 'height': 427},
+    } for i in range(2)]}}
+
+    return {
+        'article.html': article_html.encode('utf-8'),
+        'search.html': search_html.encode('utf-8'),
+        'article.json': json.dumps(article_json).encode('utf-8'),
+        'search.json': json.dumps(search_json).encode('utf-8'),
+    }
+
+def load_pages(title: str, search: str):
+    if all(os.path.exists(os.path.join(fixture_path, name)) for name in fixture_files):
+        pages = {}
+        for name in fixture_files:
+            with open(os.path.join(fixture_path, name), 'rb') as fixture_file:
+                pages[name] = fixture_file.read()
+        return pages, 'saved fixtures in ' + fixture_path
+    return synthetic_pages(title, search), 'synthetic pages (run with --record to save real ones)'
+
+def timed(parse, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = parse()
+        timings.append(time.perf_counter() - start)
+    return results, statistics.median(timings)
+
+def parse_api(content, query: str, search: bool):
+    body = json.loads(content)
+    if search:
+        pages = sorted(body['query']['pages'], key=lambda page: page.get('index', 0))
+        return [engines.wikipedia_page_result(query, page) for page in pages[0:2]]
+    page = engines.parse_wikipedia_pages(body, [query])[query]
+    return [engines.wikipedia_page_result(query, page)]
+
+def compare(pages: dict, title: str, search: str, repeat: int):
+    cases = [
+        ('article', title, False, lambda: engines.parse_wikipedia_article(title, 'https://en.wikipedia.org/wiki/' + title, pages['article.html'])),
+        ('search', search, True, lambda: engines.parse_wikipedia_search(search, pages['search.html'])),
+    ]
+    print(f'{"page":>8} {"path":>5} {"bytes":>9} {"gzipped":>9} {"parse ms":>9}')
+    for name, query, search_page, parse_html in cases:
+        html = pages[name + '.html']
+        api = pages[name + '.json']
+        html_results, html_time = timed(parse_html, repeat)
+        api_results, api_time = timed(lambda: parse_api(api, query, search_page), repeat)
+        print(f'{name:>8} {"html":>5} {len(html):9d} {len(gzip.compress(html)):9d} {html_time * 1000:9.2f}')
+        print(f'{name:>8} {"api":>5} {len(api):9d} {len(gzip.compress(api)):9d} {api_time * 1000:9.2f}')
+
+        # both paths have to produce the same kind of cards
+        assert len(api_results) == len(html_results), (api_results, html_results)
+        for api_result, html_result in zip(api_results, html_results):
+            assert api_result.snippet and api_result.url and api_result.title, api_result
+            assert bool(api_result.thumbnail) == bool(html_result.thumbnail), (api_result, html_result)
+
+# upstream requests for one plan's Wikipedia sub-queries: the scraper makes a search request plus
+# a redirect to the article for each, the API path batches every title into one request
+def count_requests(titles: list):
+    async def run(search):
+        import httpx
+        async with httpx.AsyncClient() as client:
+            return await asyncio.gather(*[search(client, title) for title in titles])
+
+    with MockUpstreams(default_latency=0.02) as upstreams:
+        counts = {}
+        for name, search in [('html', engines.search_wikipedia_html), ('api', engines.search_wikipedia)]:
+            upstreams.reset()
+            start = time.perf_counter()
+            results = asyncio.run(run(search))
+            elapsed = time.perf_counter() - start
+            assert all(len(result) == 1 for result in results), results
+            counts[name] = upstreams.counts.get('Wikipedia', 0)
+            print(f'{name:>5}: {len(titles)} titles -> {counts[name]} requests in {elapsed * 1000:.1f} ms')
+        assert counts['api'] == 1, counts
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--title', default='Mountain')
+    parser.add_argument('--search', default='mountain sunset colors')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--record', action='store_true', help='save live pages as fixtures first')
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.title, args.search)
+    pages, source = load_pages(args.title, args.search)
+    print('using', source)
+    compare(pages, args.title, args.search, args.repeat)
+    print()
+    count_requests(['History of Scotland', 'Scottish Wars of Independence', 'Jacobite rising of 1745', 'Highland Clearances'])
+
+if __name__ == '__main__':
+    main()
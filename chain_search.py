@@ -1,471 +1,548 @@
+import startup # first, so the import timer sees everything below
+import modal
 from modal import Image, App, fastapi_endpoint, Secret, Function
-from fastapi.responses import HTMLResponse
+
+import coalesce
+import dispatch
+import merge
+import pagination
+import planner
+import render
+import result_cache
+import thumbnails
+import tracing
+from search_result import SearchBatch, failed, timed_out
 
 # define Image for metasearch hitting web APIs
 image = Image.debian_slim(python_version='3.10') \
-            .pip_install('openai', 'httpx', 'beautifulsoup4', 'fastapi[standard]')
+            .pip_install('openai', 'httpx[http2]', 'beautifulsoup4', 'fastapi[standard]', 'pillow') \
+            .add_local_python_source('coalesce', 'engines', 'dispatch', 'merge', 'pagination', 'planner', 'rate_limit', 'render', 'result_cache', 'search_result', 'startup', 'thumbnails', 'tracing')
 app = App('chain-search', image=image)
 
+# inputs a container of the functions below takes at once: they spend their inputs waiting on upstreams,
+# OpenAI or other functions, so one container can serve many (sync ones run them in threads)
+# a container's inputs share its per-container state (dispatcher and sub-query flights, planner, request_flights),
+# so identical concurrent searches only coalesce when they land in the same container
+CONCURRENT_INPUTS = 32
+
+# the input limit of each function declared concurrent (benchmarks/local_modal.py runs the rest one input
+# per container, like Modal does)
+concurrent_inputs = {}
+
+# @modal.concurrent, recording the limit in concurrent_inputs
+def concurrent(max_inputs: int = CONCURRENT_INPUTS):
+    def decorate(function):
+        concurrent_inputs[function.__name__] = max_inputs
+        return modal.concurrent(max_inputs=max_inputs)(function)
+    return decorate
+
+# every function below takes an optional trace (tracing.context() of the caller's span), so its spans
+# join the request's trace (see tracing.py)
+
 # use OpenAI to convert query into smaller queries
+# plans are cached by topic (see planner.py); one_call merges the two chained completions into one
 @app.function(secrets=[Secret.from_name('openai_secret')])
-def openai_chain_search(query: str):
-    import openai 
-    import os 
-    import re
-    model = 'gpt-3.5-turbo' # using GPT 3.5 turbo model
-
-    # Pull Open AI secrets
-    client = openai.OpenAI(api_key=os.environ['OPENAI_API_KEY'])
-
-    # message templates with (some) prompt engineering
-    system_message = """Act as my assistant who's job is to help me understand and derive inspiration around a topic I give you.  Your primary job is to help find the best images, content, and online resources for me. Assume I have entered a subject into a command line on a website and do not have the ability to provide you with follow-up context.
-
-Your first step is to determine what sort of content and resources would be most valuable. For topics such as "wedding dresses" and "beautiful homes" and "brutalist architecture", I am likely to want more visual image content as these topics are design oriented and people tend to want images to understand or derive inspiration. For topics, such as "home repair" and "history of Scotland" and "how to start a business", I am likely to want more text and link content as these topics are task-oriented and people tend to want authoritative information or answers to questions."""
-    initial_prompt_template = 'I am interested in the topic:\n{topic}\n\nAm I more interested in visual content or text and link based content? Select the best answer between the available options, even if it is ambiguous. Start by stating the answer to the question plainly. Do not provide the links or resources. That will be addressed in a subsequent question.'
-    text_template = 'You have access to three search engines.\n\nThe first will directly query Wikipedia. The second will surface interesting posts on Reddit based on keyword matching with the post title and text. The third will surface podcast episodes based on keyword matching.\n\nQueries to Wikipedia should be fairly direct so as to maximize the likelihood that something relevant will be returned. Queries to the Reddit and podcast search engines should be specific and go beyond what is obvious and overly broad to surface the most interesting posts and podcasts.\n\nWhat are 2 queries that will yield the most interesting Wikipedia posts, 3 queries that will yield the most valuable Reddit posts, and 3 queries surface that will yield the most insightful and valuable podcast episodes about:\n{topic}\n\nProvide the queries in a numbered list with quotations around the entire query and brackets around which search engine they\'re intended for (for example: 1. [Reddit] "Taylor Swift relationships". 2. [Podcast] "Impact of Taylor Swift on Music". 3. [Wikipedia] "Taylor Swift albums").'
-    image_template = 'You have access to a the free stock photo site Unsplash. There will be a good breadth of photos but the key will be trying to find the highest quality images.\n\nWhat are 3 great queries to use that will provide good visual inspiration and be different enough from one another so as to provide a broad range of relevant images from Unsplash to get the highest quality images on the topic of:\n{topic}\n\nProvide the queries in a numbered list with quotations around the entire query and "[Unsplash]" before the quotation to make it clear thats the intended search engine (for example: 1. [Unsplash] "Wildlife on a mountain top at sunset". 2. [Unsplash] "High quality capture of mountain top at sunset".)'
-
-    # create context to send to OpenAI
-    messages = []
-    # add system message
-    if 'gpt-4' not in model: # only gpt-4 and beyond have 'system' message
-        messages.append({
-            'role': 'user',
-            'content': system_message
-        })
-    else:
-        messages.append({
-            'role': 'system',
-            'content': system_message
-        })
-
-    # add initial prompt
-    messages.append({
-        'role': 'user',
-        'content': initial_prompt_template.format(topic=query)
-    })
-
-    # get initial response
-    response = client.chat.completions.create(
-        model=model,
-        messages = messages,
-        temperature = 1.0
-    )
-    messages.append({
-        'role': 'assistant',
-        'content': response.choices[0].message.content
-    })
-
-    # chain decision: decide based on response what to do
-    responses = [] # aggregate list of actions to take
-    if 'text and link' in response.choices[0].message.content.lower():
-        # get good wikipedia, reddit, and podcast queries
-        messages.append({
-            'role': 'user',
-            'content': text_template.format(topic=query)
-        })
-    else:
-        # Wikipedia one-shot the query to add some additional text-based context
-        responses.append('Wikipedia: ' + query)
-        
-        # get good image search queries
-        messages.append({
-            'role': 'user',
-            'content': image_template.format(topic=query)
-        })
-
-    # make followup call to OpenAI
-    response = client.chat.completions.create(
-        model=model,
-        messages = messages,
-        temperature = 1.0
-    )
-    
-    # use regex to parse GPT's recommended queries
-    for engine, query in re.findall(r'[0-9]+. \[(\w+)\] "(.*)"', 
-                                response.choices[0].message.content):
-        responses.append(engine + ': ' + query)
-    
-    return responses
+@concurrent()
+@startup.profiled
+async def openai_chain_search(query: str, one_call: bool = False, trace: dict = None):
+    with tracing.span('openai_chain_search', parent=trace):
+        return await planner.get_planner().plan(query, one_call=one_call)
+
+# same as openai_chain_search, but yields each response as soon as the model writes it
+@app.function(secrets=[Secret.from_name('openai_secret')])
+@concurrent()
+@startup.profiled
+async def openai_chain_search_stream(query: str, one_call: bool = False, trace: dict = None):
+    with tracing.span('openai_chain_search_stream', parent=trace, topic=query):
+        async for response in planner.get_planner().plan_stream(query, one_call=one_call):
+            yield response
 
 # handle Wikipedia
 @app.function()
-def search_wikipedia(query: str):
-    import httpx
-    import urllib.parse
-    from bs4 import BeautifulSoup
-
-    # base_search_url works pretty well if search string is spot-on, if not shows search results
-    base_search_url = 'https://en.wikipedia.org/w/index.php?title=Special:Search&search={query}'
-    base_url = 'https://en.wikipedia.org'
-
-    results = []
-    r = httpx.get(base_search_url.format(query = urllib.parse.quote(query)), follow_redirects=True)
-    soup = BeautifulSoup(r.content, 'html.parser')
-
-    if 'title=Special:Search' in str(r.url): # no match, so its a search, get top two results
-        search_results = soup.find_all('li', class_='mw-search-result')
-        for search_result in search_results[0:2]:
-            result = {'query':query}
-            result['source'] = 'Wikipedia'
-            thumbnail_anchors = search_result.css.select("div.searchResultImage-thumbnail > a")
-            if len(thumbnail_anchors): # thumbnail exists
-                result['thumbnail'] = 'https:' + thumbnail_anchors[0].find('img')['src']
-            else:
-                result['thumbnail'] = 'None'
-            result_header_tag = search_result.css.select("div.mw-search-result-heading > a")[0]
-            result['url'] = base_url + result_header_tag['href']
-            result['title'] = result_header_tag.get_text()
-            result['snippet'] = search_result.css.select("div.searchResultImage-text > div.searchresult")[0].get_text()
-            results.append(result)
-    else:
-        result = {'query':query}
-        result['source'] = 'Wikipedia'
-        result['url'] = r.url 
-        result['title'] = soup.find('h1').get_text()
-
-        # get the right paragraph to determine if this is a disambiguation article
-        real_paragraphs = soup.find_all(lambda tag: tag.name == 'p' and 'class' not in tag.attrs and len(tag.get_text().split()) > 10)
-        if real_paragraphs:
-            paragraph_text = real_paragraphs[0].get_text().strip()
-        else:
-            paragraph_text = ''
-
-        if not len(paragraph_text) or paragraph_text[-18:] == 'may also refer to:' or paragraph_text[-13:] == 'may refer to:': # is disambiguation article or blank
-            result['thumbnail'] = 'None'
-            result['snippet'] = 'This page links to several Wikipedia articles that might be relevant.'
-        else: # normal article
-            result['snippet'] = paragraph_text
-            img_link = soup.find(lambda tag: tag.name == 'meta' and tag.has_attr('property') and tag.has_attr('content') and tag['property'] == 'og:image')
-            if img_link: # an image exists
-                result['thumbnail'] = img_link['content']
-            else:
-                result['thumbnail'] = 'None'
-
-        results.append(result)
-    
-    return results
+@concurrent()
+@startup.profiled
+async def search_wikipedia(query: str, trace: dict = None):
+    with tracing.span('search_wikipedia', parent=trace):
+        return await dispatch.get_dispatcher().search('Wikipedia', query)
 
 # handle Reddit
 @app.function(secrets=[Secret.from_name('reddit_secret')])
-def search_reddit(query: str):
-    import httpx
-    import base64 
-    import os 
-
-    reddit_id = os.environ['REDDIT_USER']
-    user_agent = os.environ['REDDIT_AGENT']
-    reddit_secret = os.environ['REDDIT_KEY']
-
-    # set up for auth token request
-    auth_string = reddit_id + ':' + reddit_secret
-    encoded_auth_string = base64.b64encode(auth_string.encode('ascii')).decode('ascii')
-    auth_headers = {
-        'Authorization': 'Basic ' + encoded_auth_string,
-        'User-agent': user_agent
-    }
-    auth_data = {
-        'grant_type': 'client_credentials'
-    }
-
-    # get auth token
-    r = httpx.post('https://www.reddit.com/api/v1/access_token', headers = auth_headers, data = auth_data)
-    if r.status_code == 200:
-        if 'access_token' in r.json():
-            reddit_access_token = r.json()['access_token']
-    else:
-        return [{'error':'auth token failure'}]
-
-    results = []
-
-    # set up headers for search requests
-    headers = {
-        'Authorization': 'Bearer ' + reddit_access_token,
-        'User-agent': user_agent
-    }
-    
-    # execute subreddit search
-    params = {
-        'sort': 'relevance',
-        't': 'year',
-        'limit': 4,
-        'q': query[:512]
-    }
-    r = httpx.get('https://oauth.reddit.com/search', params=params, headers=headers)
-    if r.status_code == 200:
-        body = r.json()
-        if 'data' in body and 'children' in body['data'] and len(body['data']['children']) > 0:
-            post_results = body['data']['children']
-            for post in post_results:
-                # get subreddit level details
-                result = {'query':query}
-                subreddit_handle = post['data']['subreddit_name_prefixed'] + '/'
-                subreddit_url = 'https://www.reddit.com'+subreddit_handle
-                result['source'] = 'Reddit'
-                result['subsource'] = subreddit_handle 
-                result['subsource_url'] = subreddit_url 
-                result['url'] = 'https://www.reddit.com'+post['data']['permalink']
-                result['title'] = post['data']['title']
-
-                # get image from Reddit blob, start with preview
-                if 'preview' in post['data'] and 'images' in post['data']['preview'] and len(post['data']['preview']['images']):
-                    result['thumbnail'] = post['data']['preview']['images'][0]['source']['url']
-                # use media_metadata if post is media gallery and pull first image in blob
-                elif 'media_metadata' in post['data']:
-                    first_key = list(post['data']['media_metadata'].keys())[0]
-                    result['thumbnail'] = post['data']['media_metadata'][first_key]['p'][-1]
-                # fall back to thumbnail if needed but only if thumbnail is valid
-                elif 'thumbnail' in post['data'] and post['data']['thumbnail'] != 'self':
-                    result['thumbnail'] = post['data']['thumbnail']
-                else:
-                    result['thumbnail'] = ''
-                result['snippet'] = post['data']['selftext'][0:1000] + ('...(more)' if len(post['data']['selftext']) else '')
-                results.append(result)
-    
-    return results
+@concurrent()
+@startup.profiled
+async def search_reddit(query: str, trace: dict = None):
+    with tracing.span('search_reddit', parent=trace):
+        return await dispatch.get_dispatcher().search('Reddit', query)
 
 # handle Podcast Search via Taddy
 @app.function(secrets=[Secret.from_name('taddy_secret')])
-def search_podcasts(query: str):
-    import os 
-    import httpx 
-
-    # prepare headers for querying taddy
-    taddy_user_id = os.environ['TADDY_USER']
-    taddy_secret = os.environ['TADDY_KEY']
-    url = 'https://api.taddy.org'
-    headers = {
-        'Content-Type': 'application/json',
-        'X-USER-ID': taddy_user_id,
-        'X-API-KEY': taddy_secret
-    }
-    # query body for podcast search
-    queryString = """{
-  searchForTerm(
-    term: """
-    queryString += '"' + query + '"\n'
-    queryString += """
-    filterForTypes: PODCASTEPISODE
-    searchResultsBoostType: BOOST_POPULARITY_A_LOT
-    limitPerPage: 3
-  ) {
-    searchId
-    podcastEpisodes {
-      uuid
-      name
-      subtitle
-      websiteUrl
-      audioUrl
-      imageUrl
-      description
-      podcastSeries {
-        uuid
-        name
-        imageUrl
-        websiteUrl
-      }
-    }
-  }
-}
-"""
-    # make the graphQL request and parse the JSON body
-    r = httpx.post(url, headers=headers, json={'query': queryString})
-    if r.status_code != 200:
-        return []
-    else:
-        responseBody = r.json()
-        if 'errors' in responseBody:
-            return [{'error': 'authentication issue with Taddy'}]
-        else:
-            episodes = responseBody['data']['searchForTerm']['podcastEpisodes']
-            results = []
-            for episode in episodes:
-                result = {'query':query}
-                result['source'] = 'Podcast'
-                result['subsource'] = episode['podcastSeries']['name']
-                result['subsource_url'] = episode['podcastSeries']['websiteUrl']
-                if episode['websiteUrl'] and episode['websiteUrl'] != episode['podcastSeries']['websiteUrl']:
-                    result['url'] = episode['websiteUrl']
-                else: 
-                    result['url'] = episode['audioUrl']
-                
-                result['title'] = episode['name']
-                if episode['subtitle']:
-                    result['snippet'] = episode['subtitle'][0:1000] + ('...(more)' if len(episode['subtitle']) else '')
-                elif episode['description']:
-                    result['snippet'] = episode['description'][0:1000] + ('...(more)' if len(episode['description']) else '')
-                else:
-                    result['snippet'] = ''
-                
-                if episode['imageUrl']:
-                    result['thumbnail'] = episode['imageUrl']
-                elif episode['podcastSeries']['imageUrl']:
-                    result['thumbnail'] = episode['podcastSeries']['imageUrl']
-                else:
-                    result['thumbnail'] = ''
-                results.append(result)
-    
-    return results
+@concurrent()
+@startup.profiled
+async def search_podcasts(query: str, trace: dict = None):
+    with tracing.span('search_podcasts', parent=trace):
+        return await dispatch.get_dispatcher().search('Podcast', query)
 
 # handle Unsplash Search
 @app.function(secrets=[Secret.from_name('unsplash_secret')])
-def search_unsplash(query: str, num_matches: int = 10):
-    import os 
-    import httpx 
-
-    # set up and make request
-    unsplash_client = os.environ['UNSPLASH_ACCESS']
-    unsplash_url = 'https://api.unsplash.com/search/photos'
-
-    headers = {
-        'Authorization': 'Client-ID ' + unsplash_client,
-        'Accept-Version': 'v1'
-    }
-    params = {
-        'page': 1,
-        'per_page': num_matches,
-        'query': query
-    }
-    r = httpx.get(unsplash_url, params=params, headers=headers)
-
-    # check if request is good 
-    if r.status_code == 200:
-        results = []
-        body = r.json()
-        # convert to result format
-        for image_result in body['results']:
-            result = {
-                'query': query,
-                'source': 'Unsplash',
-                'subsource': image_result['user']['username'],
-                'subsource_url': image_result['user']['links']['html'],
-                'snippet': image_result['description'],
-                'url': image_result['links']['html'],
-                'thumbnail': image_result['urls']['regular']
-            }
-            results.append(result)
-            
-        return results
-    else:
-        return [{'error':'auth failure'}]
+@concurrent()
+@startup.profiled
+async def search_unsplash(query: str, num_matches: int = 10, trace: dict = None):
+    with tracing.span('search_unsplash', parent=trace):
+        # only pass num_matches through when it differs so the default shares cache entries with fan_out
+        if num_matches != 10:
+            return await dispatch.get_dispatcher().search('Unsplash', query, num_matches=num_matches)
+        return await dispatch.get_dispatcher().search('Unsplash', query)
+
+# handle Image Vector Search (CLIP text embedding + vector store in the text-pinecone-query app)
+@app.function()
+@concurrent()
+@startup.profiled
+async def search_vector(query: str, trace: dict = None):
+    with tracing.span('search_vector', parent=trace):
+        return await dispatch.get_dispatcher().search('Vector', query)
+
+# engine function for each planner response prefix
+engine_functions = {
+    'Wikipedia': search_wikipedia,
+    'Reddit': search_reddit,
+    'Podcast': search_podcasts,
+    'Unsplash': search_unsplash,
+    'Vector': search_vector,
+}
 
-# function to map against response list
+# function to map against response list, returns a SearchBatch so errors travel next to results
+@app.function()
+@concurrent()
+@startup.profiled
+def parse_response(response: str, trace: dict = None):
+    engine, query = dispatch.split_response(response)
+    with tracing.span('parse_response', parent=trace, engine=engine, query=query) as span:
+        try:
+            if engine:
+                return SearchBatch(engine_functions[engine].remote(query, trace=tracing.context(span)), [])
+        except Exception as e:
+            print('Search failed:', response, repr(e))
+            return failed(response, e)
+        return SearchBatch([], [])
+
+# secrets for every search engine, for functions that run all of them in one container
+engine_secrets = [Secret.from_name('reddit_secret'), 
+                  Secret.from_name('taddy_secret'), 
+                  Secret.from_name('unsplash_secret')]
+
+# run every search in one container with a shared connection pool, yielding each search's
+# SearchBatch in completion order
+# started is when the request began (time.time()), which the request deadline counts from
+@app.function(secrets=engine_secrets)
+@concurrent()
+@startup.profiled
+async def fan_out(responses: list, trace: dict = None, started: float = None):
+    with tracing.span('fan_out', parent=trace):
+        async for response, batch in dispatch.get_dispatcher().run(responses, started=started):
+            yield batch
+
+# plan and search inside the fan_out container: each sub-query starts as soon as the planner
+# streams it, and with speculative, raw-topic searches run while the planner does
+@app.function(secrets=engine_secrets)
+@concurrent()
+@startup.profiled
+async def fan_out_planned(query: str, one_call: bool = False, speculative: bool = False, trace: dict = None,
+                          started: float = None):
+    with tracing.span('fan_out_planned', parent=trace, speculative=speculative) as span:
+        plan = openai_chain_search_stream.remote_gen.aio(query, one_call=one_call, trace=tracing.context(span))
+        if speculative:
+            searches = dispatch.get_dispatcher().run_speculative(query, plan, started)
+        else:
+            searches = dispatch.get_dispatcher().run_streaming(plan, started)
+        async for response, batch in searches:
+            yield batch
+
+# the next page of every sub-query in a "load more" cursor (see pagination.py), all in one container
+# returns the SearchBatches in cursor order, and the pages to ask for after them
+@app.function(secrets=engine_secrets)
+@concurrent()
+@startup.profiled
+async def search_pages(pages: list, trace: dict = None):
+    with tracing.span('search_pages', parent=trace, pages=len(pages)):
+        options = {response: page_options for response, page_options in pages}
+        batches = {}
+        async for response, batch in dispatch.get_dispatcher().run(list(options), options):
+            batches[response] = batch
+        return [batches[response] for response, page_options in pages if response in batches], \
+               pagination.advance(pages, batches)
+
+# hit/miss counters summed across every container's result cache
 @app.function()
-def parse_response(response: str):
-    if response[0:11] == 'Wikipedia: ':
-        return search_wikipedia.remote(response[11:])
-    elif response[0:8] == 'Reddit: ':
-        return search_reddit.remote(response[8:])
-    elif response[0:9] == 'Podcast: ':
-        return search_podcasts.remote(response[9:])
-    elif response[0:10] == 'Unsplash: ':
-        return search_unsplash.remote(response[10:])  
-
-# web endpoint
+async def cache_stats():
+    return await result_cache.collect_stats(result_cache.default_stats_store())
+
+# run the searches for a list of planner responses using either fan-out path
+# 'modal' spawns each response in its own container, 'async' runs them all in one fan_out container
+# (which applies the request deadline itself); parent is the request's root span, if it's traced, and
+# started is when the request began (the deadline counts from there, see dispatch.REQUEST_DEADLINE)
+def run_searches(responses: list, fanout: str = 'modal', order_outputs: bool = True, parent=None,
+                 started: float = None):
+    trace = tracing.context(parent)
+    if fanout == 'async': # always completion order
+        return fan_out.remote_gen(responses, trace=trace, started=started)
+    searches = completed_results(((response, parse_response.spawn(response, trace=trace)) for response in responses),
+                                 parent=parent, started=started)
+    if order_outputs: # everything that arrived before the deadline, in plan order
+        order = {response: i for i, response in reversed(list(enumerate(responses)))}
+        return [batch for response, batch in sorted(searches, key=lambda search: order.get(search[0], len(order)))]
+    return (batch for response, batch in searches)
+
+# wait on (response, Modal function call) pairs (which may still be being spawned by a generator)
+# and yield (response, SearchBatch) in completion order (engine functions return bare result lists)
+# once the request deadline passes (counted from started, the request's time.time() start), calls still
+# running are cancelled and reported as timed out
+# each wait is traced as a call span under parent (a Span), the container hop included
+def completed_results(calls, deadline: float = dispatch.REQUEST_DEADLINE, parent=None, started: float = None):
+    import time
+    import queue
+    import threading
+
+    done = queue.Queue()
+    stopped = threading.Event()
+    running = {} # call -> response, for cancelling at the deadline
+    lock = threading.Lock() # so a call is either registered before stopping or cancelled after it
+    def wait_for(response, call):
+        engine, query = dispatch.split_response(response)
+        with tracing.span('call', parent=parent, engine=engine, query=query):
+            try:
+                result = call.get()
+                batch = result if isinstance(result, SearchBatch) else SearchBatch(result, [])
+            except Exception as e: # one failing upstream shouldn't take down the whole page
+                print('Search failed:', response, repr(e))
+                batch = failed(response, e)
+        done.put(('result', (call, response, batch)))
+    def start_all():
+        try:
+            for response, call in calls:
+                with lock:
+                    late = stopped.is_set()
+                    if not late:
+                        running[call] = response
+                if late: # spawned after the deadline, nobody is waiting for it
+                    call.cancel()
+                    continue
+                done.put(('started', None))
+                threading.Thread(target=wait_for, args=(response, call), daemon=True).start()
+        finally:
+            done.put(('all started', None))
+    threading.Thread(target=start_all, daemon=True).start()
+
+    stop_at = time.monotonic() + dispatch.time_left(deadline, started) if deadline else None
+    outstanding = 0
+    all_started = False
+    try:
+        while outstanding or not all_started:
+            try:
+                kind, item = done.get(timeout=max(0.0, stop_at - time.monotonic()) if stop_at else None)
+            except queue.Empty: # out of time, render whatever has arrived
+                with lock:
+                    stopped.set()
+                    unfinished = list(running.items())
+                    running.clear()
+                for call, response in unfinished:
+                    call.cancel()
+                    yield response, timed_out(response, dispatch.split_response(response)[0])
+                break
+            if kind == 'started':
+                outstanding += 1
+            elif kind == 'all started':
+                all_started = True
+            else:
+                outstanding -= 1
+                call, response, batch = item
+                with lock:
+                    running.pop(call, None)
+                yield response, batch
+    finally:
+        # caller stopped early, so don't leave searches running
+        with lock:
+            stopped.set()
+            unfinished = list(running)
+            running.clear()
+        for call in unfinished:
+            call.cancel()
+
+# engine functions used for raw-topic speculative searches on the modal path
+speculative_functions = {engine: engine_functions[engine] for engine in dispatch.SPECULATIVE_ENGINES}
+
+# modal path with speculation: raw-topic searches start alongside the planner so latency is
+# roughly max(planner, search) rather than planner + search, yields results in completion order
+def search_speculative(query: str, one_call: bool = False, parent=None, started: float = None):
+    trace = tracing.context(parent)
+    with tracing.span('call', parent=parent, function='openai_chain_search') as span:
+        plan_call = openai_chain_search.spawn(query, one_call=one_call, trace=tracing.context(span))
+        speculative_calls = {engine: function.spawn(query, trace=trace) for engine, function in speculative_functions.items()}
+        try:
+            responses = plan_call.get()
+        except Exception:
+            for call in speculative_calls.values():
+                call.cancel()
+            raise
+
+    # cancel what the plan makes irrelevant, don't re-run planned searches already covered
+    keep, cancel, remaining = dispatch.reconcile_speculation(query, responses, speculative_calls)
+    for engine in cancel:
+        speculative_calls[engine].cancel()
+
+    calls = [(engine + ': ' + query, speculative_calls[engine]) for engine in keep]
+    calls += [(response, parse_response.spawn(response, trace=trace)) for response in remaining]
+    for response, batch in completed_results(calls, parent=parent, started=started):
+        yield batch
+
+# modal path with a streamed plan: spawn each search as soon as the planner writes its line
+def search_streamed(query: str, one_call: bool = False, parent=None, started: float = None):
+    trace = tracing.context(parent)
+    plan = openai_chain_search_stream.remote_gen(query, one_call=one_call, trace=trace)
+    calls = ((response, parse_response.spawn(response, trace=trace)) for response in plan)
+    for response, batch in completed_results(calls, parent=parent, started=started):
+        yield batch
+
+# concurrent identical requests in a container share one plan and one run of the searches (see coalesce.py)
+request_flights = coalesce.RequestFlights()
+
+# plan and run every search, yielding each search's SearchBatch
+# (in completion order, except for the plain modal path with order_outputs)
+# parent is the request's root span, if it's traced; a request that joins an identical one already
+# running gets its batches and is tagged coalesced
+# the request deadline counts from started (time.time() when the request began, now if None), planning included
+def search_results(query: str, fanout: str = 'modal', one_call: bool = False, speculative: bool = False, 
+                   stream_plan: bool = False, order_outputs: bool = True, parent=None, started: float = None):
+    import time
+
+    started = started if started is not None else time.time()
+    start = lambda: plan_and_search(query, fanout, one_call, speculative, stream_plan, order_outputs, parent, started)
+    if not coalesce.ENABLED:
+        return start()
+    key = '|'.join([result_cache.normalize_query(query), fanout] + 
+                   [str(option) for option in (one_call, speculative, stream_plan, order_outputs)])
+    batches, joined = request_flights.run(key, start)
+    if joined and parent is not None:
+        parent.set(coalesced=True)
+    return batches
+
+def plan_and_search(query: str, fanout: str = 'modal', one_call: bool = False, speculative: bool = False, 
+                    stream_plan: bool = False, order_outputs: bool = True, parent=None, started: float = None):
+    if fanout == 'async' and (speculative or stream_plan):
+        return fan_out_planned.remote_gen(query, one_call=one_call, speculative=speculative, trace=tracing.context(parent),
+                                          started=started)
+    elif speculative: # on the modal path speculation waits for the full plan
+        return search_speculative(query, one_call, parent, started)
+    elif stream_plan:
+        return search_streamed(query, one_call, parent, started)
+    else:
+        with tracing.span('call', parent=parent, function='openai_chain_search') as span:
+            responses = openai_chain_search.remote(query, one_call=one_call, trace=tracing.context(span))
+        return run_searches(responses, fanout, order_outputs, parent, started)
+
+# waterfall of a debug trace's spans plus p50/p95/p99 per stage, for ?debug=timing
+def timing_html(root):
+    if root is None or not root.debug:
+        return ''
+    return render.render_timing(tracing.collect(root), tracing.latency_summary())
+
+# a web endpoint's URL, None if it isn't known (e.g. running outside a deployment)
+def web_url(function):
+    try:
+        return function.get_web_url()
+    except Exception as e:
+        print('No web URL:', repr(e))
+        return None
+
+# "More results" link for the pages after these batches, '' if there are none (or nowhere to link)
+def more_link(topic: str, pages: list):
+    url = web_url(more_results) if pages else None
+    return render.render_more(url + '?cursor=' + pagination.encode_cursor(topic, pages)) if url else ''
+
+# image sources through the thumbnail endpoint (see thumbnails.py) for render.py, or None to load
+# images directly if it's unavailable
+def thumbnail_src(results: list):
+    if not thumbnails.ENABLED or not any(result.thumbnail for result in results):
+        return None
+    try:
+        return thumbnails.proxy_src(web_url(thumbnail))
+    except Exception as e: # e.g. no signing key
+        print('Thumbnail proxy unavailable:', repr(e))
+        return None
+
+# generator for streaming results page: header first, then each engine's cards as they finish
+# (the trace's root span is passed around explicitly, since each chunk may be produced in a different thread)
+def stream_results_page(query: str, fanout: str = 'modal', one_call: bool = False, speculative: bool = False, 
+                        stream_plan: bool = False, debug: bool = False):
+    merger = merge.ResultMerger()
+    timeouts = []
+    batches = [] # for the load more cursor
+
+    with tracing.start_trace('web_search', debug=debug, query=query, stream=True, fanout=fanout) as root:
+        # send header and search form right away, before any search has run
+        yield "<html>" + render.render_header(query, stream=True) + "<div class='row'>"
+
+        # run chain search and flush each search's results in completion order,
+        # deduped against everything already sent in earlier chunks
+        searches = search_results(query, fanout, one_call, speculative, stream_plan, order_outputs=False, parent=root)
+        for batch in searches:
+            batches.append(batch)
+            if batch.errors:
+                print('Search errors:', batch.errors)
+            timeouts += [engine for engine in batch.timeouts if engine not in timeouts]
+            with tracing.span('render', parent=root):
+                added = merger.add(batch.results)
+                html_string = render.render_results(added, thumbnail_src(added))
+            if html_string:
+                yield html_string
+
+        yield render.render_page_end(timeouts, more_link(query, pagination.first_pages(batches)) + timing_html(root))
+
+# web endpoint (?debug=timing adds a waterfall of the request's spans to the page)
 @app.function()
 @fastapi_endpoint(label='metasearch')
-def web_search(query: str = None):
-    import random 
-
-    html_string = "<html>"
-    css_string = "<style type='text/css'>\n .row {display: flex; flex-flow: row wrap}\n .rowchild {border: 1px solid #555555; border-radius: 10px; padding: 10px; max-width: 45%; min-width: 300px; margin: 10px;}\n .linkhead {font-size: larger}\n .actualquery {font-size: smaller}\n .snippet {margin: 10px auto; padding: 0px 15px; font-style: italic}\n .imagecontainer {max-width: 90%; max-height: 400px}\n .imagecontainer img {max-width: 100%; max-height: 400px; margin: auto;}\n .imagecontainer img.podcast {max-width: 200px; max-height: 200px;} </style>"
-    results = []
-    seen_urls = []
-    seen_thumbnails = []
-
-    if query:
-        html_string += "<head><title>AI Metasearch Concept: " + query + "</title>" + css_string + '</head>'
-        html_string += "<body><form action='/' method='get'><input type='text' name='query' placeholder='Search' value='" + query + "' style='width: 80%; padding: 10px;'><button type='submit' id='submit' style='width: 20%; padding: 10px;'>Search</button></form>"
-        html_string += "<h1>Search: " + query + "</h1>"
-
-        # run chain search and then process each search independently
-        responses = openai_chain_search.remote(query)
-        results = parse_response.map(responses)
-        flattened_results = []
-        for result_array in results:
-            if result_array:
-                flattened_results += result_array
-
-        # shuffle results to add some randomness
-        random.shuffle(flattened_results)
-
-        # iterate through search results and build results page
-        row_start = True 
-        for result in flattened_results:
-            # make sure it's not a duplicate
-            if result['url'] not in seen_urls and result['thumbnail'] not in seen_thumbnails:
-                # housekeeping to make sure we don't surface duplicates
-                seen_urls.append(result['url'])
-                if result['source'] == 'Reddit' and result['thumbnail'] not in seen_thumbnails:
-                    seen_thumbnails.append(result['thumbnail'])
-                
-                # assemble HTML for search results
-                # use flexbox for 2 column rows
-                if row_start:
-                    html_string += "<div class='row'>"
-                    html_string += "<div class='rowchild'>"
-                    row_start = False 
-                else:
-                    html_string += "<div class='rowchild'>"
-                
-                # assemble link
-                if 'title' in result and result['title']:
-                    html_string += "<div class='linkhead'><a href = '" + result['url'] + "'>" + result['title'] + "</a></div>"
-                else: 
-                    html_string += "<div class='linkhead'><a href = '" + result['url'] + "'>Link</a></div>"
-                
-                # assemble source, choose whether or not to say the source name given subsource
-                if 'subsource' in result:
-                    if result['source'] in ['Image Vector Search']:
-                        html_string += "<div>Source: <a href='" + result['subsource_url'] + "'>" + result['subsource'] + "</a></div>"
-                    else:
-                        html_string += "<div>Source: <a href='" + result['subsource_url'] + "'>" + result['subsource'] + "</a> <i>(" + result['source'] + ")</i></div>"
-                else:
-                    html_string += "<div>Source: <i>" + result['source'] + "</i></div>"
-
-                # assemble actual query
-                html_string += "<div class='actualquery'>Actual query: <i>" + result['query'] + "</i></div>"
-                
-                if 'snippet' in result and result['snippet']:
-                    html_string += "<div class='snippet'>" + result['snippet'] + '</div>'
-                if result['thumbnail'] and result['thumbnail'] != 'None' and type(result['thumbnail']) != dict:
-                    if result['source'] == 'Podcast':
-                        html_string += "<div class='imagecontainer'><a href='" + result['thumbnail'] + "'><img class='podcast' src='" + result['thumbnail'] + "' /></a></div>"
-                    else:
-                        html_string += "<div class='imagecontainer'><a href='" + result['thumbnail'] + "'><img src='" + result['thumbnail'] + "' /></a></div>"
-
-                html_string += "</div>"
-
-        html_string += "</div></body></html>"
+@concurrent()
+@startup.profiled
+def web_search(query: str = None, stream: bool = False, fanout: str = 'modal', one_call: bool = False, 
+               speculative: bool = False, stream_plan: bool = False, debug: str = None):
+    from fastapi.responses import HTMLResponse, StreamingResponse # only web_search containers need fastapi
+
+    if query and stream:
+        return StreamingResponse(stream_results_page(query, fanout, one_call, speculative, stream_plan, debug == 'timing'),
+                                 media_type='text/html')
+    elif query:
+        with tracing.start_trace('web_search', debug=debug == 'timing', query=query, fanout=fanout,
+                                 one_call=one_call, speculative=speculative, stream_plan=stream_plan) as root:
+            # run chain search and then process each search independently
+            results = search_results(query, fanout, one_call, speculative, stream_plan, parent=root)
+
+            # dedup and interleave the results across sources (see merge.py), errors only go to the logs
+            with tracing.span('searches', parent=root):
+                batches = list(results)
+                merged = merge.merge_batches(batches)
+            if merged.errors:
+                print('Search errors:', merged.errors)
+
+            # build results page (flexbox for 2 column rows), noting engines that ran out of time
+            with tracing.span('render', parent=root):
+                html_string = ''.join(render.render_page(query, merged.results, end=False, thumbnail_src=thumbnail_src(merged.results)))
+            html_string += render.render_page_end(merged.timeouts, more_link(query, pagination.first_pages(batches)) +
+                                                  timing_html(root))
     else:
-        html_string += "<head><title>Search</title></head>"
-        html_string += "<body><form action='/' method='get'><input type='text' name='query' placeholder='Search' style='width: 80%; padding: 10px;'><button type='submit' id='submit' style='width: 20%; padding: 10px;'>Search</button></form>"
-        html_string += "</body></html>"
+        html_string = render.home_page
+    return HTMLResponse(html_string)
+
+# "load more" endpoint: the next page of each sub-query in the cursor from a results page, fetched in
+# parallel with the plan the cursor carries (no OpenAI calls), with a link on to the page after
+@app.function()
+@fastapi_endpoint(label='metasearch-more')
+@concurrent()
+@startup.profiled
+def more_results(cursor: str, debug: str = None):
+    from fastapi.responses import HTMLResponse
+
+    try:
+        topic, pages = pagination.decode_cursor(cursor)
+    except ValueError as e:
+        print('Bad cursor:', repr(e))
+        return HTMLResponse('<html><body>Bad cursor</body></html>', status_code=400)
+
+    with tracing.start_trace('more_results', debug=debug == 'timing', query=topic, pages=len(pages)) as root:
+        with tracing.span('call', parent=root, function='search_pages') as span:
+            batches, next_pages = search_pages.remote(pages, trace=tracing.context(span))
+        with tracing.span('searches', parent=root):
+            merged = merge.merge_batches(batches)
+        if merged.errors:
+            print('Search errors:', merged.errors)
+        with tracing.span('render', parent=root):
+            html_string = ''.join(render.render_page(topic, merged.results, end=False, thumbnail_src=thumbnail_src(merged.results)))
+        html_string += render.render_page_end(merged.timeouts, more_link(topic, next_pages) + timing_html(root))
     return HTMLResponse(html_string)
 
+# thumbnail proxy for result images: the image at url (signed by the results page) shrunk to fit its
+# card and re-encoded as WebP, fetched once per container and served from its disk cache after that
+# (the cache is on the container's local disk, so a cold container fetches its images again)
+# if the image can't be fetched or decoded, redirects to the original so the card still shows it
+@app.function()
+@fastapi_endpoint(label='metasearch-thumbnail')
+@concurrent()
+@startup.profiled
+async def thumbnail(url: str, size: str = 'image', sig: str = ''):
+    from fastapi.responses import RedirectResponse, Response
+
+    await thumbnails.load_signing_key() # so verify doesn't block the loop on the Modal Dict
+    if not url.startswith(('http://', 'https://')) or not thumbnails.verify(url, size, sig):
+        return Response('Bad thumbnail URL', status_code=403)
+    try:
+        digest, data = await thumbnails.get_proxy().get(url, size)
+    except Exception as e:
+        print('Thumbnail failed:', url, repr(e))
+        return RedirectResponse(url, status_code=302)
+    # the bytes for a signed URL don't change, so browsers can keep them
+    return Response(data, media_type='image/webp',
+                    headers={'Cache-Control': 'public, max-age=604800, immutable', 'ETag': '"' + digest + '"'})
+
 # local entrypoint to test
 @app.local_entrypoint()
-def main(query = 'Mountain sunset'):
+def main(query = 'Mountain sunset', fanout = 'modal', one_call: bool = False, speculative: bool = False, 
+         stream_plan: bool = False):
+    import time
+
     results = []
-    seen_urls = []
-    seen_thumbnails = []
+    started = time.time() # the request deadline counts from here, planning included
 
-    responses = openai_chain_search.remote(query)
-    for response in responses:
-        print(response)
-    
-    # use map to speed this up
-    results = parse_response.map(responses)
-    flattened_results = []
-    for result_array in results:
-        if result_array:
-            flattened_results += result_array
+    if speculative or stream_plan: # searches start before the whole plan is known
+        results = search_results(query, fanout, one_call, speculative, stream_plan, started=started)
+    else:
+        responses = openai_chain_search.remote(query, one_call=one_call)
+        for response in responses:
+            print(response)
     
-    for result in flattened_results:
-        if result['url'] not in seen_urls and result['thumbnail'] not in seen_thumbnails:
-            seen_urls.append(result['url'])
-            if result['source'] == 'Reddit' and result['thumbnail'] not in seen_thumbnails:
-                seen_thumbnails.append(result['thumbnail'])
-            for key in result:
-                print(key + ':', result[key])
-            print(' ')
\ No newline at end of file
+        # use map (or the async fan-out) to speed this up
+        results = run_searches(responses, fanout, started=started)
+    merged = merge.merge_batches(results)
+    for result in merged.results:
+        for key, value in result.to_dict().items():
+            print(key + ':', value)
+        print(' ')
+    for error in merged.errors:
+        print('Error:', error)
+    if merged.timeouts:
+        print('Timed out:', ', '.join(merged.timeouts))
+
+# p50/p95/p99 per stage (and engine) across every container's traced spans
+@app.function()
+async def latency_metrics():
+    return await tracing.collect_metrics(tracing.metrics_store())
+
+# every container's startup profile (see startup.py), summarized per function
+@app.function()
+def startup_profiles():
+    import modal
+    profiles = modal.Dict.from_name(startup.PROFILE_DICT, create_if_missing=True)
+    return startup.summarize(list(profiles.values()))
+
+# local entrypoint to check result cache hit rates
+@app.local_entrypoint()
+def show_cache_stats():
+    for engine, stats in cache_stats.remote().items():
+        print(engine + ':', stats)
+
+# local entrypoint to see where request time goes, stage by stage
+@app.local_entrypoint()
+def show_latency():
+    print(f'{"stage":>36} {"count":>7} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for stage, summary in sorted(latency_metrics.remote().items()):
+        print(f'{stage:>36} {summary["count"]:7d} {summary["p50"] * 1000:8.1f} '
+              f'{summary["p95"] * 1000:8.1f} {summary["p99"] * 1000:8.1f}')
+
+# local entrypoint to track cold starts: import and load time per function
+@app.local_entrypoint()
+def show_startup_profiles():
+    for function, summary in sorted(startup_profiles.remote().items()):
+        print(function + ':', summary['containers'], 'containers,',
+              format(summary['until_first_input'], '.2f') + 's to first input,',
+              format(summary['imports_total'], '.2f') + 's importing,',
+              format(summary['first_input'], '.2f') + 's first input')
+        for name, seconds in summary['slowest_imports']:
+            print('   import', name, format(seconds, '.3f') + 's')
+        for name, seconds in summary['phases'].items():
+            print('   ', name, format(seconds, '.3f') + 's')
@@ -0,0 +1,48 @@
+# text-only CLIP encoder for TextEmbeddingModel
+# download_models in pinecone_query.py exports the text tower and projection of clip-ViT-B-32 on their
+# own as safetensors (memory-mapped on load), so containers skip the image tower and never import
+# sentence_transformers; the embeddings are the same as SentenceTransformer.encode on text
+import os
+
+# CLIP's context length
+max_length = 77
+
+class TextEncoder:
+    def __init__(self, path: str, int8: bool = False):
+        import torch
+        import transformers
+
+        torch.set_grad_enabled(False)
+        self.tokenizer = transformers.CLIPTokenizerFast.from_pretrained(path)
+        self.model = transformers.CLIPTextModelWithProjection.from_pretrained(path, use_safetensors=True)
+        self.model.eval()
+        if int8: # dynamic int8 quantization of the linear layers, faster on CPU for a little accuracy
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.dim = self.model.config.projection_dim
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    # same call shape as SentenceTransformer.encode: list of strings in, float32 array of vectors out
+    def encode(self, texts: list, batch_size: int = 32):
+        import numpy
+        import torch
+
+        vectors = []
+        with torch.inference_mode():
+            for start in range(0, len(texts), batch_size):
+                tokens = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                        max_length=max_length, return_tensors='pt')
+                vectors.append(self.model(**tokens).text_embeds.float().numpy())
+        if not vectors:
+            return numpy.zeros((0, self.dim), dtype=numpy.float32)
+        return numpy.concatenate(vectors)
+
+# the encoder picked by CLIP_ENCODER: 'text' (default), 'text-int8', or 'full' for the whole
+# SentenceTransformer (image tower included) from full_path
+def load_encoder(full_path: str, text_path: str, mode: str = None):
+    mode = mode or os.environ.get('CLIP_ENCODER', 'text')
+    if mode == 'full' or not os.path.exists(text_path):
+        import sentence_transformers
+        return sentence_transformers.SentenceTransformer(full_path, device='cpu')
+    return TextEncoder(text_path, int8=mode == 'text-int8')
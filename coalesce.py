@@ -0,0 +1,209 @@
+# single-flight coalescing: concurrent identical work waits on the one run already in flight
+#   SingleFlight: async, per event loop, for cache misses (engine sub-queries and planner runs, see
+#   result_cache.py); with a store, the leader also takes a lock entry in it so leaders in other
+#   containers wait for its result to land in the shared cache instead of repeating the call
+#   RequestFlights: threads, for whole metasearch requests in a web_search container (keyed by the
+#   normalized topic and options): one run of the searches, every duplicate replays its batches as they arrive
+#   (within one container only: identical requests in different containers each plan and search, sharing
+#   only the cache-level coalescing of their sub-queries and plans)
+# set COALESCE=0 to turn both off
+import os
+import time
+import uuid
+import random
+import asyncio
+import threading
+from collections import Counter
+
+ENABLED = os.environ.get('COALESCE', '1') != '0'
+
+# a lock entry older than this (seconds) belongs to a leader that died, so it can be taken over
+LEASE = 15.0
+
+# how often (seconds) a container waiting on another container's leader first checks for its result,
+# doubling (with jitter) after each check up to MAX_POLL_INTERVAL, so waiters don't hammer the store
+POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 0.5
+
+# longest (seconds) to wait on another container's leader before doing the work anyway (callers with a
+# time budget pass a shorter max_wait to run, see Dispatcher.search)
+MAX_WAIT = 10.0
+
+class SingleFlight:
+    def __init__(self, store=None, lease: float = LEASE, poll_interval: float = POLL_INTERVAL,
+                 max_wait: float = MAX_WAIT):
+        self.store = store # shared lock store across containers, None to coalesce in this container only
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.owner = uuid.uuid4().hex
+        self.flights = {} # key -> task every caller waits on
+        self.waiters = Counter()
+        self.stats = Counter()
+
+    # run compute() for key, or wait on the run already in flight
+    # recheck() returns the result if another container has stored it (None if not), count(kind) is
+    # told about callers that didn't run compute themselves ('coalesced' here, 'shared_coalesced' elsewhere)
+    # max_wait caps how long the run waits on another container's leader (the flight's default if None)
+    async def run(self, key: str, compute, recheck=None, count=None, max_wait: float = None):
+        task = self.flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.lead(key, compute, recheck, count,
+                                                   self.max_wait if max_wait is None else max_wait))
+            self.flights[key] = task
+            task.add_done_callback(lambda task: self.flights.pop(key, None) if self.flights.get(key) is task else None)
+        else:
+            self.stats['coalesced'] += 1
+            if count is not None:
+                count('coalesced')
+        self.waiters[key] += 1
+        try:
+            # shielded, so one caller giving up (its deadline passed) doesn't cancel the others
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self.waiters[key] == 1 and not task.done(): # nobody is left waiting
+                task.cancel()
+            raise
+        finally:
+            self.waiters[key] -= 1
+            if not self.waiters[key]:
+                del self.waiters[key]
+
+    async def lead(self, key: str, compute, recheck, count, max_wait: float):
+        self.stats['leads'] += 1
+        if self.store is None or recheck is None:
+            return await compute()
+
+        # another container holds the lock: poll for its result until it releases the lock or runs out of time
+        # (checking after claiming it too, since the last leader may have stored its result and let go
+        # of the lock after the cache was checked)
+        stop_at = time.monotonic() + max_wait
+        interval = self.poll_interval
+        while True:
+            claimed = await self.claim(key)
+            value = await recheck()
+            if value is not None:
+                if claimed:
+                    await self.release(key)
+                self.stats['shared_coalesced'] += 1
+                if count is not None:
+                    count('shared_coalesced')
+                return value
+            if claimed or time.monotonic() >= stop_at:
+                break
+            await asyncio.sleep(min(interval * random.uniform(0.5, 1.0), max(0.0, stop_at - time.monotonic())))
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+        try:
+            return await compute()
+        finally:
+            if claimed:
+                await self.release(key)
+
+    # take the lock entry for key, taking over one whose lease ran out
+    # (store outages count as claimed, so coalescing never blocks a search)
+    async def claim(self, key: str):
+        try:
+            if await self.store.put_if_absent('lock:' + key, (time.time(), self.owner)):
+                return True
+            entry = await self.store.get('lock:' + key)
+            if entry is not None and time.time() - entry[0] < self.lease:
+                return False
+            await self.store.delete('lock:' + key)
+            return await self.store.put_if_absent('lock:' + key, (time.time(), self.owner))
+        except Exception as e:
+            print('Coalescing lock failed:', repr(e))
+            return True
+
+    async def release(self, key: str):
+        try:
+            entry = await self.store.get('lock:' + key)
+            if entry is not None and entry[1] == self.owner:
+                await self.store.delete('lock:' + key)
+        except Exception as e:
+            print('Coalescing unlock failed:', repr(e))
+
+# one run of a generator of items, replayed to every subscriber as the items arrive
+class Broadcast:
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.subscribers = 0
+
+    # pull items in a thread of its own, so a subscriber going away early doesn't stop the others
+    # (the generator is closed once every subscriber has gone)
+    def start(self, items, on_done):
+        def drive():
+            try:
+                for item in items:
+                    with self.condition:
+                        self.items.append(item)
+                        self.condition.notify_all()
+                        if not self.subscribers:
+                            break
+            except Exception as e:
+                self.error = e
+            finally:
+                if hasattr(items, 'close'):
+                    items.close()
+                on_done()
+                with self.condition:
+                    self.done = True
+                    self.condition.notify_all()
+        threading.Thread(target=drive, daemon=True).start()
+
+    # items so far, then each new one, for a subscriber already counted in subscribers
+    def subscribe(self):
+        try:
+            index = 0
+            while True:
+                with self.condition:
+                    while index >= len(self.items) and not self.done:
+                        self.condition.wait()
+                    if index < len(self.items):
+                        item = self.items[index]
+                        index += 1
+                    elif self.error is not None:
+                        raise self.error
+                    else:
+                        return
+                yield item
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+
+class RequestFlights:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.broadcasts = {}
+        self.stats = Counter()
+
+    # iterate start()'s items, sharing one run with every concurrent request for key
+    # returns (items, whether this request joined one already running)
+    def run(self, key: str, start):
+        with self.lock:
+            broadcast = self.broadcasts.get(key)
+            joined = broadcast is not None
+            if not joined:
+                broadcast = self.broadcasts[key] = Broadcast()
+            broadcast.subscribers += 1
+            self.stats['coalesced' if joined else 'leads'] += 1
+        if not joined:
+            try:
+                items = start()
+            except Exception as e: # requests that joined meanwhile get the same error
+                self.finish(key, broadcast)
+                with broadcast.condition:
+                    broadcast.error = e
+                    broadcast.done = True
+                    broadcast.subscribers -= 1
+                    broadcast.condition.notify_all()
+                raise
+            broadcast.start(iter(items), lambda: self.finish(key, broadcast))
+        return broadcast.subscribe(), joined
+
+    def finish(self, key: str, broadcast: Broadcast):
+        with self.lock:
+            if self.broadcasts.get(key) is broadcast:
+                del self.broadcasts[key]
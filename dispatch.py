@@ -0,0 +1,367 @@
+# in-process async fan-out: run every planner sub-query concurrently in one container
+# with a single pooled httpx.AsyncClient instead of one Modal container hop per sub-query
+import time
+import asyncio
+import weakref
+from collections import Counter, defaultdict, deque
+
+import coalesce
+import engines
+import rate_limit
+import result_cache
+import tracing
+from search_result import SearchBatch, SearchResults, SearchTimeout, Throttled, failed, timed_out
+
+# engine prefixes emitted by the planner, mapped to their implementations
+ENGINES = {
+    'Wikipedia': engines.search_wikipedia,
+    'Reddit': engines.search_reddit,
+    'Podcast': engines.search_podcasts,
+    'Unsplash': engines.search_unsplash,
+    'Vector': engines.search_vector,
+}
+
+# max in-flight requests per engine, to stay polite with each upstream host
+ENGINE_CONCURRENCY = {
+    'Wikipedia': 4,
+    'Reddit': 2,
+    'Podcast': 2,
+    'Unsplash': 2,
+    'Vector': 8, # TextEmbeddingModel batches concurrent queries into one CLIP call
+}
+
+# time budget (seconds) for each engine's search, hedged duplicates included; past it the search
+# is abandoned and the engine is reported as timed out
+ENGINE_BUDGETS = {
+    'Wikipedia': 3.0,
+    'Reddit': 4.0,
+    'Podcast': 4.0,
+    'Unsplash': 3.0,
+    'Vector': 4.0, # enough for a warm container, a cold one (loading CLIP) gets left off the page
+}
+DEFAULT_BUDGET = 4.0
+
+# share of an engine's budget a cache miss spends waiting on another container already fetching the
+# same search (see coalesce.py), leaving the rest for its own fetch if that one doesn't land in time
+COALESCE_SHARE = 0.5
+
+# deadline (seconds) for all of a request's searches: whatever has arrived by then gets rendered
+# the clock starts when the request does, on every path (planned, streamed and speculative, modal and async
+# fan-out), so planning counts against it; callers pass the request's start (time.time()) down as started
+REQUEST_DEADLINE = 6.0
+
+# seconds left before deadline for a request that began at started (time.time(), None for now)
+def time_left(deadline: float, started: float = None):
+    return deadline - (time.time() - started if started is not None else 0.0)
+
+# send a duplicate request once a search has run longer than this percentile of the engine's recent
+# latencies (HEDGE_DELAY until there are HEDGE_MIN_SAMPLES of them), and take whichever answers first
+HEDGE_PERCENTILE = 0.9
+HEDGE_DELAY = 1.0
+HEDGE_MIN_SAMPLES = 20
+
+# engines worth searching with the raw topic while the planner is still running
+SPECULATIVE_ENGINES = ['Wikipedia', 'Reddit', 'Podcast', 'Unsplash']
+
+# one pooled client (and dispatcher) per event loop, so keep-alive connections and caches
+# survive across inputs in a container
+clients = weakref.WeakKeyDictionary()
+dispatchers = weakref.WeakKeyDictionary()
+
+# split a planner response like 'Reddit: some query' into (engine, query)
+def split_response(response: str):
+    engine, _, query = response.partition(': ')
+    if engine in ENGINES and query:
+        return engine, query
+    return None, None
+
+# given a finished plan and the engines searched speculatively with the raw topic, work out
+# which speculative searches to keep (the plan uses that engine), which to cancel, and which
+# planned responses still need to run (a planned raw-topic search is already covered)
+def reconcile_speculation(topic: str, responses: list, speculative_engines):
+    planned = set(split_response(response)[0] for response in responses)
+    keep = [engine for engine in speculative_engines if engine in planned]
+    cancel = [engine for engine in speculative_engines if engine not in planned]
+
+    remaining = []
+    for response in responses:
+        engine, query = split_response(response)
+        if engine in keep and result_cache.normalize_query(query) == result_cache.normalize_query(topic):
+            continue
+        remaining.append(response)
+    return keep, cancel, remaining
+
+# get the shared client for the running event loop, creating it on first use
+def get_client():
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    client = clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(10.0, connect=3.0), # backstop, budgets normally cut searches off first
+            event_hooks={'response': [rate_limit.observe_response]}, # feeds rate limit headers back
+            limits=httpx.Limits(max_connections=100,
+                                max_keepalive_connections=20,
+                                keepalive_expiry=60)
+        )
+        clients[loop] = client
+    return client
+
+# get the shared, result-caching dispatcher for the running event loop
+def get_dispatcher():
+    loop = asyncio.get_running_loop()
+    if loop not in dispatchers:
+        store = result_cache.default_store()
+        flights = coalesce.SingleFlight(store) if coalesce.ENABLED else None
+        dispatchers[loop] = Dispatcher(cache=result_cache.ResultCache(store, flights=flights,
+                                                                   stats_store=result_cache.default_stats_store()),
+                                       limiter=rate_limit.RateLimiter(rate_limit.default_store()))
+    return dispatchers[loop]
+
+# recent successful request latencies per engine, for picking hedge delays
+class LatencyTracker:
+    def __init__(self, window: int = 200):
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+
+    def record(self, engine: str, seconds: float):
+        self.samples[engine].append(seconds)
+
+    # the given percentile of recent latencies, or None without enough samples
+    def percentile(self, engine: str, percentile: float, min_samples: int = 1):
+        samples = self.samples[engine]
+        if len(samples) < min_samples or not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile))]
+
+class Dispatcher:
+    def __init__(self, client=None, concurrency: dict = None, cache=None, budgets: dict = None,
+                 deadline: float = REQUEST_DEADLINE, hedge: bool = True, limiter=None):
+        self.client = client if client is not None else get_client()
+        self.cache = cache
+
+        # per-engine concurrency limits, overridable per dispatcher
+        limits = dict(ENGINE_CONCURRENCY)
+        limits.update(concurrency or {})
+        self.semaphores = {engine: asyncio.Semaphore(limit) for engine, limit in limits.items()}
+
+        # per-engine time budgets and the request deadline (0 or None turns the deadline off)
+        self.budgets = dict(ENGINE_BUDGETS)
+        self.budgets.update(budgets or {})
+        self.deadline = deadline
+        self.hedge = hedge
+        self.latencies = LatencyTracker()
+        self.stats = Counter() # hedges sent, hedges that won, budget timeouts, cached fallbacks
+
+        # per-engine rate limits and circuit breakers (see rate_limit.py), None to call upstreams freely
+        self.limiter = limiter
+
+    # run a single engine search (options are passed through to the engine, e.g. num_matches)
+    # traced as a search span, with a fetch span under it unless the cache answered
+    # the engine's budget covers waiting on another container's fetch of the same search too: a miss
+    # waits on it for at most COALESCE_SHARE of the budget, then fetches in whatever is left
+    async def search(self, engine: str, query: str, **options):
+        with tracing.span('search', engine=engine, query=query):
+            if self.cache is None:
+                return await self.fetch(engine, query, options)
+            budget = self.budgets.get(engine, DEFAULT_BUDGET)
+            started = time.monotonic()
+            remaining = lambda: max(0.0, budget - (time.monotonic() - started))
+            try:
+                return await self.cache.get_or_fetch(engine, query,
+                                                     lambda: self.fetch(engine, query, options, remaining()),
+                                                     options, max_wait=budget * COALESCE_SHARE)
+            except Throttled:
+                # engine is rate limited or its breaker is open, so serve the last results we have, however old
+                fallback = await self.cache.get_fallback(engine, query, options)
+                if fallback is None:
+                    raise
+                self.stats['fallbacks'] += 1
+                tracing.annotate(fallback=True)
+                return fallback
+
+    # hit the upstream within the engine's time budget, unless its circuit breaker is open
+    # (the results come back as SearchResults, so they pickle compactly into the cache and across containers)
+    # budget is what's left of the engine's (all of it if None)
+    async def fetch(self, engine: str, query: str, options: dict, budget: float = None):
+        with tracing.span('fetch', engine=engine, query=query):
+            if self.limiter is not None:
+                await self.limiter.check(engine, query)
+            budget = self.budgets.get(engine, DEFAULT_BUDGET) if budget is None else budget
+            try:
+                results = await asyncio.wait_for(self.hedged(engine, query, options), budget)
+            except asyncio.TimeoutError:
+                self.stats['timeouts'] += 1
+                if self.limiter is not None:
+                    self.limiter.failure(engine)
+                raise SearchTimeout(engine, query, 'no response within ' + str(round(budget, 2)) + 's')
+            except Throttled:
+                raise
+            except Exception:
+                if self.limiter is not None:
+                    self.limiter.failure(engine)
+                raise
+            if self.limiter is not None:
+                self.limiter.success(engine)
+            return SearchResults(results)
+
+    # how long to wait on a search before sending a duplicate, or None to never hedge
+    def hedge_delay(self, engine: str):
+        if not self.hedge:
+            return None
+        delay = self.latencies.percentile(engine, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+        delay = HEDGE_DELAY if delay is None else delay
+        return delay if delay < self.budgets.get(engine, DEFAULT_BUDGET) else None
+
+    # run a search, and if it's slower than the engine usually is, race a duplicate against it
+    async def hedged(self, engine: str, query: str, options: dict):
+        primary = asyncio.ensure_future(self.attempt(engine, query, options))
+        attempts = [primary]
+        try:
+            delay = self.hedge_delay(engine)
+            if delay is not None:
+                done, _ = await asyncio.wait(attempts, timeout=delay)
+                if not done:
+                    self.stats['hedges'] += 1
+                    # a duplicate is only worth sending if the rate limit has a token to spare right now
+                    attempts.append(asyncio.ensure_future(self.attempt(engine, query, options, max_wait=0.0, hedge=True)))
+
+            # first successful attempt wins, fail only if every attempt failed
+            pending, error = set(attempts), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.stats['hedge_wins'] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    # one request to the upstream under that engine's concurrency limit and rate limit
+    # (the upstream span's queued attribute is the time spent waiting on both)
+    async def attempt(self, engine: str, query: str, options: dict, max_wait: float = rate_limit.MAX_WAIT,
+                      hedge: bool = False):
+        with tracing.span('upstream', engine=engine, query=query, hedge=hedge) as span:
+            queued_at = time.monotonic()
+            if self.limiter is not None:
+                await self.limiter.acquire(engine, query, max_wait)
+                rate_limit.current_call.set((self.limiter, engine))
+            async with self.semaphores[engine]:
+                start = time.monotonic()
+                if span is not None:
+                    span.set(queued=round(start - queued_at, 4))
+                results = await ENGINES[engine](self.client, query, **options)
+                self.latencies.record(engine, time.monotonic() - start)
+                return results
+
+    # start a search task for every planner response, keyed by task
+    # pages optionally maps responses to the engine's paging options (see pagination.py)
+    def start(self, responses, pages: dict = None):
+        pending = {}
+        for response in responses:
+            engine, query = split_response(response)
+            if engine:
+                options = (pages or {}).get(response, {})
+                pending[asyncio.ensure_future(self.search(engine, query, **options))] = response
+        return pending
+
+    # start a search for one planner response, releasing the parked speculative search for its engine
+    # and skipping the response if it's just the raw topic that search already covers
+    def add(self, pending: dict, response: str, speculative: dict, covered: set, topic: str):
+        engine, query = split_response(response)
+        if not engine:
+            return
+        if engine in speculative:
+            pending[speculative.pop(engine)] = engine + ': ' + topic
+            covered.add(engine)
+        if engine in covered and result_cache.normalize_query(query) == result_cache.normalize_query(topic):
+            return
+        pending[asyncio.ensure_future(self.search(engine, query))] = response
+
+    # yield (response, SearchBatch) for started searches in completion order
+    # plan is an optional async iterator of responses still being generated: each one's search
+    # starts as soon as it arrives. speculative holds parked raw-topic searches by engine, released
+    # when the plan uses their engine and cancelled if the plan finishes without it
+    # once the request deadline passes (counted from started, see REQUEST_DEADLINE), searches still running
+    # are cancelled and reported as timed out
+    async def as_completed(self, pending: dict, plan=None, speculative: dict = None, topic: str = None,
+                           started: float = None):
+        speculative = speculative if speculative is not None else {}
+        covered = set()
+        next_response = asyncio.ensure_future(plan.__anext__()) if plan is not None else None
+        loop = asyncio.get_running_loop()
+        stop_at = loop.time() + time_left(self.deadline, started) if self.deadline else None
+        try:
+            while pending or next_response is not None:
+                waiting = set(pending)
+                if next_response is not None:
+                    waiting.add(next_response)
+                timeout = max(0.0, stop_at - loop.time()) if stop_at is not None else None
+                done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done: # out of time, render whatever has arrived
+                    for task, response in list(pending.items()):
+                        task.cancel()
+                        yield response, timed_out(response, split_response(response)[0])
+                    pending.clear()
+                    return
+
+                if next_response in done:
+                    done.discard(next_response)
+                    try:
+                        response = next_response.result()
+                    except StopAsyncIteration:
+                        # plan is done, so parked searches on engines it never used are irrelevant
+                        next_response = None
+                        for task in speculative.values():
+                            task.cancel()
+                        speculative.clear()
+                    else:
+                        next_response = asyncio.ensure_future(plan.__anext__())
+                        self.add(pending, response, speculative, covered, topic)
+
+                for task in done:
+                    response = pending.pop(task)
+                    if task.exception():
+                        # one failing upstream shouldn't take down the whole page, report it alongside
+                        print('Search failed:', response, repr(task.exception()))
+                        yield response, failed(response, task.exception())
+                    else:
+                        yield response, SearchBatch(task.result(), [])
+        finally:
+            # caller stopped early (or the plan failed), so don't leave searches running
+            for task in list(pending) + list(speculative.values()):
+                task.cancel()
+            if next_response is not None:
+                next_response.cancel()
+
+    # run every planner response concurrently, yielding (response, SearchBatch) in completion order
+    async def run(self, responses, pages: dict = None, started: float = None):
+        async for response, batch in self.as_completed(self.start(responses, pages), started=started):
+            yield response, batch
+
+    # run searches for a streaming plan (async iterator of responses) as each response arrives
+    async def run_streaming(self, plan, started: float = None):
+        async for response, batch in self.as_completed({}, plan, started=started):
+            yield response, batch
+
+    # search the raw topic on every engine while the planner runs (plan is an async iterator of
+    # responses, or an awaitable list of them), keep the searches on engines the plan uses,
+    # cancel the rest, and run the rest of the plan
+    async def run_speculative(self, topic: str, plan, started: float = None):
+        if not hasattr(plan, '__anext__'):
+            plan = iterate(plan)
+        speculative = {engine: asyncio.ensure_future(self.search(engine, topic)) for engine in SPECULATIVE_ENGINES}
+        async for response, batch in self.as_completed({}, plan, speculative, topic, started):
+            yield response, batch
+
+# turn an awaitable list of responses into an async iterator
+async def iterate(responses):
+    for response in await responses:
+        yield response
@@ -0,0 +1,180 @@
+# persistent cache of CLIP text embeddings, keyed by a hash of the normalized text
+# every container appends its new (hash, float16 vector) records to its own shard file and no container
+# ever rewrites a file, so containers committing the volume at the same time can't clobber each other's
+# entries; on load every shard is memory-mapped read-only (warm containers on a host share its pages
+# through the OS page cache) and merged, newest shard first, up to capacity entries
+# a shard is read up to its last whole record, and keeping the hash next to its vector means a record
+# can never be paired with the wrong text
+# once the shards hold more than COMPACT_FACTOR times capacity records (superseded and evicted ones
+# included), or there are more than MAX_SHARDS of them, a loading container rewrites what it loaded
+# into its own shard and deletes the shards it read, so the volume stays near capacity
+import os
+import secrets
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+SHARD_SUFFIX = '.f16'
+COMPACT_FACTOR = 2
+MAX_SHARDS = 64
+
+# collapse case and whitespace so trivially different prompts share a vector
+def normalize_text(text: str):
+    return ' '.join(text.lower().split())
+
+def text_hash(text: str):
+    # 0 marks an empty record, so never hand it out as a hash
+    return int.from_bytes(hashlib.blake2b(normalize_text(text).encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+class EmbeddingCache:
+    def __init__(self, path: str, dim: int = 512, capacity: int = 50000, flush_every: int = 256):
+        self.path = path
+        self.dim = dim
+        self.capacity = capacity
+        self.flush_every = flush_every
+        self.record = np.dtype([('hash', '<u8'), ('vector', '<f2', (dim,))])
+        os.makedirs(path, exist_ok=True)
+        # this container's shard, created on its first flush
+        self.shard_path = os.path.join(path, 'shard-' + secrets.token_hex(8) + SHARD_SUFFIX)
+        self.pending = [] # records not yet appended to the shard
+
+        # hash -> float16 vector (a row of a mapped shard, or an array put here), least recently used first
+        self.vectors = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'encoded': 0, 'encode_seconds': 0.0, 'evictions': 0, 'compacted': 0}
+        self.load()
+
+    # merge every shard on the volume, newest first, so the newest vector for a text wins; shards with
+    # nothing left to contribute (superseded or past capacity) are deleted
+    def load(self):
+        shards = []
+        for name in os.listdir(self.path):
+            if name.startswith('shard-') and name.endswith(SHARD_SUFFIX):
+                try:
+                    shards.append((os.path.getmtime(os.path.join(self.path, name)), name))
+                except FileNotFoundError: # deleted by another container's load
+                    pass
+        loaded = []
+        kept = [] # shards still on the volume after the merge
+        total = 0 # records in them
+        for _, name in sorted(shards, reverse=True):
+            shard_path = os.path.join(self.path, name)
+            records = self.map_shard(shard_path)
+            found = 0
+            if records is not None:
+                total += len(records)
+                # later records in a shard are newer
+                for row in range(len(records) - 1, -1, -1):
+                    if len(loaded) >= self.capacity:
+                        break
+                    key = int(records['hash'][row])
+                    if key and key not in self.vectors:
+                        self.vectors[key] = records['vector'][row]
+                        loaded.append(key)
+                        found += 1
+            if not found:
+                try:
+                    os.remove(shard_path)
+                except FileNotFoundError:
+                    pass
+            else:
+                kept.append(shard_path)
+        # oldest first, so the newest records are the last to be evicted
+        for key in reversed(loaded):
+            self.vectors.move_to_end(key)
+        if len(kept) > MAX_SHARDS or total > COMPACT_FACTOR * self.capacity:
+            self.compact(kept)
+
+    # write every loaded record to this container's shard (oldest first, like appends) and delete the
+    # shards they came from; a container still mapping one keeps reading it until it closes the map
+    def compact(self, shard_paths: list):
+        records = np.empty(len(self.vectors), dtype=self.record)
+        records['hash'] = list(self.vectors)
+        for row, vector in enumerate(self.vectors.values()):
+            records['vector'][row] = vector
+        # written under another name and renamed, so no container maps a half-written shard
+        partial = os.path.join(self.path, 'compacting-' + secrets.token_hex(8))
+        with open(partial, 'wb') as f:
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, self.shard_path)
+        for shard_path in shard_paths:
+            try:
+                os.remove(shard_path)
+            except FileNotFoundError:
+                pass
+        # point at the new shard, so the deleted ones' pages can be dropped
+        mapped = self.map_shard(self.shard_path)
+        if mapped is not None:
+            for row, key in enumerate(list(self.vectors)):
+                self.vectors[key] = mapped['vector'][row]
+        self.stats['compacted'] += len(shard_paths)
+
+    # a shard's whole records, mapped read-only (a record still being appended is left out), or None
+    def map_shard(self, shard_path: str):
+        try:
+            count = os.path.getsize(shard_path) // self.record.itemsize
+        except FileNotFoundError:
+            return None
+        if not count:
+            return None
+        return np.memmap(shard_path, dtype=self.record, mode='r', shape=(count,))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    # cached vector for text (a float32 copy, so callers never hold a view into a mapped shard), or None
+    def get(self, text: str):
+        key = text_hash(text)
+        vector = self.vectors.get(key)
+        if vector is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        self.vectors.move_to_end(key)
+        return np.array(vector, dtype=np.float32)
+
+    def put(self, text: str, vector):
+        key = text_hash(text)
+        vector = np.asarray(vector, dtype=np.float16)
+        if key not in self.vectors and len(self.vectors) >= self.capacity: # evict the least recently used
+            self.vectors.popitem(last=False)
+            self.stats['evictions'] += 1
+        self.vectors[key] = vector
+        self.vectors.move_to_end(key)
+        self.pending.append((key, vector))
+
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    # record how long a batch of encodes took, to estimate the time hits save
+    def record_encode(self, count: int, seconds: float):
+        self.stats['encoded'] += count
+        self.stats['encode_seconds'] += seconds
+
+    # append pending records to this container's shard, whole records at a time
+    def flush(self):
+        if not self.pending:
+            return
+        records = np.array(self.pending, dtype=self.record)
+        with open(self.shard_path, 'ab') as f:
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+
+    def report(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        seconds_per_encode = self.stats['encode_seconds'] / self.stats['encoded'] if self.stats['encoded'] else 0.0
+        return {
+            'entries': len(self.vectors),
+            'capacity': self.capacity,
+            'hits': self.stats['hits'],
+            'misses': self.stats['misses'],
+            'hit_rate': self.stats['hits'] / lookups if lookups else 0.0,
+            'evictions': self.stats['evictions'],
+            'compacted_shards': self.stats['compacted'],
+            'ms_per_encode': seconds_per_encode * 1000,
+            'encode_seconds_saved': self.stats['hits'] * seconds_per_encode,
+        }
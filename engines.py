@@ -0,0 +1,457 @@
+# async implementations of each search engine
+# shared by the per-engine Modal functions in chain_search.py and the in-process dispatcher in dispatch.py
+# every engine takes the httpx.AsyncClient to use so connections can be pooled across searches
+import os
+import time
+import asyncio
+import weakref
+import base64
+import urllib.parse
+
+import tracing
+from search_result import SearchResult, SearchError, clean_url
+
+# upstream base URLs (module level so benchmarks can point them at local mock servers)
+wikipedia_url = 'https://en.wikipedia.org'
+reddit_auth_url = 'https://www.reddit.com'
+reddit_api_url = 'https://oauth.reddit.com'
+taddy_url = 'https://api.taddy.org'
+unsplash_url = 'https://api.unsplash.com'
+
+# Reddit app-only tokens are good for an hour, so reuse them across searches in a container
+reddit_token = {'access_token': None, 'expires_at': 0.0}
+
+# Wikipedia asks API clients to identify themselves
+wikipedia_headers = {'User-Agent': 'ai-metasearch-concept/1.0 (https://github.com/BenjaminTseng/ai_metasearch_concept)'}
+
+# one action=query call returns the intro text, thumbnail, and disambiguation flag for each page
+wikipedia_query_params = {
+    'action': 'query',
+    'format': 'json',
+    'formatversion': 2,
+    'redirects': 1,
+    'prop': 'extracts|pageimages|pageprops|info',
+    'exintro': 1,
+    'explaintext': 1,
+    'exlimit': 'max',
+    'piprop': 'thumbnail',
+    'pithumbsize': 640,
+    'pilimit': 'max',
+    'ppprop': 'disambiguation',
+    'inprop': 'url',
+}
+
+# titles looked up at about the same time share one request (20 is the API's cap for intro extracts)
+wikipedia_batch_size = 20
+wikipedia_batch_wait = 0.01
+
+# one title batcher per client, so batches never mix event loops
+wikipedia_batchers = weakref.WeakKeyDictionary()
+
+disambiguation_snippet = 'This page links to several Wikipedia articles that might be relevant.'
+
+# the Image Vector Search engine lives in the text-pinecone-query app (pinecone_query.py), where
+# TextEmbeddingModel keeps CLIP loaded in a warm pool; it's looked up once per container
+vector_app_name = 'text-pinecone-query'
+vector_model = {'instance': None}
+
+def get_vector_model():
+    if vector_model['instance'] is None:
+        import modal
+        vector_model['instance'] = modal.Cls.from_name(vector_app_name, 'TextEmbeddingModel')()
+    return vector_model['instance']
+
+# SearchError for a non-200 upstream response, so rate limits and outages surface as failures
+# (the dispatcher's rate limiter reads the response headers itself)
+def upstream_error(engine: str, query: str, response):
+    if response.status_code == 429:
+        return SearchError(engine, query, 'rate limited (HTTP 429)')
+    elif response.status_code in (401, 403):
+        return SearchError(engine, query, 'auth failure (HTTP ' + str(response.status_code) + ')')
+    return SearchError(engine, query, 'HTTP ' + str(response.status_code))
+
+# handle Wikipedia: the JSON API, falling back to scraping the HTML pages if the API fails
+# later pages (for "load more") are the next two search results from offset, leaving out the article
+# titled exclude (the one a first page found by exact title, see pagination.py)
+async def search_wikipedia(client, query: str, offset: int = 0, exclude: str = None):
+    if offset or exclude:
+        return await search_wikipedia_results(client, query, offset, exclude)
+    try:
+        return await search_wikipedia_api(client, query)
+    except Exception as e:
+        print('Wikipedia API failed, scraping HTML instead:', repr(e))
+        return await search_wikipedia_html(client, query)
+
+async def search_wikipedia_api(client, query: str):
+    # an exact title (after redirects) is the article, like the "Go" behavior of Special:Search
+    page = await get_wikipedia_batcher(client).lookup(query)
+    if page is not None and not page.get('missing') and not page.get('invalid'):
+        return [wikipedia_page_result(query, page)]
+
+    # no match, so its a search, get top two results
+    return await search_wikipedia_results(client, query)
+
+# top two search results from offset; with exclude, three with the article titled exclude dropped if
+# it's among them (so three results means it's still further down)
+async def search_wikipedia_results(client, query: str, offset: int = 0, exclude: str = None):
+    limit = 3 if exclude else 2
+    params = dict(wikipedia_query_params, generator='search', gsrsearch=query, gsrlimit=limit)
+    if offset:
+        params['gsroffset'] = offset
+    body = await query_wikipedia(client, params)
+    pages = sorted(body.get('query', {}).get('pages', []), key=lambda page: page.get('index', 0))
+    return [wikipedia_page_result(query, page) for page in pages[0:limit] if page['title'] != exclude]
+
+# run an action=query request and return the decoded body
+async def query_wikipedia(client, params: dict):
+    r = await client.get(wikipedia_url + '/w/api.php', params=params, headers=wikipedia_headers)
+    r.raise_for_status()
+    body = r.json()
+    if 'error' in body:
+        raise ValueError('Wikipedia API error: ' + str(body['error']))
+    return body
+
+# look up many titles in one request, returning {requested title: page or None}
+async def query_wikipedia_titles(client, titles: list):
+    params = dict(wikipedia_query_params, titles='|'.join(titles))
+    return parse_wikipedia_pages(await query_wikipedia(client, params), titles)
+
+# map each requested title to its page, following title normalization and redirects
+def parse_wikipedia_pages(body: dict, titles: list):
+    query = body.get('query', {})
+    pages = {page['title']: page for page in query.get('pages', [])}
+    aliases = {}
+    for step in query.get('normalized', []) + query.get('redirects', []):
+        aliases[step['from']] = step['to']
+
+    found = {}
+    for title in titles:
+        resolved, seen = title, set()
+        while resolved in aliases and resolved not in seen:
+            seen.add(resolved)
+            resolved = aliases[resolved]
+        found[title] = pages.get(resolved)
+    return found
+
+# turn an API page into a result, matching what the HTML scraper produces
+def wikipedia_page_result(query: str, page: dict):
+    result = SearchResult('Wikipedia', query, page['fullurl'], title=page['title'])
+
+    # first real paragraph of the intro
+    paragraphs = [paragraph.strip() for paragraph in page.get('extract', '').split('\n') if len(paragraph.split()) > 10]
+    paragraph_text = paragraphs[0] if paragraphs else ''
+
+    if 'disambiguation' in page.get('pageprops', {}) or not len(paragraph_text): # is disambiguation article or blank
+        result.snippet = disambiguation_snippet
+    else: # normal article
+        result.snippet = paragraph_text
+        if 'thumbnail' in page: # an image exists
+            result.thumbnail = page['thumbnail']['source']
+    return result
+
+# get the title batcher for a client, creating it on first use
+def get_wikipedia_batcher(client):
+    if client not in wikipedia_batchers:
+        wikipedia_batchers[client] = WikipediaBatcher(client)
+    return wikipedia_batchers[client]
+
+# collects title lookups for a short window (or until the batch is full) and resolves them
+# all with one action=query request
+class WikipediaBatcher:
+    def __init__(self, client, max_batch: int = None, max_wait: float = None):
+        self.client = client
+        self.max_batch = max_batch or wikipedia_batch_size
+        self.max_wait = max_wait if max_wait is not None else wikipedia_batch_wait
+        self.pending = {} # title -> future shared by everyone waiting on it
+        self.timer = None
+        self.tasks = set()
+
+    async def lookup(self, title: str):
+        future = self.pending.get(title)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[title] = future
+            if len(self.pending) >= self.max_batch:
+                self.flush()
+            elif self.timer is None:
+                self.timer = asyncio.get_running_loop().call_later(self.max_wait, self.flush)
+        # shield so one cancelled search doesn't cancel the lookup for others waiting on the title
+        return await asyncio.shield(future)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, {}
+        if batch:
+            task = asyncio.ensure_future(self.fetch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def fetch(self, batch: dict):
+        try:
+            pages = await query_wikipedia_titles(self.client, list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+                    future.exception() # waiters may have been cancelled, so mark it retrieved
+        else:
+            for title, future in batch.items():
+                if not future.done():
+                    future.set_result(pages.get(title))
+
+# scrape the search (or article) HTML page
+async def search_wikipedia_html(client, query: str):
+    # base_search_url works pretty well if search string is spot-on, if not shows search results
+    base_search_url = wikipedia_url + '/w/index.php?title=Special:Search&search={query}'
+
+    r = await client.get(base_search_url.format(query = urllib.parse.quote(query)), follow_redirects=True)
+
+    if 'title=Special:Search' in str(r.url): # no match, so its a search, get top two results
+        return parse_wikipedia_search(query, r.content)
+    else:
+        return parse_wikipedia_article(query, str(r.url), r.content)
+
+def parse_wikipedia_search(query: str, content):
+    from bs4 import BeautifulSoup
+    base_url = 'https://en.wikipedia.org'
+
+    results = []
+    soup = BeautifulSoup(content, 'html.parser')
+    search_results = soup.find_all('li', class_='mw-search-result')
+    for search_result in search_results[0:2]:
+        result_header_tag = search_result.css.select("div.mw-search-result-heading > a")[0]
+        result = SearchResult('Wikipedia', query, base_url + result_header_tag['href'],
+                              title=result_header_tag.get_text(),
+                              snippet=search_result.css.select("div.searchResultImage-text > div.searchresult")[0].get_text())
+        thumbnail_anchors = search_result.css.select("div.searchResultImage-thumbnail > a")
+        if len(thumbnail_anchors): # thumbnail exists
+            result.thumbnail = 'https:' + thumbnail_anchors[0].find('img')['src']
+        results.append(result)
+    return results
+
+def parse_wikipedia_article(query: str, url: str, content):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(content, 'html.parser')
+    result = SearchResult('Wikipedia', query, url, title=soup.find('h1').get_text())
+
+    # get the right paragraph to determine if this is a disambiguation article
+    real_paragraphs = soup.find_all(lambda tag: tag.name == 'p' and 'class' not in tag.attrs and len(tag.get_text().split()) > 10)
+    if real_paragraphs:
+        paragraph_text = real_paragraphs[0].get_text().strip()
+    else:
+        paragraph_text = ''
+
+    if not len(paragraph_text) or paragraph_text[-18:] == 'may also refer to:' or paragraph_text[-13:] == 'may refer to:': # is disambiguation article or blank
+        result.snippet = disambiguation_snippet
+    else: # normal article
+        result.snippet = paragraph_text
+        img_link = soup.find(lambda tag: tag.name == 'meta' and tag.has_attr('property') and tag.has_attr('content') and tag['property'] == 'og:image')
+        if img_link: # an image exists
+            result.thumbnail = img_link['content']
+
+    return [result]
+
+# get (or reuse) a Reddit app-only access token
+async def get_reddit_token(client):
+    if reddit_token['access_token'] and reddit_token['expires_at'] > time.time():
+        return reddit_token['access_token']
+
+    reddit_id = os.environ['REDDIT_USER']
+    user_agent = os.environ['REDDIT_AGENT']
+    reddit_secret = os.environ['REDDIT_KEY']
+
+    # set up for auth token request
+    auth_string = reddit_id + ':' + reddit_secret
+    encoded_auth_string = base64.b64encode(auth_string.encode('ascii')).decode('ascii')
+    auth_headers = {
+        'Authorization': 'Basic ' + encoded_auth_string,
+        'User-agent': user_agent
+    }
+    auth_data = {
+        'grant_type': 'client_credentials'
+    }
+
+    # get auth token
+    r = await client.post(reddit_auth_url + '/api/v1/access_token', headers = auth_headers, data = auth_data)
+    if r.status_code == 200 and 'access_token' in r.json():
+        body = r.json()
+        reddit_token['access_token'] = body['access_token']
+        # refresh a minute early so a token never expires mid-search
+        reddit_token['expires_at'] = time.time() + body.get('expires_in', 3600) - 60
+        return reddit_token['access_token']
+    return None
+
+# handle Reddit (after is the fullname of the last post on the previous page, for "load more")
+async def search_reddit(client, query: str, after: str = None):
+    user_agent = os.environ['REDDIT_AGENT']
+    reddit_access_token = await get_reddit_token(client)
+    if not reddit_access_token:
+        raise SearchError('Reddit', query, 'auth token failure')
+
+    results = []
+
+    # set up headers for search requests
+    headers = {
+        'Authorization': 'Bearer ' + reddit_access_token,
+        'User-agent': user_agent
+    }
+
+    # execute subreddit search
+    params = {
+        'sort': 'relevance',
+        't': 'year',
+        'limit': 4,
+        'q': query[:512],
+        'raw_json': 1 # unescaped text and URLs (the page escapes everything when it renders)
+    }
+    if after:
+        params['after'] = after
+    r = await client.get(reddit_api_url + '/search', params=params, headers=headers)
+    if r.status_code == 200:
+        body = r.json()
+        if 'data' in body and 'children' in body['data'] and len(body['data']['children']) > 0:
+            post_results = body['data']['children']
+            for post in post_results:
+                # get subreddit level details
+                subreddit_handle = post['data']['subreddit_name_prefixed'] + '/'
+                subreddit_url = 'https://www.reddit.com'+subreddit_handle
+                result = SearchResult('Reddit', query, 'https://www.reddit.com'+post['data']['permalink'],
+                                      title=post['data']['title'],
+                                      subsource=subreddit_handle,
+                                      subsource_url=subreddit_url)
+
+                # get image from Reddit blob, start with preview
+                if 'preview' in post['data'] and 'images' in post['data']['preview'] and len(post['data']['preview']['images']):
+                    result.thumbnail = clean_url(post['data']['preview']['images'][0]['source']['url'])
+                # use media_metadata if post is media gallery and pull first image in blob
+                # (its largest preview, a dict with the URL under 'u')
+                elif 'media_metadata' in post['data']:
+                    first_key = list(post['data']['media_metadata'].keys())[0]
+                    previews = post['data']['media_metadata'][first_key].get('p') or [{}]
+                    result.thumbnail = clean_url(previews[-1].get('u'))
+                # fall back to thumbnail if needed but only if thumbnail is valid ('self', 'default', etc. aren't)
+                elif 'thumbnail' in post['data']:
+                    result.thumbnail = clean_url(post['data']['thumbnail'])
+                result.snippet = post['data']['selftext'][0:1000] + ('...(more)' if len(post['data']['selftext']) else '')
+                results.append(result)
+    else:
+        raise upstream_error('Reddit', query, r)
+
+    return results
+
+# handle Podcast Search via Taddy (page counts from 1)
+async def search_podcasts(client, query: str, page: int = 1):
+    # prepare headers for querying taddy
+    taddy_user_id = os.environ['TADDY_USER']
+    taddy_secret = os.environ['TADDY_KEY']
+    headers = {
+        'Content-Type': 'application/json',
+        'X-USER-ID': taddy_user_id,
+        'X-API-KEY': taddy_secret
+    }
+    # query body for podcast search
+    queryString = """{
+  searchForTerm(
+    term: """
+    queryString += '"' + query + '"\n'
+    queryString += """
+    filterForTypes: PODCASTEPISODE
+    searchResultsBoostType: BOOST_POPULARITY_A_LOT
+    limitPerPage: 3
+    page: """ + str(int(page)) + """
+  ) {
+    searchId
+    podcastEpisodes {
+      uuid
+      name
+      subtitle
+      websiteUrl
+      audioUrl
+      imageUrl
+      description
+      podcastSeries {
+        uuid
+        name
+        imageUrl
+        websiteUrl
+      }
+    }
+  }
+}
+"""
+    # make the graphQL request and parse the JSON body
+    r = await client.post(taddy_url, headers=headers, json={'query': queryString})
+    if r.status_code != 200:
+        raise upstream_error('Podcast', query, r)
+    else:
+        responseBody = r.json()
+        if 'errors' in responseBody:
+            raise SearchError('Podcast', query, 'authentication issue with Taddy')
+        else:
+            episodes = responseBody['data']['searchForTerm']['podcastEpisodes']
+            results = []
+            for episode in episodes:
+                if episode['websiteUrl'] and episode['websiteUrl'] != episode['podcastSeries']['websiteUrl']:
+                    url = episode['websiteUrl']
+                else:
+                    url = episode['audioUrl']
+                result = SearchResult('Podcast', query, url,
+                                      title=episode['name'],
+                                      subsource=episode['podcastSeries']['name'],
+                                      subsource_url=episode['podcastSeries']['websiteUrl'])
+
+                if episode['subtitle']:
+                    result.snippet = episode['subtitle'][0:1000] + ('...(more)' if len(episode['subtitle']) else '')
+                elif episode['description']:
+                    result.snippet = episode['description'][0:1000] + ('...(more)' if len(episode['description']) else '')
+
+                if episode['imageUrl']:
+                    result.thumbnail = episode['imageUrl']
+                elif episode['podcastSeries']['imageUrl']:
+                    result.thumbnail = episode['podcastSeries']['imageUrl']
+                results.append(result)
+
+    return results
+
+# handle Image Vector Search (no HTTP client needed, the results come back as SearchResults)
+# offset skips that many of the nearest matches, for "load more"
+async def search_vector(client, query: str, num_matches: int = 10, offset: int = 0):
+    if offset:
+        return await get_vector_model().query.remote.aio(query, num_matches, trace=tracing.context(), offset=offset)
+    return await get_vector_model().query.remote.aio(query, num_matches, trace=tracing.context())
+
+# handle Unsplash Search (page counts from 1)
+async def search_unsplash(client, query: str, num_matches: int = 10, page: int = 1):
+    # set up and make request
+    unsplash_client = os.environ['UNSPLASH_ACCESS']
+
+    headers = {
+        'Authorization': 'Client-ID ' + unsplash_client,
+        'Accept-Version': 'v1'
+    }
+    params = {
+        'page': page,
+        'per_page': num_matches,
+        'query': query
+    }
+    r = await client.get(unsplash_url + '/search/photos', params=params, headers=headers)
+
+    # check if request is good
+    if r.status_code == 200:
+        results = []
+        body = r.json()
+        # convert to result format
+        for image_result in body['results']:
+            result = SearchResult('Unsplash', query, image_result['links']['html'],
+                                  snippet=image_result['description'] or '',
+                                  thumbnail=image_result['urls']['regular'],
+                                  subsource=image_result['user']['username'],
+                                  subsource_url=image_result['user']['links']['html'])
+            results.append(result)
+
+        return results
+    else:
+        raise upstream_error('Unsplash', query, r)
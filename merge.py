@@ -0,0 +1,163 @@
+# merge stage for search results: takes each search's results as it finishes, drops duplicates with
+# set lookups on normalized URLs (and thumbnails), and orders what's left with a deterministic
+# weighted round-robin across sources so no single engine crowds the top of the page
+import functools
+import itertools
+import operator
+import urllib.parse
+
+from search_result import SearchBatch
+
+# query params that only track where a click came from, never part of a page's identity
+TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'igshid', 'mc_cid', 'mc_eid',
+                   'ref', 'ref_src', 'ref_url', 'share_id', 'si', 'spm', '_ga'}
+TRACKING_PREFIXES = ('utm_',)
+
+# results per round-robin turn for each source (unlisted sources get 1)
+SOURCE_WEIGHTS = {
+    'Wikipedia': 1,
+    'Reddit': 1,
+    'Podcast': 1,
+    'Unsplash': 1,
+    'Image Vector Search': 1,
+}
+
+# sources whose thumbnails mark duplicates (Reddit crossposts share an image); podcast episodes
+# fall back to their series art, so those are expected to repeat
+THUMBNAIL_SOURCES = {'Reddit'}
+
+def is_tracking_param(name: str):
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+# dedup key for a URL: scheme, 'www.', fragment, trailing slash, and tracking params don't matter,
+# the remaining params are sorted (or dropped entirely with keep_query=False)
+# cached, since the same results come back from the result cache request after request
+@functools.lru_cache(maxsize=8192)
+def normalize_url(url: str, keep_query: bool = True):
+    url = url.strip()
+    if not keep_query:
+        url = url.partition('#')[0].partition('?')[0]
+    # fast path for plain scheme://host/path URLs, skipping urlsplit (same key as split_key gives them)
+    scheme, separator, rest = url.partition('://')
+    host, _, path = rest.partition('/')
+    if separator and host and scheme.isalpha() and '?' not in url and '#' not in url \
+            and '@' not in host and ':' not in host and '[' not in host \
+            and '\t' not in url and '\n' not in url and '\r' not in url:
+        host = host.lower()
+        if host.startswith('www.'):
+            host = host[4:]
+        return host + (('/' + path).rstrip('/') or '/')
+    return split_key(url, keep_query)
+
+def split_key(url: str, keep_query: bool = True):
+    try:
+        parts = urllib.parse.urlsplit(url)
+        host = parts.hostname or ''
+        port = parts.port
+    except ValueError: # not a URL we can take apart, so compare it as-is
+        return url
+    if host.startswith('www.'):
+        host = host[4:]
+    if port and port not in (80, 443):
+        host += ':' + str(port)
+    path = parts.path.rstrip('/') or '/'
+
+    key = host + path
+    if keep_query:
+        params = [(name, value) for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+                  if not is_tracking_param(name)]
+        if params:
+            key += '?' + urllib.parse.urlencode(sorted(params))
+    return key
+
+# dedup key for a thumbnail: resized copies of the same image share a key
+@functools.lru_cache(maxsize=8192)
+def thumbnail_key(url: str):
+    key = normalize_url(url.replace('&amp;', '&'), keep_query=False)
+    host, _, path = key.partition('/')
+    # Wikimedia: commons/thumb/a/ab/File.jpg/640px-File.jpg is a resize of commons/a/ab/File.jpg
+    if host == 'upload.wikimedia.org' and '/thumb/' in '/' + path:
+        path = ('/' + path).replace('/thumb/', '/', 1).rsplit('/', 1)[0][1:]
+    # Reddit serves the same upload from i.redd.it and preview.redd.it
+    elif host in ('i.redd.it', 'preview.redd.it'):
+        host = 'redd.it'
+    return host + '/' + path
+
+# sort key for a merger's (rank, result) entries
+first = operator.itemgetter(0)
+
+class ResultMerger:
+    def __init__(self, weights: dict = None, thumbnail_sources=None):
+        self.weights = dict(SOURCE_WEIGHTS)
+        self.weights.update(weights or {})
+        self.thumbnail_sources = set(thumbnail_sources) if thumbnail_sources is not None else THUMBNAIL_SOURCES
+        self.seen_urls = set()
+        self.seen_thumbnails = set()
+        self.sources = {} # source -> [(rank, result)] in accepted order
+        self.accepted = 0
+
+    def __len__(self):
+        return self.accepted
+
+    # add one search's results (best first), returning the new, non-duplicate ones in that order
+    # so a streaming page can send them right away; a result is kept unless its URL (or a tracked
+    # thumbnail) was already seen
+    def add(self, results: list):
+        accepted = []
+        seen_urls, seen_thumbnails, thumbnail_sources = self.seen_urls, self.seen_thumbnails, self.thumbnail_sources
+        source = entries = None # a search's results usually share a source
+        for rank, result in enumerate(results or ()):
+            if not result.url:
+                continue
+            url = normalize_url(result.url)
+            if url in seen_urls:
+                continue
+            if result.thumbnail:
+                thumbnail = thumbnail_key(result.thumbnail)
+                if thumbnail in seen_thumbnails:
+                    continue
+                if result.source in thumbnail_sources:
+                    seen_thumbnails.add(thumbnail)
+            seen_urls.add(url)
+            if result.source != source:
+                source = result.source
+                entries = self.sources.setdefault(source, [])
+            entries.append((rank, result))
+            accepted.append(result)
+        self.accepted += len(accepted)
+        return accepted
+
+    # every accepted result for the full page: each source's results by rank within their search
+    # (so the top result of every sub-query comes before any second result), then a weighted
+    # round-robin across sources in the order they first answered
+    def ordered(self):
+        weights = [max(1, self.weights.get(source, 1)) for source in self.sources]
+        # sorted is stable, so equal ranks keep their accepted order
+        columns = [[result for _, result in sorted(entries, key=first)] for entries in self.sources.values()]
+        chunked = max(weights, default=1) > 1
+        if chunked: # each source's turn takes up to its weight in results
+            columns = [[results[start:start + weight] for start in range(0, len(results), weight)]
+                       for weight, results in zip(weights, columns)]
+        # a turn for every source still holding results, in order
+        merged = [item for turn in itertools.zip_longest(*columns) for item in turn if item is not None]
+        return [result for chunk in merged for result in chunk] if chunked else merged
+
+# merge search result arrays into one ordered, deduplicated list
+def merge_results(result_arrays, weights: dict = None):
+    merger = ResultMerger(weights)
+    for results in result_arrays:
+        merger.add(results)
+    return merger.ordered()
+
+# merge SearchBatches into one SearchBatch of the ordered results, every error, and the engines
+# that timed out (each named once)
+def merge_batches(batches, weights: dict = None):
+    merger = ResultMerger(weights)
+    errors = []
+    timeouts = []
+    for batch in batches:
+        merger.add(batch.results)
+        errors += batch.errors
+        timeouts += [engine for engine in batch.timeouts if engine not in timeouts]
+    return SearchBatch(merger.ordered(), errors, tuple(timeouts))
@@ -0,0 +1,136 @@
+# "load more" cursors: the planned sub-queries of a results page and the next page to ask each engine for
+# a cursor is opaque to the page (compressed, URL-safe JSON) and holds [response, options] pairs, where
+# options are the engine search function's paging arguments for its next page:
+#   Wikipedia: offset (into the search results) and exclude (the title of the article a first page found by
+#   exact title, which also turns up in the search results), Reddit: after (the last post's fullname),
+#   Podcast: page (Taddy's page), Unsplash: page, Vector: offset (into the nearest matches)
+# the plan travels in the cursor, so more pages never call OpenAI; sub-queries whose last page came
+# back short are left out, and ones that failed or timed out are retried with the same page (for a
+# first page, options {}, so it's asked for just as the results page did)
+import json
+import zlib
+import base64
+
+# results on a full page, per engine (a shorter page means there's nothing after it)
+PAGE_SIZES = {
+    'Wikipedia': 2,
+    'Reddit': 4,
+    'Podcast': 3,
+    'Unsplash': 10,
+    'Vector': 10,
+}
+
+# paging options each engine takes, with the largest value a cursor may carry
+PAGE_OPTIONS = {
+    'Wikipedia': {'offset': 100, 'exclude': 255}, # title length
+    'Reddit': {'after': 16}, # fullname length
+    'Podcast': {'page': 20}, # Taddy's cap
+    'Unsplash': {'page': 100},
+    'Vector': {'offset': 1000},
+}
+
+# options holding text (their PAGE_OPTIONS value is the longest allowed), the rest are ints
+TEXT_OPTIONS = {'after', 'exclude'}
+
+# most sub-queries a cursor can carry, so a crafted one can't fan out without bound
+MAX_PAGES = 24
+
+# engine name for a result's source (most engines tag results with their own name)
+SOURCE_ENGINES = {'Image Vector Search': 'Vector'}
+
+# paging options for the page after this one, or None if this was the last page
+def next_options(engine: str, options: dict, results: list):
+    if not results or (len(results) < PAGE_SIZES[engine] and (engine != 'Wikipedia' or options)):
+        return None # (the first Wikipedia page can be a single article that matched the title)
+    if engine == 'Reddit':
+        # a listing's after is the fullname (t3_ + id) of its last post, which is in the permalink
+        parts = results[-1].url.split('/comments/')
+        return {'after': 't3_' + parts[1].split('/')[0]} if len(parts) == 2 else None
+    elif engine == 'Wikipedia':
+        options = wikipedia_options(options, results)
+    elif engine == 'Vector':
+        options = {'offset': options.get('offset', 0) + len(results)}
+    else:
+        options = {'page': options.get('page', 1) + 1}
+    # as deep as a cursor can go
+    return options if all(name in TEXT_OPTIONS or value <= PAGE_OPTIONS[engine][name]
+                          for name, value in options.items()) else None
+
+# Wikipedia's next options: a single-article first page was an exact-title hit, so the search results
+# start from the top with that article left out by title; while it's excluded a page asks for one
+# extra result and drops it if it's there, so a full page (one over PAGE_SIZES) means it's still ahead
+def wikipedia_options(options: dict, results: list):
+    size = PAGE_SIZES['Wikipedia']
+    if not options and len(results) < size:
+        return {'offset': 0, 'exclude': results[0].title}
+    if 'exclude' not in options:
+        return {'offset': options.get('offset', 0) + len(results)}
+    offset = options['offset'] + size + 1
+    return {'offset': offset, 'exclude': options['exclude']} if len(results) > size else {'offset': offset}
+
+# pages to ask for after a first results page, from its batches (sub-queries with no results are done,
+# ones that failed or timed out start again from their first page)
+def first_pages(batches):
+    found = {}
+    unanswered = []
+    for batch in batches:
+        for result in batch.results:
+            engine = SOURCE_ENGINES.get(result.source, result.source)
+            if engine in PAGE_SIZES:
+                found.setdefault(engine + ': ' + result.query, []).append(result)
+        unanswered += [response for response in batch.unanswered
+                       if response.split(': ')[0] in PAGE_SIZES and response not in unanswered]
+    pages = []
+    for response, results in found.items():
+        options = next_options(response.split(': ')[0], {}, results)
+        if options is not None:
+            pages.append([response, options])
+    pages += [[response, {}] for response in unanswered if response not in found]
+    return pages[:MAX_PAGES]
+
+# pages to ask for after fetching pages, given {response: SearchBatch} for what came back
+def advance(pages: list, batches: dict):
+    next_pages = []
+    for response, options in pages:
+        batch = batches.get(response)
+        if batch is None or batch.errors or batch.timeouts: # try the same page again next time
+            next_pages.append([response, options])
+            continue
+        options = next_options(response.split(': ')[0], options, batch.results)
+        if options is not None:
+            next_pages.append([response, options])
+    return next_pages
+
+def encode_cursor(topic: str, pages: list):
+    data = json.dumps({'topic': topic, 'pages': pages}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(zlib.compress(data, 9)).decode('ascii').rstrip('=')
+
+# the topic and pages in a cursor, raising ValueError for anything a page couldn't have produced
+def decode_cursor(cursor: str):
+    try:
+        # capped, so a crafted cursor can't inflate into something huge
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)), 65536)
+        if not decompressor.eof: # cut short (checksum missing) or too big
+            raise ValueError('incomplete')
+        body = json.loads(data)
+        topic, pages = body['topic'], body['pages']
+    except Exception as e:
+        raise ValueError('unreadable cursor: ' + repr(e))
+    if not isinstance(topic, str) or not isinstance(pages, list) or len(pages) > MAX_PAGES:
+        raise ValueError('bad cursor')
+    for page in pages:
+        if not isinstance(page, list) or len(page) != 2 or not isinstance(page[0], str) or not isinstance(page[1], dict):
+            raise ValueError('bad cursor page')
+        engine, _, query = page[0].partition(': ')
+        allowed = PAGE_OPTIONS.get(engine)
+        if allowed is None or not query or set(page[1]) - set(allowed):
+            raise ValueError('bad cursor page: ' + page[0][:40])
+        for name, value in page[1].items():
+            if name in TEXT_OPTIONS:
+                valid = isinstance(value, str) and len(value) <= allowed[name]
+            else:
+                valid = type(value) is int and 0 <= value <= allowed[name]
+            if not valid:
+                raise ValueError('bad cursor option: ' + name)
+    return topic, pages
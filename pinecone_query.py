@@ -1,8 +1,24 @@
-from modal import Image, App, Secret, method, enter
+# startup profiler first, so its import timer sees everything below; it's a local source, which
+# the image build (running download_models) doesn't have yet
+try:
+    import startup
+    profiled = startup.profiled
+    timed = startup.timed
+except ImportError:
+    import contextlib
+    profiled = lambda function: function
+    timed = lambda phase: contextlib.nullcontext()
+
+from modal import Image, App, Secret, Volume, method, enter, concurrent
+import modal
+import asyncio
+import time
+import os
 
 # define Image for embedding text queries and hitting Pinecone
 # use Modal initiation trick to preload model weights
 cache_path = '/pycache/clip-ViT-B-32' # cache for CLIP model 
+text_encoder_path = '/pycache/clip-ViT-B-32-text' # text tower + projection only, loaded by clip_text.py
 def download_models():
     import sentence_transformers 
 
@@ -14,72 +30,281 @@ def download_models():
     )
     model.save(path=cache_path)
 
+    # export the text half on its own as safetensors, since queries never touch the image tower
+    # (the Hugging Face CLIP model sits in the 0_CLIPModel folder of the sentence-transformers repo)
+    import transformers
+    clip = transformers.CLIPModel.from_pretrained(model_id, subfolder='0_CLIPModel')
+    text_tower(clip).save_pretrained(text_encoder_path, safe_serialization=True)
+    transformers.CLIPTokenizerFast.from_pretrained(model_id, subfolder='0_CLIPModel').save_pretrained(text_encoder_path)
+
+# CLIPTextModelWithProjection holding a CLIPModel's text encoder and projection
+def text_tower(clip):
+    import transformers
+
+    text_config = clip.config.text_config
+    text_config.projection_dim = clip.config.projection_dim
+    text_model = transformers.CLIPTextModelWithProjection(text_config)
+    text_model.text_model.load_state_dict(clip.text_model.state_dict())
+    text_model.text_projection.load_state_dict(clip.text_projection.state_dict())
+    return text_model.eval()
+
 image = (
     Image.debian_slim(python_version='3.10')
     .pip_install('sentence_transformers')
     .run_function(download_models)
     .pip_install('pinecone-client')
+    .add_local_python_source('clip_text', 'embedding_cache', 'search_result', 'startup', 'tracing', 'vector_store')
 )
 app = App('text-pinecone-query', image=image)
 
+# persistent CLIP text embedding cache, shared by every container through a Volume
+embedding_cache_path = '/embedding-cache'
+embedding_volume = Volume.from_name('clip-embedding-cache', create_if_missing=True)
+
+# local vector store (used instead of Pinecone when VECTOR_STORE=local), see vector_store.py
+vector_store_path = '/vector-store'
+local_store_path = vector_store_path + '/savee'
+vector_store_volume = Volume.from_name('image-vector-store', create_if_missing=True)
+
+# warm pool: keep VECTOR_MIN_CONTAINERS containers (with CLIP loaded) up at all times and idle ones
+# around for scaledown_window seconds, so metasearch's Vector searches don't pay for a cold start
+vector_min_containers = int(os.environ.get('VECTOR_MIN_CONTAINERS', '1'))
+vector_scaledown_window = 600
+
+# collect concurrent encode requests for a few ms (or until max_batch) and encode them in one call
+# so concurrent queries share the CPU matrix multiplies instead of encoding one string at a time
+class MicroBatcher:
+    def __init__(self, encode, max_batch: int = 32, max_wait: float = 0.005):
+        self.encode = encode # takes a list of strings, returns a vector per string
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = [] # (text, future) waiting for the next batch
+        self.timer = None
+        self.tasks = set()
+
+    async def submit(self, text: str):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((text, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self.run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self, batch: list):
+        try:
+            # encode off the event loop so new requests keep queueing up for the next batch
+            vectors = await asyncio.to_thread(self.encode, [text for text, future in batch])
+        except Exception as e:
+            for text, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (text, future), vector in zip(batch, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+# convert Pinecone matches to the format expected (SearchResults, like Dispatcher.fetch returns, so
+# they cross back to metasearch as one blob)
+def to_results(query: str, pinecone_results):
+    from search_result import SearchResult, SearchResults, clean_url
+
+    results = []
+    for match in pinecone_results['matches']:
+        if 'original_url' in match['metadata'] and \
+            len(match['metadata']['original_url'].strip()) > 7:
+            
+            url = match['metadata']['original_url']
+        else:
+            url = match['metadata']['source_page_url']
+
+        results.append(SearchResult('Image Vector Search', query, url,
+                                    snippet=match['metadata']['caption'],
+                                    thumbnail=clean_url(match['metadata']['source_image_url']),
+                                    subsource='Savee',
+                                    subsource_url=match['metadata']['source_page_url']))
+    
+    return SearchResults(results)
+
 # use Modal's class entry trick to speed up initiation
-@app.cls(secrets=[Secret.from_name('pinecone_secret')])
+# concurrent inputs let the micro-batcher group queries arriving at the same time
+# metasearch looks this class up by name (engines.get_vector_model) and calls query for 'Vector:' searches
+@app.cls(secrets=[Secret.from_name('pinecone_secret')],
+         volumes={embedding_cache_path: embedding_volume,
+                  vector_store_path: vector_store_volume},
+         min_containers=vector_min_containers,
+         scaledown_window=vector_scaledown_window)
+@concurrent(max_inputs=64)
 class TextEmbeddingModel:
+    # each pool value gets its own containers; metasearch uses the default (warm) pool, and
+    # latency_report uses throwaway pools to measure cold starts
+    pool: str = modal.parameter(default='default')
+
     @enter()
     def enter(self):
-        import sentence_transformers
-        model = sentence_transformers.SentenceTransformer(cache_path, 
-                                                          device='cpu')
+        # text-only encoder by default (CLIP_ENCODER=full loads the whole SentenceTransformer)
+        import clip_text
+        with timed('load CLIP'):
+            model = clip_text.load_encoder(cache_path, text_encoder_path)
         self.model = model 
+        self.batcher = MicroBatcher(self.encode, max_batch=32, max_wait=0.005)
 
-        from pinecone import Pinecone
-        import os 
-        pc = Pinecone(api_key=os.environ['PINECONE_API_KEY'])
-        self.pinecone_index = pc.Index(os.environ['PINECONE_INDEX'])
-    
-    @method()
-    def query(self, query: str, num_matches = 10):
-        # embed the query 
-        vector = self.model.encode(query)
+        # map the embedding cache's shards (pages are shared by every container on this host)
+        from embedding_cache import EmbeddingCache
+        self.embedding_cache = EmbeddingCache(embedding_cache_path, 
+                                              dim=model.get_sentence_embedding_dimension())
+
+        # Pinecone, or the local store when VECTOR_STORE=local
+        import vector_store
+        with timed('open vector store'):
+            self.vector_store = vector_store.open_store(local_path=local_store_path)
 
-        # run the resulting vector through Pinecone
-        pinecone_results = self.pinecone_index.query(vector=vector.tolist(), 
-                                   top_k=num_matches, 
+    # persist new cache entries for the next containers (this container's shard is the only file it
+    # writes, so concurrent commits from other containers keep theirs)
+    @modal.exit()
+    def exit(self):
+        self.embedding_cache.flush()
+        embedding_volume.commit()
+
+    # embed a list of queries in a single encode call
+    def encode(self, queries: list, batch_size: int = 32):
+        start = time.perf_counter()
+        vectors = self.model.encode(queries, batch_size=batch_size)
+        self.embedding_cache.record_encode(len(queries), time.perf_counter() - start)
+        return vectors
+
+    # run a vector through the vector store (offset skips that many nearest matches: neither store
+    # pages, so it asks for offset + num_matches and drops the first offset)
+    def search(self, query: str, vector, num_matches: int = 10, offset: int = 0):
+        pinecone_results = self.vector_store.query(vector, 
+                                   top_k=offset + num_matches, 
                                    include_metadata=True
                                    )
-        
-        # convert to format expected
-        results = []
-        for match in pinecone_results['matches']:
-            matchDict = {
-                'query': query,
-                'source': 'Image Vector Search',
-                'subsource': 'Savee',
-                'subsource_url': match['metadata']['source_page_url'],
-                'thumbnail': match['metadata']['source_image_url'],
-                'title': '',
-                'snippet':match['metadata']['caption']
-            }
-            if 'original_url' in match['metadata'] and \
-                len(match['metadata']['original_url'].strip()) > 7:
-                
-                matchDict['url'] = match['metadata']['original_url']
+        if offset:
+            pinecone_results = {'matches': pinecone_results['matches'][offset:]}
+        return to_results(query, pinecone_results)
+    
+    # trace is the calling span's context when metasearch traces the request (see tracing.py)
+    @method()
+    @profiled
+    async def query(self, query: str, num_matches = 10, trace: dict = None, offset: int = 0):
+        import tracing
+
+        with tracing.span('vector_query', parent=trace, query=query):
+            # embed the query (batched with any other queries arriving at the same time)
+            vector = self.embedding_cache.get(query)
+            if vector is None:
+                with tracing.span('clip_encode'):
+                    vector = await self.batcher.submit(query)
+                self.embedding_cache.put(query, vector)
             else:
-                matchDict['url'] = match['metadata']['source_page_url']
+                tracing.annotate(embedding_cached=True)
+
+            # run the resulting vector through Pinecone
+            with tracing.span('vector_store'):
+                return await asyncio.to_thread(self.search, query, vector, num_matches, offset)
+
+    # embed many queries in one encode call and run their Pinecone searches concurrently
+    @method()
+    async def query_batch(self, queries: list, num_matches = 10, batch_size = 32):
+        vectors = [self.embedding_cache.get(query) for query in queries]
+        misses = [i for i, vector in enumerate(vectors) if vector is None]
+        if misses:
+            encoded = await asyncio.to_thread(self.encode, [queries[i] for i in misses], batch_size)
+            for i, vector in zip(misses, encoded):
+                vectors[i] = vector
+                self.embedding_cache.put(queries[i], vector)
+
+        # a local exact store scores every query in one matrix multiply
+        if hasattr(self.vector_store, 'query_batch') and not self.vector_store.approximate:
+            matches = await asyncio.to_thread(self.vector_store.query_batch, vectors, num_matches)
+            return [to_results(query, pinecone_results) for query, pinecone_results in zip(queries, matches)]
+        return list(await asyncio.gather(*[asyncio.to_thread(self.search, query, vector, num_matches)
+                                           for query, vector in zip(queries, vectors)]))
+
+    # hit rate and encode time saved by the embedding cache in this container
+    @method()
+    def embedding_cache_stats(self):
+        return self.embedding_cache.report()
+
+# copy every vector and its metadata out of Pinecone into the local vector store
+@app.function(secrets=[Secret.from_name('pinecone_secret')],
+              volumes={vector_store_path: vector_store_volume},
+              timeout=3600)
+def export_local_store(ivf: bool = True):
+    import os
+    from pinecone import Pinecone
+    from vector_store import LocalVectorStore
+
+    index = Pinecone(api_key=os.environ['PINECONE_API_KEY']).Index(os.environ['PINECONE_INDEX'])
+    ids, vectors, metadata = [], [], []
+    for id_batch in index.list():
+        fetched = index.fetch(ids=id_batch)
+        for id, record in fetched.vectors.items():
+            ids.append(id)
+            vectors.append(record.values)
+            metadata.append(record.metadata)
+
+    LocalVectorStore.build(local_store_path, vectors, metadata, ids, ivf=ivf)
+    vector_store_volume.commit()
+    return len(ids)
+
+def latency_summary(latencies: list):
+    latencies = sorted(latencies)
+    pick = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    return f'p50 {pick(0.5):8.1f} ms  p95 {pick(0.95):8.1f} ms  max {latencies[-1] * 1000:8.1f} ms'
+
+# compare image vector query latency on a cold container (fresh pool, CLIP loads first) with the warm pool
+# usage: modal run pinecone_query.py::latency_report --cold 3 --warm 20
+@app.local_entrypoint()
+def latency_report(cold: int = 3, warm: int = 20, prompt: str = 'Mountain sunset'):
+    import uuid
+
+    run_id = uuid.uuid4().hex[:8] # fresh prompts every run, so the persistent embedding cache doesn't help
+    cold_latencies = []
+    for i in range(cold):
+        model = TextEmbeddingModel(pool='cold-' + uuid.uuid4().hex[:8])
+        model.update_autoscaler(min_containers=0, scaledown_window=2) # don't keep throwaway pools warm
+        start = time.perf_counter()
+        model.query.remote(prompt + ' ' + run_id + ' cold ' + str(i))
+        cold_latencies.append(time.perf_counter() - start)
+
+    model = TextEmbeddingModel()
+    model.query.remote(prompt) # make sure a warm container is up before timing
+    warm_latencies = []
+    for i in range(warm):
+        start = time.perf_counter()
+        model.query.remote(prompt + ' ' + run_id + ' warm ' + str(i))
+        warm_latencies.append(time.perf_counter() - start)
 
-            results.append(matchDict)
-        
-        return results
+    print('cold:', latency_summary(cold_latencies), f'({cold} queries)')
+    print('warm:', latency_summary(warm_latencies), f'({warm} queries)')
+    print(f'cold start adds {(sorted(cold_latencies)[len(cold_latencies) // 2] - sorted(warm_latencies)[len(warm_latencies) // 2]) * 1000:.0f} ms at the median')
 
 # local entrypoint to test
 @app.local_entrypoint()
-def entry(prompt: str = "Mountain Sunset"):
+def entry(prompt: str = "Mountain Sunset", stats: bool = False):
     print('Prompt:', prompt)
     emb = TextEmbeddingModel()
     results = emb.query.remote(prompt)
+    if stats:
+        for key, value in emb.embedding_cache_stats.remote().items():
+            print(key + ':', value)
+        print('')
     for result in results:
-        print('URL:', result['url'])
-        print('Subsource:', result['subsource_url'])
-        print('Image:', result['thumbnail'])
-        print('Caption:', result['snippet'])
+        print('URL:', result.url)
+        print('Subsource:', result.subsource_url)
+        print('Image:', result.thumbnail)
+        print('Caption:', result.snippet)
         print('')
\ No newline at end of file
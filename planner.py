@@ -0,0 +1,488 @@
+# LLM planner: turn a user topic into engine-specific sub-queries like 'Reddit: some query'
+# two_call is the original chain (classify visual vs text, then ask for queries); one_call merges
+# both steps into a single JSON-mode completion. Plans are cached by the topic's content words, so
+# reworded topics (reordered, pluralized, filler words added or dropped) reuse an existing plan too,
+# with a near-duplicate lookup on local word embeddings for paraphrases the key misses (misspellings,
+# other word forms).
+import re
+import json
+import math
+import time
+import zlib
+import asyncio
+import weakref
+
+import coalesce
+import rate_limit
+import result_cache
+import tracing
+from search_result import Throttled
+
+model = 'gpt-3.5-turbo' # using GPT 3.5 turbo model
+
+# message templates with (some) prompt engineering
+system_message = """Act as my assistant who's job is to help me understand and derive inspiration around a topic I give you.  Your primary job is to help find the best images, content, and online resources for me. Assume I have entered a subject into a command line on a website and do not have the ability to provide you with follow-up context.
+
+Your first step is to determine what sort of content and resources would be most valuable. For topics such as "wedding dresses" and "beautiful homes" and "brutalist architecture", I am likely to want more visual image content as these topics are design oriented and people tend to want images to understand or derive inspiration. For topics, such as "home repair" and "history of Scotland" and "how to start a business", I am likely to want more text and link content as these topics are task-oriented and people tend to want authoritative information or answers to questions."""
+initial_prompt_template = 'I am interested in the topic:\n{topic}\n\nAm I more interested in visual content or text and link based content? Select the best answer between the available options, even if it is ambiguous. Start by stating the answer to the question plainly. Do not provide the links or resources. That will be addressed in a subsequent question.'
+text_template = 'You have access to three search engines.\n\nThe first will directly query Wikipedia. The second will surface interesting posts on Reddit based on keyword matching with the post title and text. The third will surface podcast episodes based on keyword matching.\n\nQueries to Wikipedia should be fairly direct so as to maximize the likelihood that something relevant will be returned. Queries to the Reddit and podcast search engines should be specific and go beyond what is obvious and overly broad to surface the most interesting posts and podcasts.\n\nWhat are 2 queries that will yield the most interesting Wikipedia posts, 3 queries that will yield the most valuable Reddit posts, and 3 queries surface that will yield the most insightful and valuable podcast episodes about:\n{topic}\n\nProvide the queries in a numbered list with quotations around the entire query and brackets around which search engine they\'re intended for (for example: 1. [Reddit] "Taylor Swift relationships". 2. [Podcast] "Impact of Taylor Swift on Music". 3. [Wikipedia] "Taylor Swift albums").'
+image_template = 'You have access to a the free stock photo site Unsplash. There will be a good breadth of photos but the key will be trying to find the highest quality images. You also have access to Vector, an image search over a curated collection of design inspiration that matches images to the meaning of a description, so its queries should describe what the ideal image looks like.\n\nWhat are 3 great queries to use that will provide good visual inspiration and be different enough from one another so as to provide a broad range of relevant images from Unsplash to get the highest quality images, and 2 descriptions for Vector, on the topic of:\n{topic}\n\nProvide the queries in a numbered list with quotations around the entire query and "[Unsplash]" or "[Vector]" before the quotation to make it clear thats the intended search engine (for example: 1. [Unsplash] "Wildlife on a mountain top at sunset". 2. [Unsplash] "High quality capture of mountain top at sunset". 3. [Vector] "Warm light over a quiet mountain ridge".)'
+one_call_template = 'I am interested in the topic:\n{topic}\n\nFirst decide whether I am more interested in visual content or text and link based content, selecting the best answer even if it is ambiguous.\n\nIf visual content: you have access to the free stock photo site Unsplash, and to Vector, an image search over a curated collection of design inspiration that matches images to the meaning of a description. Provide 3 great Unsplash queries that will provide good visual inspiration and be different enough from one another to give a broad range of the highest quality images, and 2 Vector queries that describe what the ideal image looks like.\n\nIf text and link based content: you have access to three search engines. Wikipedia is queried directly, so its queries should be fairly direct. Reddit surfaces posts and Podcast surfaces podcast episodes by keyword matching, so their queries should be specific and go beyond what is obvious and overly broad. Provide 2 Wikipedia queries, 3 Reddit queries, and 3 Podcast queries.\n\nRespond with only a JSON object of the form {{"content": "visual" or "text", "queries": [{{"engine": "Unsplash", "Vector", "Wikipedia", "Reddit", or "Podcast", "query": "the query"}}]}}.'
+
+# engines each content type is allowed to use
+content_engines = {
+    'visual': ['Unsplash', 'Vector'],
+    'text': ['Wikipedia', 'Reddit', 'Podcast']
+}
+
+# how long a cached plan stays fresh
+PLAN_TTL = 24 * 3600
+
+# build the opening messages (system prompt + user prompt)
+def build_messages(prompt: str):
+    messages = []
+    # add system message
+    if 'gpt-4' not in model: # only gpt-4 and beyond have 'system' message
+        messages.append({
+            'role': 'user',
+            'content': system_message
+        })
+    else:
+        messages.append({
+            'role': 'system',
+            'content': system_message
+        })
+    messages.append({
+        'role': 'user',
+        'content': prompt
+    })
+    return messages
+
+# use regex to parse GPT's recommended queries
+def parse_queries(content: str):
+    return [engine + ': ' + query for engine, query in re.findall(r'[0-9]+. \[(\w+)\] "(.*)"', content)]
+
+# first step of the original chain: classify the topic as visual or text and link content
+# returns the messages for the followup call plus any responses decided already
+async def classify(client, topic: str):
+    messages = build_messages(initial_prompt_template.format(topic=topic))
+
+    # get initial response
+    with tracing.span('openai', step='classify'):
+        response = await client.chat.completions.create(
+            model=model,
+            messages = messages,
+            temperature = 1.0
+        )
+    messages.append({
+        'role': 'assistant',
+        'content': response.choices[0].message.content
+    })
+
+    # chain decision: decide based on response what to do
+    responses = [] # aggregate list of actions to take
+    if 'text and link' in response.choices[0].message.content.lower():
+        # get good wikipedia, reddit, and podcast queries
+        messages.append({
+            'role': 'user',
+            'content': text_template.format(topic=topic)
+        })
+    else:
+        # Wikipedia one-shot the query to add some additional text-based context
+        responses.append('Wikipedia: ' + topic)
+
+        # get good image search queries
+        messages.append({
+            'role': 'user',
+            'content': image_template.format(topic=topic)
+        })
+    return messages, responses
+
+# original two-step chain: classify the topic, then ask for queries for the right engines
+async def plan_two_call(client, topic: str):
+    messages, responses = await classify(client, topic)
+
+    # make followup call to OpenAI
+    with tracing.span('openai', step='queries'):
+        response = await client.chat.completions.create(
+            model=model,
+            messages = messages,
+            temperature = 1.0
+        )
+
+    return responses + parse_queries(response.choices[0].message.content)
+
+# merged chain: one JSON-mode call returns both the content type and the queries
+async def plan_one_call(client, topic: str):
+    with tracing.span('openai', step='one_call'):
+        response = await client.chat.completions.create(
+            model=model,
+            messages = build_messages(one_call_template.format(topic=topic)),
+            temperature = 1.0,
+            response_format = {'type': 'json_object'}
+        )
+    try:
+        plan = json.loads(response.choices[0].message.content)
+    except json.JSONDecodeError:
+        # fall back to the numbered-list format in case the model ignored JSON mode
+        return parse_queries(response.choices[0].message.content)
+
+    content = 'visual' if plan.get('content') == 'visual' else 'text'
+    responses = []
+    if content == 'visual':
+        # Wikipedia one-shot the query to add some additional text-based context
+        responses.append('Wikipedia: ' + topic)
+    for item in plan.get('queries', []):
+        if type(item) == dict and item.get('engine') in content_engines[content] and item.get('query'):
+            responses.append(item['engine'] + ': ' + item['query'])
+    return responses
+
+# incremental parser for the numbered '1. [Engine] "query"' list as completion chunks stream in
+# only complete lines are parsed, so a line split across chunks waits for the rest of it
+class QueryLineParser:
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, text: str):
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split('\n')
+        return [response for line in lines for response in parse_queries(line)]
+
+    def close(self):
+        line, self.buffer = self.buffer, ''
+        return parse_queries(line)
+
+# incremental parser for a streaming one_call JSON answer: emits each complete
+# {"engine": ..., "query": ...} object once the content type is known
+class JSONQueryParser:
+    content_pattern = re.compile(r'"content"\s*:\s*"(\w+)"')
+    item_pattern = re.compile(r'\{[^{}]*\}')
+
+    def __init__(self, topic: str):
+        self.topic = topic
+        self.buffer = ''
+        self.position = 0 # where to resume scanning for query objects
+        self.content = None
+
+    def feed(self, text: str):
+        self.buffer += text
+        responses = []
+        if self.content is None:
+            match = self.content_pattern.search(self.buffer)
+            if not match: # wait for the content type before deciding which engines are allowed
+                return responses
+            responses += self.set_content(match.group(1))
+        return responses + self.scan()
+
+    def close(self):
+        responses = []
+        if self.content is None: # same default as plan_one_call
+            responses += self.set_content('text')
+        return responses + self.scan()
+
+    def set_content(self, content: str):
+        self.content = 'visual' if content == 'visual' else 'text'
+        if self.content == 'visual':
+            # Wikipedia one-shot the query to add some additional text-based context
+            return ['Wikipedia: ' + self.topic]
+        return []
+
+    def scan(self):
+        responses = []
+        queries_start = self.buffer.find('"queries"')
+        if queries_start < 0:
+            return responses
+        for match in self.item_pattern.finditer(self.buffer, max(self.position, queries_start)):
+            self.position = match.end()
+            try:
+                item = json.loads(match.group(0))
+            except json.JSONDecodeError:
+                continue
+            if item.get('engine') in content_engines[self.content] and item.get('query'):
+                responses.append(item['engine'] + ': ' + item['query'])
+        return responses
+
+# yield the text of a streaming completion as it arrives
+async def stream_text(client, **kwargs):
+    stream = await client.chat.completions.create(stream=True, **kwargs)
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+# two-call chain with the followup streamed, yielding each query as soon as its line is complete
+async def plan_two_call_stream(client, topic: str):
+    messages, responses = await classify(client, topic)
+    for response in responses:
+        yield response
+
+    parser = QueryLineParser()
+    with tracing.span('openai', step='queries', stream=True):
+        async for text in stream_text(client, model=model, messages=messages, temperature=1.0):
+            for response in parser.feed(text):
+                yield response
+    for response in parser.close():
+        yield response
+
+# one-call chain streamed, yielding each query as soon as its JSON object is complete
+async def plan_one_call_stream(client, topic: str):
+    parser = JSONQueryParser(topic)
+    with tracing.span('openai', step='one_call', stream=True):
+        async for text in stream_text(client, model=model,
+                                      messages=build_messages(one_call_template.format(topic=topic)),
+                                      temperature=1.0,
+                                      response_format={'type': 'json_object'}):
+            for response in parser.feed(text):
+                yield response
+    for response in parser.close():
+        yield response
+
+# crude plural stripping so 'dresses'/'dress' and 'stories'/'story' key alike
+def stem(word: str):
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    elif len(word) > 4 and word.endswith(('sses', 'shes', 'ches', 'xes')):
+        return word[:-2]
+    elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+# words that don't change what a topic is about
+STOPWORDS = set(['a', 'an', 'the', 'of', 'in', 'on', 'at', 'for', 'to', 'and', 'or', 'with', 'about', 'from', 'by',
+                 'is', 'are', 'how', 'what', 'why', 'when', 'where', 'which', 'who', 'my', 'your', 'our', 'their',
+                 'this', 'that', 'these', 'those', 'some'])
+
+# plan cache key: the topic's stemmed content words, sorted, so rewordings that only reorder, pluralize,
+# change case or punctuation, or add and drop filler words share a plan, while changing any meaningful
+# word ('start' vs 'sell a business', 'third' vs 'fourth century') doesn't
+# (the key depends on nothing but the topic, so rewordings share plans across containers too)
+def topic_key(topic: str):
+    normalized = result_cache.normalize_query(topic)
+    words = sorted(set(stem(word) for word in normalized.split() if word not in STOPWORDS))
+    return ' '.join(words) or normalized
+
+# cheap local word embedding: hashed character bigrams and trigrams of the padded word, L2 normalized,
+# so misspellings and other forms of a word ('histroy', 'repairing') land close to it
+def word_embedding(word: str, dims: int = 1024):
+    padded = '#' + word + '#'
+    vector = {}
+    for size in (2, 3):
+        for i in range(len(padded) - size + 1):
+            index = zlib.crc32(padded[i:i + size].encode('utf-8')) % dims
+            vector[index] = vector.get(index, 0.0) + 1.0
+    norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+    return {index: value / norm for index, value in vector.items()}
+
+# a topic key's word embeddings
+def topic_embedding(key: str):
+    return [word_embedding(word) for word in key.split()]
+
+def cosine(a: dict, b: dict):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(value * b.get(index, 0.0) for index, value in a.items())
+
+# how alike two topics are: every content word of each has to be close to some word of the other, so the
+# least matched word decides (a single changed meaningful word, 'third' vs 'fourth century', scores low
+# however long the topic is)
+def topic_similarity(a: list, b: list):
+    if not a or not b:
+        return 0.0
+    return min(min(max(cosine(x, y) for y in b) for x in a), min(max(cosine(x, y) for y in a) for x in b))
+
+# plans are stored with the one-shot Wikipedia search on the raw topic as this placeholder, and get it
+# back from the topic being planned, so a reworded topic never searches the wording it was first planned with
+TOPIC_SEARCH = 'Wikipedia: {topic}'
+
+def to_stored(topic: str, responses: list):
+    if not responses:
+        return responses
+    return [TOPIC_SEARCH if response == 'Wikipedia: ' + topic else response for response in responses]
+
+def from_stored(topic: str, responses: list):
+    if not responses:
+        return responses
+    return ['Wikipedia: ' + topic if response == TOPIC_SEARCH else response for response in responses]
+
+# plan cache keyed on the topic's content words (topic_key), with a nearest-neighbor lookup over the
+# keys planned in this container for paraphrases (the exact key is the fast path, shared across containers)
+# threshold is tuned on benchmarks/planner.py's paraphrases (0.52 and up) and one-word-apart topics (0.44 at most)
+class PlannerCache:
+    def __init__(self, cache, threshold: float = 0.5, max_topics: int = 2048):
+        self.cache = cache
+        self.threshold = threshold
+        self.max_topics = max_topics
+        self.topics = {} # topic key -> its word embeddings, for keys with a cached plan
+
+    # closest already-planned key, if it's similar enough to reuse its plan
+    def nearest(self, key: str):
+        if key in self.topics or not self.topics:
+            return key, 1.0
+        vector = topic_embedding(key)
+        # topics more than a word longer or shorter can't have every word matched
+        candidates = [(other, topic_similarity(vector, other_vector)) for other, other_vector in self.topics.items()
+                      if abs(len(other_vector) - len(vector)) <= 1]
+        if not candidates:
+            return key, 0.0
+        best_key, best_score = max(candidates, key=lambda pair: pair[1])
+        if best_score >= self.threshold:
+            return best_key, best_score
+        return key, best_score
+
+    def remember(self, key: str):
+        if key not in self.topics:
+            if len(self.topics) >= self.max_topics: # forget the oldest topic
+                self.topics.pop(next(iter(self.topics)))
+            self.topics[key] = topic_embedding(key)
+
+    def canonical(self, topic: str):
+        key = topic_key(topic)
+        canonical, score = self.nearest(key)
+        if canonical != key:
+            self.cache.count('Planner', 'near_duplicate_hits')
+        return canonical
+
+    async def get_or_plan(self, topic: str, plan):
+        async def stored():
+            return to_stored(topic, await plan())
+        canonical = self.canonical(topic)
+        responses = await self.cache.get_or_fetch('Planner', canonical, stored)
+        if responses:
+            self.remember(canonical)
+        return from_stored(topic, responses)
+
+    # cached plan for topic (or a rewording), or None; stale plans are refreshed with refresh()
+    async def get(self, topic: str, refresh=None):
+        async def stored():
+            return to_stored(topic, await refresh())
+        canonical = self.canonical(topic)
+        responses = await self.cache.get('Planner', canonical, refresh=stored if refresh is not None else None)
+        if responses:
+            self.remember(canonical)
+        return from_stored(topic, responses)
+
+    # last cached plan for topic no matter how old, for when OpenAI can't be called
+    async def get_fallback(self, topic: str):
+        return from_stored(topic, await self.cache.get_fallback('Planner', self.canonical(topic)))
+
+    async def put(self, topic: str, responses: list):
+        key = topic_key(topic)
+        await self.cache.set('Planner', key, to_stored(topic, responses))
+        if responses:
+            self.remember(key)
+
+class Planner:
+    def __init__(self, client=None, cache=None, one_call: bool = False, limiter=None):
+        if client is None:
+            import os
+            import httpx
+            import openai
+            # the response hook feeds OpenAI's x-ratelimit-* headers to the limiter
+            http_client = httpx.AsyncClient(event_hooks={'response': [rate_limit.observe_response]})
+            client = openai.AsyncOpenAI(api_key=os.environ['OPENAI_API_KEY'], http_client=http_client)
+        self.client = client
+        self.cache = cache
+        self.one_call = one_call
+        self.limiter = limiter # shared OpenAI rate limit and circuit breaker, None to call freely
+
+        # latency of each uncached planner run, by mode
+        self.timings = {'one_call': [], 'two_call': []}
+
+    # wait for rate limit tokens for one planner run (a completion each) and tag its OpenAI calls
+    async def throttle(self, topic: str, one_call: bool):
+        if self.limiter is not None:
+            await self.limiter.check('OpenAI', topic)
+            await self.limiter.acquire('OpenAI', topic, cost=1 if one_call else 2)
+            rate_limit.current_call.set((self.limiter, 'OpenAI'))
+
+    def record(self, ok: bool):
+        if self.limiter is None:
+            return
+        if ok:
+            self.limiter.success('OpenAI')
+        else:
+            self.limiter.failure('OpenAI')
+
+    # run the planner without the cache
+    async def run(self, topic: str, one_call: bool):
+        await self.throttle(topic, one_call)
+        start = time.perf_counter()
+        try:
+            if one_call:
+                responses = await plan_one_call(self.client, topic)
+            else:
+                responses = await plan_two_call(self.client, topic)
+        except Exception:
+            self.record(False)
+            raise
+        self.record(True)
+        self.timings['one_call' if one_call else 'two_call'].append(time.perf_counter() - start)
+        return responses
+
+    # traced as a plan span, with openai spans under it unless the plan was cached
+    async def plan(self, topic: str, one_call: bool = None):
+        one_call = self.one_call if one_call is None else one_call
+        with tracing.span('plan', topic=topic, one_call=one_call):
+            if self.cache is None:
+                return await self.run(topic, one_call)
+            try:
+                return await self.cache.get_or_plan(topic, lambda: self.run(topic, one_call))
+            except Throttled:
+                # OpenAI is rate limited or its breaker is open, so reuse an old plan if there is one
+                responses = await self.cache.get_fallback(topic)
+                if responses is None:
+                    raise
+                tracing.annotate(fallback=True)
+                return responses
+
+    # same as plan, but yields each response as soon as the model has written it
+    async def plan_stream(self, topic: str, one_call: bool = None):
+        one_call = self.one_call if one_call is None else one_call
+        if self.cache is not None:
+            responses = await self.cache.get(topic, refresh=lambda: self.run(topic, one_call))
+            if responses is not None:
+                for response in responses:
+                    yield response
+                return
+
+        try:
+            await self.throttle(topic, one_call)
+        except Throttled:
+            responses = await self.cache.get_fallback(topic) if self.cache is not None else None
+            if responses is None:
+                raise
+            for response in responses:
+                yield response
+            return
+
+        start = time.perf_counter()
+        responses = []
+        if one_call:
+            stream = plan_one_call_stream(self.client, topic)
+        else:
+            stream = plan_two_call_stream(self.client, topic)
+        try:
+            async for response in stream:
+                responses.append(response)
+                yield response
+        except Exception:
+            self.record(False)
+            raise
+        self.record(True)
+        self.timings['one_call' if one_call else 'two_call'].append(time.perf_counter() - start)
+
+        # only complete plans get cached (the consumer may stop early)
+        if self.cache is not None:
+            await self.cache.put(topic, responses)
+
+# one planner (and plan cache) per event loop, so warm containers reuse cached plans
+planners = weakref.WeakKeyDictionary()
+
+def get_planner():
+    loop = asyncio.get_running_loop()
+    if loop not in planners:
+        store = result_cache.default_store()
+        flights = coalesce.SingleFlight(store) if coalesce.ENABLED else None
+        cache = result_cache.ResultCache(store, ttls={'Planner': PLAN_TTL}, flights=flights,
+                                         stats_store=result_cache.default_stats_store())
+        planners[loop] = Planner(cache=PlannerCache(cache), limiter=rate_limit.RateLimiter(rate_limit.default_store()))
+    return planners[loop]
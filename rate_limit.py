@@ -0,0 +1,296 @@
+# per-engine rate limiting and circuit breaking for upstream calls
+#   token bucket: each engine gets rate tokens per second up to burst, adapted from Retry-After and
+#   X-Ratelimit-* response headers (and halved on a bare 429) so we slow down before the upstream makes us
+#   circuit breaker: after failure_threshold failures in a row the engine isn't called for cooldown
+#   seconds, then a single trial request decides whether it closes again
+# state is shared across containers through a store (Modal Dict when deployed): each container keeps
+# a local copy and merges it with the shared one every sync_interval seconds or when something changes
+# clock and sleep are injectable so everything can be driven by a fake clock
+import time
+import asyncio
+import contextvars
+from email.utils import parsedate_to_datetime
+
+from search_result import RateLimited, CircuitOpen
+
+# (rate per second, burst) for each upstream
+ENGINE_LIMITS = {
+    'Wikipedia': (10.0, 20),
+    'Reddit': (100 / 60, 20), # 100 queries a minute for OAuth clients
+    'Podcast': (1.0, 10),
+    'Unsplash': (50 / 3600, 50), # demo keys get 50 requests an hour
+    'OpenAI': (5.0, 20),
+    'Vector': (50.0, 100), # our own app, limited to spare it from runaway fan-out rather than by quota
+}
+DEFAULT_LIMIT = (1.0, 10)
+
+# window (seconds) an X-Ratelimit-Remaining count covers when there's no reset header (Unsplash is hourly)
+ENGINE_WINDOWS = {
+    'Unsplash': 3600,
+}
+DEFAULT_WINDOW = 60
+
+# how long a search may wait for a token before giving up on the engine (hedged requests never wait)
+MAX_WAIT = 1.0
+
+FAILURE_THRESHOLD = 5
+COOLDOWN = 30.0
+
+# seconds between merges with the shared store
+SYNC_INTERVAL = 1.0
+
+# (limiter, engine) for the upstream call running in this task, so the HTTP client's response hook
+# can feed rate limit headers back to the right bucket
+current_call = contextvars.ContextVar('current_call', default=None)
+
+# httpx response event hook
+async def observe_response(response):
+    call = current_call.get()
+    if call is not None:
+        limiter, engine = call
+        limiter.observe(engine, response.status_code, response.headers)
+
+# seconds to wait from a Retry-After header (either delay-seconds or an HTTP date), None if absent
+def parse_retry_after(value, now: float):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - now)
+    except (TypeError, ValueError):
+        return None
+
+# seconds from a reset header: plain seconds (Reddit) or a duration like '6m0s' / '20ms' (OpenAI)
+def parse_duration(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds, number = 0.0, ''
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    i = 0
+    while i < len(value):
+        if value[i].isdigit() or value[i] == '.':
+            number += value[i]
+            i += 1
+            continue
+        unit = 'ms' if value[i:i + 2] == 'ms' else value[i]
+        if unit not in units or not number:
+            return None
+        seconds += float(number) * units[unit]
+        number = ''
+        i += len(unit)
+    return seconds if not number else None
+
+# requests left in the current window and seconds until it resets, from whichever header set is present
+def parse_rate_headers(headers):
+    remaining = headers.get('x-ratelimit-remaining') or headers.get('x-ratelimit-remaining-requests')
+    reset = headers.get('x-ratelimit-reset') or headers.get('x-ratelimit-reset-requests')
+    try:
+        remaining = float(remaining) if remaining is not None else None
+    except ValueError:
+        remaining = None
+    return remaining, parse_duration(reset)
+
+# one engine's limiter and breaker state
+class Bucket:
+    fields = ['tokens', 'updated_at', 'rate', 'blocked_until', 'adapted_at',
+              'failures', 'open_until', 'probe_until', 'changed_at']
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.base_rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = now
+        self.rate = rate
+        self.blocked_until = 0.0 # no requests at all before this (Retry-After, exhausted quota)
+        self.adapted_at = 0.0 # when rate/blocked_until last changed
+        self.failures = 0 # consecutive failures
+        self.open_until = 0.0 # breaker open until this time, then half-open
+        self.probe_until = 0.0 # a half-open trial request is in flight until this time
+        self.changed_at = 0.0 # when the breaker state last changed
+        self.spent = 0 # tokens taken since the last sync
+        self.synced_at = None
+
+    def refill(self, now: float):
+        if now > self.updated_at:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def state(self):
+        return {name: getattr(self, name) for name in self.fields}
+
+    # combine with the shared copy: the shared bucket less what this container spent since the last
+    # sync, the most recent rate adaptation and breaker change, and the longest block
+    def merge(self, shared: dict, now: float):
+        self.refill(now)
+        shared_tokens = min(self.burst, shared['tokens'] + max(0.0, now - shared['updated_at']) * shared['rate'])
+        self.tokens = min(self.tokens, shared_tokens - self.spent)
+        if shared['adapted_at'] > self.adapted_at:
+            self.rate, self.adapted_at = shared['rate'], shared['adapted_at']
+        self.blocked_until = max(self.blocked_until, shared['blocked_until'])
+        if shared['changed_at'] > self.changed_at:
+            for name in ['failures', 'open_until', 'probe_until', 'changed_at']:
+                setattr(self, name, shared[name])
+
+class RateLimiter:
+    def __init__(self, store=None, limits: dict = None, clock=time.time, sleep=asyncio.sleep,
+                 failure_threshold: int = FAILURE_THRESHOLD, cooldown: float = COOLDOWN,
+                 sync_interval: float = SYNC_INTERVAL):
+        self.store = store
+        self.limits = dict(ENGINE_LIMITS)
+        self.limits.update(limits or {})
+        self.clock = clock # wall clock, since buckets are compared across containers
+        self.sleep = sleep
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.sync_interval = sync_interval
+        self.buckets = {}
+        self.tasks = set()
+
+    def bucket(self, engine: str):
+        if engine not in self.buckets:
+            rate, burst = self.limits.get(engine, DEFAULT_LIMIT)
+            self.buckets[engine] = Bucket(rate, burst, self.clock())
+        return self.buckets[engine]
+
+    # take cost tokens for engine, sleeping if they'll be there within max_wait
+    # raises RateLimited (without taking anything) when the wait would be longer
+    async def acquire(self, engine: str, query: str, max_wait: float = MAX_WAIT, cost: float = 1):
+        await self.maybe_sync(engine)
+        bucket = self.bucket(engine)
+        now = self.clock()
+        bucket.refill(now)
+        wait = max(bucket.blocked_until - now, (cost - bucket.tokens) / bucket.rate, 0.0)
+        if wait > max_wait:
+            raise RateLimited(engine, query, 'rate limited for ' + format(wait, '.1f') + 's')
+
+        # reserve now so concurrent callers queue up behind this one
+        bucket.tokens -= cost
+        bucket.spent += cost
+        if wait > 0:
+            await self.sleep(wait)
+
+    # raise CircuitOpen if engine shouldn't be called; once the cooldown is over, one caller at a
+    # time gets through as the trial request
+    async def check(self, engine: str, query: str):
+        await self.maybe_sync(engine)
+        bucket = self.bucket(engine)
+        now = self.clock()
+        if now < bucket.open_until:
+            raise CircuitOpen(engine, query, 'circuit open for ' + format(bucket.open_until - now, '.1f') + 's')
+        if bucket.open_until:
+            if now < bucket.probe_until:
+                raise CircuitOpen(engine, query, 'waiting on a trial request')
+            bucket.probe_until = now + self.cooldown
+            bucket.changed_at = now
+
+    def success(self, engine: str):
+        bucket = self.bucket(engine)
+        if bucket.failures or bucket.open_until:
+            bucket.failures = 0
+            bucket.open_until = bucket.probe_until = 0.0
+            bucket.changed_at = self.clock()
+            self.push(engine)
+
+    def failure(self, engine: str):
+        bucket = self.bucket(engine)
+        now = self.clock()
+        bucket.failures += 1
+        bucket.changed_at = now
+        if bucket.open_until or bucket.failures >= self.failure_threshold:
+            # a failed trial request reopens the breaker right away
+            bucket.open_until = now + self.cooldown
+            bucket.probe_until = 0.0
+        self.push(engine)
+
+    def is_open(self, engine: str):
+        return self.clock() < self.bucket(engine).open_until
+
+    # adapt engine's bucket to an upstream response's status and rate limit headers
+    def observe(self, engine: str, status: int, headers):
+        bucket = self.bucket(engine)
+        now = self.clock()
+        bucket.refill(now)
+        changed = False
+
+        delay = parse_retry_after(headers.get('retry-after'), now)
+        if status == 429 or (status == 503 and delay is not None):
+            if delay is None: # no hint from the upstream, so back off multiplicatively
+                bucket.rate = max(bucket.base_rate / 64, bucket.rate / 2)
+                delay = 1 / bucket.rate
+            bucket.blocked_until = max(bucket.blocked_until, now + delay)
+            bucket.tokens = min(bucket.tokens, 0.0)
+            changed = True
+
+        remaining, reset = parse_rate_headers(headers)
+        if remaining is not None:
+            # spread what's left of the quota evenly over the rest of the window
+            window = reset if reset else ENGINE_WINDOWS.get(engine, DEFAULT_WINDOW)
+            bucket.rate = max(remaining, 1) / max(window, 1)
+            bucket.tokens = min(bucket.tokens, remaining)
+            if remaining < 1:
+                bucket.blocked_until = max(bucket.blocked_until, now + window)
+            changed = True
+        elif status < 400 and bucket.rate < bucket.base_rate:
+            # recover from a bare 429 back-off a little with every success
+            bucket.rate = min(bucket.base_rate, bucket.rate + bucket.base_rate / 20)
+
+        if changed:
+            bucket.adapted_at = now
+            self.push(engine)
+
+    # merge with the shared store if this container's copy is older than sync_interval
+    async def maybe_sync(self, engine: str):
+        bucket = self.bucket(engine)
+        if self.store is not None and (bucket.synced_at is None or self.clock() - bucket.synced_at >= self.sync_interval):
+            await self.sync(engine)
+
+    async def sync(self, engine: str):
+        bucket = self.bucket(engine)
+        now = self.clock()
+        bucket.synced_at = now
+        try:
+            entry = await self.store.get('limits:' + engine)
+            if entry is not None:
+                bucket.merge(entry[1], now)
+            bucket.spent = 0
+            await self.store.put('limits:' + engine, (now, bucket.state()))
+        except Exception as e: # a store outage leaves each container limiting on its own
+            print('Rate limit sync failed:', engine, repr(e))
+
+    # share a change (429, quota headers, breaker trip) with other containers right away
+    def push(self, engine: str):
+        if self.store is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError: # no running loop (e.g. driven synchronously by a test)
+            return
+        task = loop.create_task(self.sync(engine))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    # tokens, rate, and breaker state per engine, for logs and benchmarks
+    def report(self):
+        now = self.clock()
+        report = {}
+        for engine, bucket in self.buckets.items():
+            bucket.refill(now)
+            report[engine] = {'tokens': round(bucket.tokens, 2), 'rate': bucket.rate,
+                              'blocked_for': max(0.0, bucket.blocked_until - now),
+                              'failures': bucket.failures, 'open': now < bucket.open_until}
+        return report
+
+# shared limiter state lives next to the result cache: a Modal Dict when deployed, SQLite locally
+def default_store():
+    import modal
+    import result_cache
+    if modal.is_local():
+        return result_cache.SQLiteStore('/tmp/metasearch_limits.sqlite')
+    return result_cache.ModalDictStore('metasearch-rate-limits')
@@ -0,0 +1,207 @@
+# HTML for the results pages, built from precompiled templates
+# every field is escaped on the way in (URLs are also limited to http(s) or relative links), and
+# pages are produced as a list of chunks joined once, or streamed chunk by chunk
+import re
+import html
+from typing import NamedTuple, Optional
+
+import thumbnails
+
+# CSS for the results page
+css_string = "<style type='text/css'>\n .row {display: flex; flex-flow: row wrap}\n .rowchild {border: 1px solid #555555; border-radius: 10px; padding: 10px; max-width: 45%; min-width: 300px; margin: 10px;}\n .linkhead {font-size: larger}\n .actualquery {font-size: smaller}\n .snippet {margin: 10px auto; padding: 0px 15px; font-style: italic}\n .imagecontainer {max-width: 90%; max-height: 400px}\n .imagecontainer img {max-width: 100%; max-height: 400px; margin: auto; object-fit: contain}\n .imagecontainer img.podcast {max-width: 200px; max-height: 200px;}\n .timeouts {margin: 10px; color: #555555; font-style: italic}\n .more {margin: 10px; font-size: larger}\n .timing {margin: 10px; font-size: smaller}\n .timing td {padding: 1px 6px; white-space: nowrap}\n .timing .bar {width: 50%; min-width: 300px}\n .timing .bar div {height: 10px; background: #4a7ebb}\n .timing .bar div.error {background: #bb4a4a}\n .timing .bar div.cancelled {background: #aaaaaa} </style>"
+
+# templates, compiled once to bound format methods
+header_template = ("<head><title>AI Metasearch Concept: {query}</title>" + css_string.replace('{', '{{').replace('}', '}}') + "</head>"
+                   "<body><form action='/' method='get'><input type='text' name='query' placeholder='Search' value='{query}' style='width: 80%; padding: 10px;'>"
+                   "{hidden}"
+                   "<button type='submit' id='submit' style='width: 20%; padding: 10px;'>Search</button></form>"
+                   "<h1>Search: {query}</h1>").format
+stream_input = "<input type='hidden' name='stream' value='true'>"
+home_page = ("<html><head><title>Search</title></head>"
+             "<body><form action='/' method='get'><input type='text' name='query' placeholder='Search' style='width: 80%; padding: 10px;'><button type='submit' id='submit' style='width: 20%; padding: 10px;'>Search</button></form>"
+             "</body></html>")
+
+# pieces of a result card; each shape of card (which source line, snippet or not, which image)
+# is joined into one template the first time it's needed, so a card is a single format call
+link_html = "<div class='linkhead'><a href = '{url}'>{title}</a></div>"
+source_html = {
+    'subsource_only': "<div>Source: <a href='{subsource_url}'>{subsource}</a></div>",
+    'subsource': "<div>Source: <a href='{subsource_url}'>{subsource}</a> <i>({source})</i></div>",
+    'source': "<div>Source: <i>{source}</i></div>",
+}
+query_html = "<div class='actualquery'>Actual query: <i>{query}</i></div>"
+snippet_html = "<div class='snippet'>{snippet}</div>"
+timeouts_html = "<div class='timeouts'>No results in time from: {engines}</div>"
+more_html = "<div class='more'><a href='{url}'>More results</a></div>"
+# images load lazily, in a box the size of the thumbnail proxy's (see thumbnails.py) so the page doesn't
+# shift as they arrive; the image links to the original, as it always has
+image_html = {
+    'podcast': "<div class='imagecontainer'><a href='{image}'><img class='podcast' src='{thumbnail}' loading='lazy' width='%d' height='%d' /></a></div>" % thumbnails.SIZES['podcast'],
+    'image': "<div class='imagecontainer'><a href='{image}'><img src='{thumbnail}' loading='lazy' width='%d' height='%d' /></a></div>" % thumbnails.SIZES['image'],
+    None: '',
+}
+card_templates = {}
+
+# ?debug=timing view: a waterfall row per span (indented under its parent, bar placed on the
+# request's timeline), then p50/p95/p99 per stage
+timing_html = "<div class='timing'><h2>Timing</h2><table>{rows}</table><h2>Latency by stage</h2><table>{stages}</table></div>"
+waterfall_row = ("<tr><td style='padding-left: {indent}em'>{name}</td><td>{label}</td><td>{ms} ms</td>"
+                 "<td class='bar'><div class='{status}' style='margin-left: {left}%; width: {width}%'></div></td></tr>").format
+stage_header = "<tr><th>stage</th><th>count</th><th>p50 ms</th><th>p95 ms</th><th>p99 ms</th></tr>"
+stage_row = "<tr><td>{stage}</td><td>{count}</td><td>{p50}</td><td>{p95}</td><td>{p99}</td></tr>".format
+
+# sources shown by their subsource alone
+subsource_only_sources = ['Image Vector Search']
+
+# cards per chunk when streaming a rendered page
+chunk_size = 20
+
+# most fields have nothing to escape, and one regex scan is cheaper than html.escape's five replaces
+needs_escape = re.compile('[&<>"\']').search
+
+def escape(text):
+    if type(text) is not str:
+        text = str(text)
+    return html.escape(text) if needs_escape(text) else text
+
+# escape a URL for an attribute, refusing schemes like javascript:
+def escape_url(url):
+    url = (url if type(url) is str else str(url)).strip()
+    scheme, colon, _ = url.partition(':')
+    if colon and '/' not in scheme and scheme.lower() not in ('http', 'https'):
+        return '#'
+    return html.escape(url) if needs_escape(url) else url
+
+# the fields a card shows, already escaped (a result without a title shows 'Link'); thumbnail is
+# the image's src and image the original it links to, the same URL unless it's proxied
+class Card(NamedTuple):
+    url: str
+    title: str
+    source: str
+    query: str
+    subsource: Optional[str] = None # None when the result has no subsource
+    subsource_url: Optional[str] = None
+    snippet: str = ''
+    thumbnail: str = ''
+    image: str = ''
+
+    # thumbnail_src, if given, maps a result with an image to the URL to load it from (thumbnails.proxy_src)
+    @classmethod
+    def from_result(cls, result, thumbnail_src=None):
+        image = escape_url(result.thumbnail) if result.thumbnail else ''
+        return cls(
+            escape_url(result.url),
+            escape(result.title) if result.title else 'Link',
+            escape(result.source),
+            escape(result.query),
+            escape(result.subsource) if result.subsource is not None else None,
+            escape_url(result.subsource_url or '') if result.subsource is not None else None,
+            escape(result.snippet) if result.snippet else '',
+            escape_url(thumbnail_src(result)) if image and thumbnail_src else image,
+            image,
+        )
+
+# page header, search form, and title for a results page
+def render_header(query: str, stream: bool = False):
+    # keep streaming on for follow-up searches
+    return header_template(query=escape(query), hidden=stream_input if stream else '')
+
+# compiled template for one shape of card, with fields numbered in Card order so a card
+# formats straight from its tuple
+def card_template(source_kind: str, snippet: bool, image_kind: str):
+    key = (source_kind, snippet, image_kind)
+    if key not in card_templates:
+        template = ("<div class='rowchild'>" + link_html + source_html[source_kind] + query_html +
+                    (snippet_html if snippet else '') + image_html[image_kind] + "</div>")
+        positions = {field: '{' + str(i) + '}' for i, field in enumerate(Card._fields)}
+        card_templates[key] = template.format(**positions).format
+    return card_templates[key]
+
+# assemble HTML card for a single card record
+def render_card(card: Card):
+    # choose whether or not to say the source name given subsource
+    if card.subsource is None:
+        source_kind = 'source'
+    elif card.source in subsource_only_sources:
+        source_kind = 'subsource_only'
+    else:
+        source_kind = 'subsource'
+
+    if not card.thumbnail:
+        image_kind = None
+    elif card.source == 'Podcast':
+        image_kind = 'podcast'
+    else:
+        image_kind = 'image'
+
+    return card_template(source_kind, bool(card.snippet), image_kind)(*card)
+
+# assemble HTML card for a single SearchResult
+def render_result(result, thumbnail_src=None):
+    return render_card(Card.from_result(result, thumbnail_src))
+
+# HTML for a list of results
+def render_results(results, thumbnail_src=None):
+    return ''.join([render_result(result, thumbnail_src) for result in results])
+
+# note naming the engines that ran out of time, '' when none did
+def render_timeouts(engines):
+    if not engines:
+        return ''
+    return timeouts_html.format(engines=', '.join([escape(engine) for engine in engines]))
+
+# link to the next page of results (see pagination.py)
+def render_more(url: str):
+    return more_html.format(url=escape_url(url))
+
+# span records (see tracing.py) in waterfall order: depth-first from the root, children by start time,
+# with spans whose parent never arrived (e.g. cut off by the deadline) at the top level
+def waterfall(spans: list):
+    ids = set(span['span_id'] for span in spans)
+    children = {}
+    for span in sorted(spans, key=lambda span: span['start']):
+        parent = span['parent_id'] if span['parent_id'] in ids else None
+        children.setdefault(parent, []).append(span)
+    ordered = []
+    def visit(parent, depth):
+        for span in children.get(parent, []):
+            ordered.append((depth, span))
+            visit(span['span_id'], depth + 1)
+    visit(None, 0)
+    return ordered
+
+# the ?debug=timing view for a trace's spans and the latency summary (tracing.collect_metrics)
+def render_timing(spans: list, summary: dict):
+    rows = []
+    if spans:
+        start = min(span['start'] for span in spans)
+        total = max(max(span['end'] for span in spans) - start, 1e-6)
+        for depth, span in waterfall(spans):
+            attributes = span['attributes']
+            label = ': '.join([str(attributes[key]) for key in ('engine', 'query') if attributes.get(key)])
+            label = label or attributes.get('step') or attributes.get('function') or ''
+            rows.append(waterfall_row(indent=depth, name=escape(span['name']), label=escape(label),
+                                      ms=format((span['end'] - span['start']) * 1000, '.1f'),
+                                      status=escape(span['status']),
+                                      left=format((span['start'] - start) / total * 100, '.2f'),
+                                      width=format(max((span['end'] - span['start']) / total * 100, 0.2), '.2f')))
+    stages = [stage_header] + [stage_row(stage=escape(stage), count=values['count'],
+                                         **{p: format(values[p] * 1000, '.1f') for p in ('p50', 'p95', 'p99')})
+                               for stage, values in sorted(summary.items())]
+    return timing_html.format(rows=''.join(rows), stages=''.join(stages))
+
+# closing chunk of a results page: which engines (if any) timed out, then anything else for the bottom
+# of the page (like the ?debug=timing view)
+def render_page_end(timeouts=(), footer: str = ''):
+    return "</div>" + render_timeouts(timeouts) + footer + "</body></html>"
+
+# a full results page as chunks: header, then cards chunk_size at a time, then (unless end is False,
+# for callers adding their own render_page_end) which engines timed out
+def render_page(query: str, results: list, stream: bool = False, timeouts=(), end: bool = True, thumbnail_src=None):
+    yield "<html>" + render_header(query, stream)
+    if results:
+        yield "<div class='row'>"
+    for start in range(0, len(results), chunk_size):
+        yield render_results(results[start:start + chunk_size], thumbnail_src)
+    if end:
+        yield render_page_end(timeouts)
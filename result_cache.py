@@ -0,0 +1,344 @@
+# two-tier cache for engine search results, keyed by (engine, normalized query)
+#   tier 1: in-process LRU with a TTL, so warm containers answer repeats without any network
+#   tier 2: shared store (Modal Dict when deployed, SQLite for local runs) so containers share results
+# stale entries are served immediately while a background refresh brings them up to date
+import re
+import time
+import uuid
+import atexit
+import pickle
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict, Counter, defaultdict
+
+# how long (seconds) each engine's results count as fresh
+ENGINE_TTLS = {
+    'Wikipedia': 7 * 24 * 3600, # articles barely change
+    'Reddit': 3600, # new posts show up all the time
+    'Podcast': 24 * 3600,
+    'Unsplash': 24 * 3600,
+    'Vector': 7 * 24 * 3600, # the image index changes only when it's re-exported
+}
+DEFAULT_TTL = 3600
+
+# bumped whenever the cached value format changes, so old entries are never read back
+KEY_VERSION = 'v2/'
+
+# how long past its TTL an entry can still be served while it's refreshed in the background
+MAX_STALE = 24 * 3600
+
+# published counters older than this belong to containers long gone, and are dropped by collect_stats
+STATS_MAX_AGE = 7 * 24 * 3600
+
+# collapse case, quotes, punctuation, and whitespace so trivially different LLM queries share a key
+def normalize_query(query: str):
+    query = query.lower().replace('"', ' ').replace("'", '')
+    query = re.sub(r'[^\w\s&+#-]', ' ', query)
+    return ' '.join(query.split())
+
+# in-process LRU holding (stored_at, value) entries
+class LRUCache:
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: tuple):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+# shared tier for local runs
+class SQLiteStore:
+    def __init__(self, path: str = '/tmp/metasearch_cache.sqlite'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, stored_at REAL, value BLOB)')
+        self.connection.commit()
+
+    def get_sync(self, key: str):
+        with self.lock:
+            row = self.connection.execute('SELECT stored_at, value FROM cache WHERE key = ?', (key,)).fetchone()
+        if row:
+            return row[0], pickle.loads(row[1])
+        return None
+
+    def put_sync(self, key: str, entry: tuple):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                                    (key, entry[0], pickle.dumps(entry[1])))
+            self.connection.commit()
+
+    # write entry only if key isn't there yet, returning whether it was written (used for locks)
+    def put_if_absent_sync(self, key: str, entry: tuple):
+        with self.lock:
+            cursor = self.connection.execute('INSERT OR IGNORE INTO cache VALUES (?, ?, ?)',
+                                             (key, entry[0], pickle.dumps(entry[1])))
+            self.connection.commit()
+        return cursor.rowcount == 1
+
+    def delete_sync(self, key: str):
+        with self.lock:
+            self.connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self.connection.commit()
+
+    def items_sync(self, prefix: str):
+        with self.lock:
+            rows = self.connection.execute('SELECT key, stored_at, value FROM cache WHERE key LIKE ?',
+                                           (prefix + '%',)).fetchall()
+        return [(key, (stored_at, pickle.loads(value))) for key, stored_at, value in rows]
+
+    async def get(self, key: str):
+        return await asyncio.to_thread(self.get_sync, key)
+
+    async def put(self, key: str, entry: tuple):
+        await asyncio.to_thread(self.put_sync, key, entry)
+
+    async def put_if_absent(self, key: str, entry: tuple):
+        return await asyncio.to_thread(self.put_if_absent_sync, key, entry)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self.delete_sync, key)
+
+    async def items(self, prefix: str):
+        return await asyncio.to_thread(self.items_sync, prefix)
+
+# shared tier across Modal containers
+class ModalDictStore:
+    def __init__(self, name: str = 'metasearch-result-cache'):
+        import modal
+        self.dict = modal.Dict.from_name(name, create_if_missing=True)
+
+    async def get(self, key: str):
+        return await self.dict.get.aio(key)
+
+    async def put(self, key: str, entry: tuple):
+        await self.dict.put.aio(key, entry)
+
+    def put_sync(self, key: str, entry: tuple):
+        self.dict.put(key, entry)
+
+    async def put_if_absent(self, key: str, entry: tuple):
+        return await self.dict.put.aio(key, entry, skip_if_exists=True)
+
+    async def delete(self, key: str):
+        await self.dict.pop.aio(key, None)
+
+    async def items(self, prefix: str):
+        return [(key, entry) async for key, entry in self.dict.items.aio() if key.startswith(prefix)]
+
+# Modal Dict inside Modal containers, SQLite everywhere else
+def default_store():
+    import modal
+    if modal.is_local():
+        return SQLiteStore()
+    return ModalDictStore()
+
+# hit/miss counters live in their own small store, so collect_stats never reads cached results
+def default_stats_store():
+    import modal
+    if modal.is_local():
+        return SQLiteStore('/tmp/metasearch_cache_stats.sqlite')
+    return ModalDictStore('metasearch-cache-stats')
+
+class ResultCache:
+    def __init__(self, store=None, ttls: dict = None, max_stale: float = MAX_STALE,
+                 max_entries: int = 1024, publish_every: int = 50, flights=None, stats_store=None):
+        self.local = LRUCache(max_entries)
+        self.store = store
+        self.flights = flights # coalesce.SingleFlight that misses share, None to fetch on every miss
+        self.ttls = dict(ENGINE_TTLS)
+        self.ttls.update(ttls or {})
+        self.max_stale = max_stale
+
+        # hit/miss counters per engine, periodically published to stats_store (None to keep them local),
+        # and once more when the container exits
+        self.counters = defaultdict(Counter)
+        self.stats_store = stats_store
+        self.instance_id = uuid.uuid4().hex
+        self.publish_every = publish_every
+        self.lookups = 0
+        self.published_lookups = 0
+        if stats_store is not None:
+            atexit.register(self.flush_stats)
+
+        # keys being refreshed in the background (plus task refs so they aren't garbage collected)
+        self.refreshing = set()
+        self.tasks = set()
+
+    def key(self, engine: str, query: str, options: dict = None):
+        key = KEY_VERSION + engine + ':' + normalize_query(query)
+        if options: # e.g. a non-default num_matches gets its own entry
+            key += '|' + '&'.join(name + '=' + str(value) for name, value in sorted(options.items()))
+        return key
+
+    # only cache real results: empty responses are usually transient (errors are raised, never cached)
+    def cacheable(self, value):
+        return bool(value)
+
+    # find an entry, checking the shared tier when the local copy is missing or past its TTL
+    # (another container may have refreshed it already)
+    async def lookup(self, key: str, ttl: float):
+        entry = self.local.get(key)
+        if entry is not None and time.time() - entry[0] < ttl:
+            return entry, 'local'
+        if self.store is not None:
+            try:
+                shared_entry = await self.store.get(key)
+            except Exception as e: # a shared store outage shouldn't break search
+                print('Cache store read failed:', repr(e))
+                shared_entry = None
+            if shared_entry is not None and (entry is None or shared_entry[0] > entry[0]):
+                self.local.put(key, shared_entry)
+                return shared_entry, 'shared'
+        return entry, 'local'
+
+    async def put(self, key: str, value):
+        entry = (time.time(), value)
+        self.local.put(key, entry)
+        if self.store is not None:
+            try:
+                await self.store.put(key, entry)
+            except Exception as e:
+                print('Cache store write failed:', repr(e))
+
+    async def refresh(self, key: str, engine: str, fetch):
+        try:
+            value = await fetch()
+            if self.cacheable(value):
+                await self.put(key, value)
+            self.counters[engine]['refreshes'] += 1
+        except Exception as e:
+            self.counters[engine]['refresh_errors'] += 1
+            print('Background refresh failed:', key, repr(e))
+        finally:
+            self.refreshing.discard(key)
+
+    def revalidate(self, key: str, engine: str, fetch):
+        if key in self.refreshing:
+            return
+        self.refreshing.add(key)
+        self.background(self.refresh(key, engine, fetch))
+
+    def background(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    # cached results for (engine, query), or None on a miss
+    # stale results are still returned, and refreshed in the background with refresh() if given
+    async def get(self, engine: str, query: str, options: dict = None, refresh=None):
+        key = self.key(engine, query, options)
+        ttl = self.ttls.get(engine, DEFAULT_TTL)
+        entry, tier = await self.lookup(key, ttl)
+        self.count(engine, 'lookups')
+
+        if entry is not None:
+            age = time.time() - entry[0]
+            if age < ttl:
+                self.count(engine, tier + '_hits')
+                return entry[1]
+            elif age < ttl + self.max_stale:
+                # serve stale now, refresh in the background
+                self.count(engine, 'stale_hits')
+                if refresh is not None:
+                    self.revalidate(key, engine, refresh)
+                return entry[1]
+
+        self.count(engine, 'misses')
+        return None
+
+    # last cached results for (engine, query) no matter how old, for when the engine can't be called
+    async def get_fallback(self, engine: str, query: str, options: dict = None):
+        entry, tier = await self.lookup(self.key(engine, query, options), self.ttls.get(engine, DEFAULT_TTL))
+        if entry is None:
+            return None
+        self.count(engine, 'fallback_hits')
+        return entry[1]
+
+    async def set(self, engine: str, query: str, value, options: dict = None):
+        if self.cacheable(value):
+            await self.put(self.key(engine, query, options), value)
+
+    # fresh results for a key, or None, without counting a lookup (for callers waiting on another container)
+    async def peek(self, key: str, engine: str):
+        entry, tier = await self.lookup(key, self.ttls.get(engine, DEFAULT_TTL))
+        if entry is not None and time.time() - entry[0] < self.ttls.get(engine, DEFAULT_TTL):
+            return entry[1]
+        return None
+
+    async def fetch_and_set(self, engine: str, query: str, fetch, options: dict = None):
+        value = await fetch()
+        await self.set(engine, query, value, options)
+        return value
+
+    # return cached results for (engine, query) if there are any, otherwise run fetch() and cache it
+    # (concurrent misses for the same key share one fetch when there are flights; max_wait caps how long
+    # a miss waits on another container's fetch before running its own)
+    async def get_or_fetch(self, engine: str, query: str, fetch, options: dict = None, max_wait: float = None):
+        value = await self.get(engine, query, options, refresh=fetch)
+        if value is None and self.flights is None:
+            value = await self.fetch_and_set(engine, query, fetch, options)
+        elif value is None:
+            key = self.key(engine, query, options)
+            value = await self.flights.run(key, lambda: self.fetch_and_set(engine, query, fetch, options),
+                                           lambda: self.peek(key, engine), lambda kind: self.count(engine, kind),
+                                           max_wait)
+        return value
+
+    def count(self, engine: str, counter: str):
+        self.counters[engine][counter] += 1
+        if counter == 'lookups':
+            self.lookups += 1
+            if self.stats_store is not None and self.lookups % self.publish_every == 0:
+                self.background(self.publish_stats())
+
+    def stats(self):
+        return {engine: dict(counter) for engine, counter in self.counters.items()}
+
+    # write this instance's counters to the stats store so collect_stats can sum across containers
+    async def publish_stats(self):
+        self.published_lookups = self.lookups
+        try:
+            await self.stats_store.put('stats:' + self.instance_id, (time.time(), self.stats()))
+        except Exception as e:
+            print('Cache stats publish failed:', repr(e))
+
+    # publish lookups counted since the last publish, blocking (at interpreter exit the event loop and
+    # thread pools are gone), so a container's last counters aren't lost when it exits
+    def flush_stats(self):
+        if self.stats_store is None or self.lookups == self.published_lookups:
+            return
+        self.published_lookups = self.lookups
+        try:
+            self.stats_store.put_sync('stats:' + self.instance_id, (time.time(), self.stats()))
+        except Exception as e:
+            print('Cache stats publish failed:', repr(e))
+
+# sum the hit/miss counters every cache instance has published to the stats store in the last max_age
+# seconds, deleting older entries (only counters are in it, so listing it doesn't download any results)
+async def collect_stats(store, max_age: float = STATS_MAX_AGE):
+    totals = defaultdict(Counter)
+    for key, (published_at, stats) in await store.items('stats:'):
+        if time.time() - published_at > max_age:
+            await store.delete(key)
+            continue
+        for engine, counter in stats.items():
+            totals[engine].update(counter)
+
+    # hit rate per engine, to size the cache under real traffic
+    report = {}
+    for engine, counter in totals.items():
+        hits = counter['local_hits'] + counter['shared_hits'] + counter['stale_hits'] + \
+            counter['coalesced'] + counter['shared_coalesced']
+        report[engine] = dict(counter)
+        report[engine]['hit_rate'] = hits / counter['lookups'] if counter['lookups'] else 0.0
+    return report
@@ -0,0 +1,101 @@
+# the record every engine returns, and the error channel for searches that fail
+# a search's results cross containers (Modal returns, shared cache entries) as one marshal blob of
+# their field tuples (see SearchResults)
+import marshal
+from dataclasses import dataclass
+from typing import NamedTuple, Optional
+
+@dataclass(slots=True)
+class SearchResult:
+    source: str
+    query: str
+    url: str
+    title: str = ''
+    snippet: str = ''
+    thumbnail: str = '' # image URL, '' when there isn't one
+    subsource: Optional[str] = None # e.g. the subreddit or podcast series, None when there isn't one
+    subsource_url: Optional[str] = None
+
+    def to_tuple(self):
+        return (self.source, self.query, self.url, self.title, self.snippet,
+                self.thumbnail, self.subsource, self.subsource_url)
+
+    @classmethod
+    def from_tuple(cls, fields):
+        return cls(*fields)
+
+    # fields that are set, for printing
+    def to_dict(self):
+        return {name: value for name, value in zip(field_names, self.to_tuple()) if value}
+
+field_names = ['source', 'query', 'url', 'title', 'snippet', 'thumbnail', 'subsource', 'subsource_url']
+
+# one search's results (what Dispatcher.fetch returns), pickled as a single bytes object: Modal's pickler
+# runs a Python hook on every object it writes, so this costs a fraction of a dict or record per result
+# (see benchmarks/search_result.py)
+class SearchResults(list):
+    def __reduce__(self):
+        return (unpack_results, (pack_results(self),))
+
+def pack_results(results):
+    return marshal.dumps([result.to_tuple() for result in results])
+
+def unpack_results(data: bytes):
+    return SearchResults([SearchResult(*fields) for fields in marshal.loads(data)])
+
+# an engine couldn't answer (bad credentials, upstream error), as opposed to finding nothing
+class SearchError(Exception):
+    def __init__(self, engine: str, query: str, message: str):
+        super().__init__(engine + ' search for ' + repr(query) + ' failed: ' + message)
+        self.engine = engine
+        self.query = query
+        self.message = message
+
+    def __reduce__(self):
+        return (self.__class__, (self.engine, self.query, self.message))
+
+# an engine ran out of its time budget (or the request deadline passed first)
+class SearchTimeout(SearchError):
+    pass
+
+# an engine wasn't called because we're holding back: its rate limit is used up, or its circuit breaker is open
+class Throttled(SearchError):
+    pass
+
+class RateLimited(Throttled):
+    pass
+
+class CircuitOpen(Throttled):
+    pass
+
+# one search's results plus any errors, so failures travel next to results instead of inside them
+# timeouts names the engines that ran out of time, so the page can say what's missing, and unanswered
+# the planner responses that failed or timed out, so "More results" can try them again
+# pickles with its results packed like SearchResults
+class SearchBatch(NamedTuple):
+    results: list
+    errors: list
+    timeouts: tuple = ()
+    unanswered: tuple = ()
+
+    def __reduce__(self):
+        return (unpack_batch, (pack_results(self.results), self.errors, self.timeouts, self.unanswered))
+
+def unpack_batch(results: bytes, errors: list, timeouts: tuple = (), unanswered: tuple = ()):
+    return SearchBatch(unpack_results(results), errors, timeouts, unanswered)
+
+# batch for a failed search
+def failed(response: str, error: Exception):
+    if isinstance(error, SearchTimeout):
+        return SearchBatch([], [str(error)], (error.engine,), (response,))
+    return SearchBatch([], [str(error) if isinstance(error, SearchError) else response + ': ' + repr(error)], (), (response,))
+
+# batch for a search the request deadline cut off
+def timed_out(response: str, engine: str):
+    return SearchBatch([], [response + ': timed out'], (engine,) if engine else (), (response,))
+
+# an image or link URL from an upstream, or '' for placeholders like 'None', 'self', or 'default'
+def clean_url(value):
+    if isinstance(value, str) and value.startswith(('http://', 'https://')):
+        return value
+    return ''
@@ -0,0 +1,189 @@
+# cold-start profiler: times every top-level module import and named startup phase (like a model
+# load) in a container, then publishes one profile per container when its first input finishes,
+# so import and load time can be tracked per Modal function
+# import this module before anything else in an app file so the import timer sees everything after it
+# it's off unless STARTUP_PROFILE=1, since the timer wraps every import in the process
+import os
+import sys
+import time
+import uuid
+import inspect
+import functools
+import threading
+import contextlib
+
+# profiles go to this Modal Dict, keyed by function name and container
+PROFILE_DICT = 'metasearch-startup-profiles'
+
+ENABLED = os.environ.get('STARTUP_PROFILE') == '1'
+
+started = time.perf_counter()
+imports = {} # top-level module -> seconds, including everything it imported
+nested = {} # modules imported directly by a top-level one (e.g. by the app file) -> seconds
+phases = {} # named phase -> seconds
+profile = {'published': False, 'first_input_at': None}
+
+# wraps a module loader so exec_module is timed; nested imports count toward the outermost one,
+# and one level down is kept too so the app file's own imports show up separately
+class TimedLoader:
+    depth = 0
+
+    def __init__(self, loader, name: str):
+        self.loader = loader
+        self.name = name
+
+    def __getattr__(self, attribute): # get_data, get_resource_reader, etc. go to the real loader
+        return getattr(self.loader, attribute)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        TimedLoader.depth += 1
+        start = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            TimedLoader.depth -= 1
+            if TimedLoader.depth == 0:
+                imports[self.name] = imports.get(self.name, 0.0) + time.perf_counter() - start
+            elif TimedLoader.depth == 1:
+                nested[self.name] = nested.get(self.name, 0.0) + time.perf_counter() - start
+
+class ImportTimer:
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = TimedLoader(spec.loader, name)
+                return spec
+        return None
+
+if ENABLED and not any(isinstance(finder, ImportTimer) for finder in sys.meta_path):
+    sys.meta_path.insert(0, ImportTimer())
+
+# seconds since the container's Python process started (Linux only), None elsewhere
+def process_age():
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = float(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+@contextlib.contextmanager
+def timed(phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[phase] = phases.get(phase, 0.0) + time.perf_counter() - start
+
+def first_input_started():
+    if profile['first_input_at'] is None:
+        profile['first_input_at'] = time.perf_counter()
+        profile['process_age'] = process_age()
+
+# the profile so far
+def report(function: str):
+    first_input_at = profile['first_input_at'] or time.perf_counter()
+    return {
+        'function': function,
+        'process_age_at_first_input': profile.get('process_age'),
+        'until_first_input': first_input_at - started,
+        'first_input': time.perf_counter() - first_input_at,
+        'imports': dict(imports),
+        'nested_imports': dict(nested),
+        'phases': dict(phases),
+    }
+
+# publish this container's profile once, after its first input, without holding up the response
+def first_input_done(function: str):
+    if profile['published']:
+        return
+    profile['published'] = True
+    entry = report(function)
+    print('Startup profile:', function, {name: round(seconds, 3) for name, seconds in
+                                         sorted(dict(nested, **imports).items(), key=lambda item: -item[1])[:5]},
+          {name: round(seconds, 3) for name, seconds in entry['phases'].items()})
+
+    def publish():
+        try:
+            import modal
+            if modal.is_local():
+                return
+            profiles = modal.Dict.from_name(PROFILE_DICT, create_if_missing=True)
+            profiles.put(function + ':' + os.environ.get('MODAL_TASK_ID', uuid.uuid4().hex), (time.time(), entry))
+        except Exception as e:
+            print('Startup profile publish failed:', repr(e))
+    threading.Thread(target=publish, daemon=True).start()
+
+# decorator for Modal functions (plain, async, generator, or async generator) that marks the first
+# input's start and end for the profile (left as is when profiling is off)
+def profiled(function):
+    if not ENABLED:
+        return function
+    name = function.__name__
+    if inspect.isasyncgenfunction(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            first_input_started()
+            try:
+                async for item in function(*args, **kwargs):
+                    yield item
+            finally:
+                first_input_done(name)
+    elif inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            first_input_started()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                first_input_done(name)
+    elif inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            first_input_started()
+            try:
+                yield from function(*args, **kwargs)
+            finally:
+                first_input_done(name)
+    else:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            first_input_started()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                first_input_done(name)
+    return wrapper
+
+# median import, phase, and time-to-first-input per function across every published profile
+def summarize(entries):
+    import statistics
+
+    by_function = {}
+    for published_at, entry in entries:
+        by_function.setdefault(entry['function'], []).append(entry)
+    summary = {}
+    for function, profiles in by_function.items():
+        median = lambda values: statistics.median(values) if values else 0.0
+        timings = [dict(entry.get('nested_imports', {}), **entry['imports']) for entry in profiles]
+        modules = set(name for timing in timings for name in timing)
+        names = set(name for entry in profiles for name in entry['phases'])
+        summary[function] = {
+            'containers': len(profiles),
+            'until_first_input': median([entry['until_first_input'] for entry in profiles]),
+            'first_input': median([entry['first_input'] for entry in profiles]),
+            'imports_total': median([sum(entry['imports'].values()) for entry in profiles]),
+            'slowest_imports': sorted(((name, median([timing.get(name, 0.0) for timing in timings]))
+                                       for name in modules), key=lambda item: -item[1])[:5],
+            'phases': {name: median([entry['phases'].get(name, 0.0) for entry in profiles]) for name in names},
+        }
+    return summary
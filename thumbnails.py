@@ -0,0 +1,248 @@
+# thumbnail proxy: result cards show images through the thumbnail endpoint instead of linking the
+# full-size originals (Unsplash regular, Reddit preview sources, podcast artwork run to megabytes each)
+# each image is fetched once, shrunk to fit its card (SIZES), re-encoded as WebP and kept in a disk
+# cache: files are named by the SHA-256 of their WebP bytes, with an index from source URL to file,
+# and the least recently used files are evicted past MAX_CACHE_BYTES
+# the disk cache is the container's own local disk (not a Volume, whose commits would race on the SQLite
+# index), so a cold container fetches each image again; browsers keep the responses (immutable), so
+# that's once per image per container rather than per page view
+# proxied URLs are signed (HMAC of size and source URL), so the endpoint only fetches images a results
+# page asked for; set THUMBNAILS=0 to link the originals
+import io
+import os
+import time
+import hmac
+import asyncio
+import hashlib
+import sqlite3
+import secrets
+import threading
+import urllib.parse
+import weakref
+from collections import Counter
+
+import coalesce
+
+ENABLED = os.environ.get('THUMBNAILS', '1') != '0'
+
+# largest box (width, height) each kind of card shows its image in, matching render.py's CSS
+SIZES = {
+    'image': (640, 400),
+    'podcast': (200, 200),
+}
+
+WEBP_QUALITY = 80
+
+# originals bigger than this (bytes, or pixels once decoded) are left alone (the card links them directly)
+MAX_SOURCE_BYTES = 20 * 1024 * 1024
+MAX_SOURCE_PIXELS = 50_000_000
+
+# per container, see above
+THUMBNAIL_DIR = os.environ.get('THUMBNAIL_DIR', '/tmp/metasearch_thumbnails')
+MAX_CACHE_BYTES = 512 * 1024 * 1024
+
+# signing key shared by every container, kept in this Modal Dict unless THUMBNAIL_KEY is set
+KEY_DICT = 'metasearch-thumbnail-key'
+
+signing = {}
+proxies = weakref.WeakKeyDictionary()
+disk_cache = {}
+disk_cache_lock = threading.Lock()
+
+# the signing key, loaded once per container (blocking, for the page-rendering functions)
+def signing_key():
+    if 'key' not in signing:
+        key = os.environ.get('THUMBNAIL_KEY')
+        if not key:
+            import modal
+            keys = modal.Dict.from_name(KEY_DICT, create_if_missing=True)
+            keys.put('key', secrets.token_hex(32), skip_if_exists=True)
+            key = keys.get('key')
+        signing['key'] = key.encode('utf-8')
+    return signing['key']
+
+# same, without blocking the event loop (the thumbnail endpoint awaits this before verifying)
+async def load_signing_key():
+    if 'key' not in signing:
+        key = os.environ.get('THUMBNAIL_KEY')
+        if not key:
+            import modal
+            keys = modal.Dict.from_name(KEY_DICT, create_if_missing=True)
+            await keys.put.aio('key', secrets.token_hex(32), skip_if_exists=True)
+            key = await keys.get.aio('key')
+        signing['key'] = key.encode('utf-8')
+    return signing['key']
+
+def sign(url: str, size: str):
+    return hmac.new(signing_key(), (size + '|' + url).encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+def verify(url: str, size: str, signature: str):
+    return size in SIZES and hmac.compare_digest(sign(url, size), signature or '')
+
+# card size for a result's image (podcast artwork shows smaller, see render.py)
+def size_for(result):
+    return 'podcast' if result.source == 'Podcast' else 'image'
+
+# the thumbnail endpoint URL for an image
+def proxy_url(base_url: str, url: str, size: str):
+    return base_url + '?' + urllib.parse.urlencode({'url': url, 'size': size, 'sig': sign(url, size)})
+
+# image source for a result's card through the thumbnail endpoint at base_url (see render.py, which
+# still links the image to the original), or None to show originals; the key is loaded here so a
+# missing one turns the proxy off before rendering starts
+def proxy_src(base_url: str):
+    if not base_url:
+        return None
+    signing_key()
+    def src(result):
+        if result.thumbnail.startswith(('http://', 'https://')):
+            return proxy_url(base_url, result.thumbnail, size_for(result))
+        return result.thumbnail
+    return src
+
+# shrink an image to fit box (never enlarging it) and encode it as WebP
+def resize(data: bytes, box: tuple):
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(data))
+    if image.width * image.height > MAX_SOURCE_PIXELS:
+        raise ValueError('image too large: ' + str(image.width) + 'x' + str(image.height))
+    image.draft('RGB', box) # JPEGs decode straight at a smaller scale
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if image.mode in ('LA', 'PA', 'P') or 'transparency' in image.info else 'RGB')
+    image.thumbnail(box, Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, 'WEBP', quality=WEBP_QUALITY, method=4)
+    return output.getvalue()
+
+# content-addressed files on local disk with an SQLite index, evicting least recently used files
+class DiskCache:
+    def __init__(self, directory: str = THUMBNAIL_DIR, max_bytes: int = MAX_CACHE_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(directory, 'index.sqlite'), check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS sources (key TEXT PRIMARY KEY, digest TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (digest TEXT PRIMARY KEY, size INTEGER, used REAL)')
+        self.connection.commit()
+        self.total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+        self.stats = Counter()
+
+    def path(self, digest: str):
+        return os.path.join(self.directory, digest[:2], digest + '.webp')
+
+    # (digest, bytes) stored for key, or None
+    def get(self, key: str):
+        with self.lock:
+            row = self.connection.execute('SELECT digest FROM sources WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            self.connection.execute('UPDATE files SET used = ? WHERE digest = ?', (time.time(), row[0]))
+            self.connection.commit()
+        try:
+            with open(self.path(row[0]), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError: # removed behind the index's back
+            with self.lock:
+                self.forget(row[0])
+                self.connection.commit()
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return row[0], data
+
+    # store data for key, returning its digest (sources with identical output share one file)
+    def put(self, key: str, data: bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = path + '.' + secrets.token_hex(4)
+            with open(temporary, 'wb') as f:
+                f.write(data)
+            os.replace(temporary, path) # readers never see a partial file
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO sources VALUES (?, ?)', (key, digest))
+            added = self.connection.execute('INSERT OR IGNORE INTO files VALUES (?, ?, ?)',
+                                            (digest, len(data), time.time())).rowcount
+            if added:
+                self.total += len(data)
+            else:
+                self.connection.execute('UPDATE files SET used = ? WHERE digest = ?', (time.time(), digest))
+            self.evict(keep=digest)
+            self.connection.commit()
+        return digest
+
+    # drop least recently used files until the cache fits (call with the lock held)
+    def evict(self, keep: str = None):
+        while self.total > self.max_bytes:
+            rows = self.connection.execute('SELECT digest FROM files WHERE digest != ? ORDER BY used LIMIT 32',
+                                           (keep or '',)).fetchall()
+            if not rows:
+                return
+            for (digest,) in rows:
+                self.forget(digest)
+                self.stats['evictions'] += 1
+                if self.total <= self.max_bytes:
+                    return
+
+    def forget(self, digest: str):
+        row = self.connection.execute('SELECT size FROM files WHERE digest = ?', (digest,)).fetchone()
+        self.connection.execute('DELETE FROM sources WHERE digest = ?', (digest,))
+        self.connection.execute('DELETE FROM files WHERE digest = ?', (digest,))
+        self.total -= row[0] if row else 0
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+# the container's disk cache, shared by every event loop
+def get_disk_cache():
+    with disk_cache_lock:
+        if 'cache' not in disk_cache:
+            disk_cache['cache'] = DiskCache(THUMBNAIL_DIR, MAX_CACHE_BYTES)
+        return disk_cache['cache']
+
+class ThumbnailProxy:
+    def __init__(self, cache: DiskCache, client=None):
+        import httpx
+
+        self.cache = cache
+        self.client = client if client is not None else httpx.AsyncClient(
+            follow_redirects=True, timeout=httpx.Timeout(10.0, connect=3.0),
+            headers={'User-Agent': 'ai-metasearch-concept thumbnail proxy'})
+        self.flights = coalesce.SingleFlight() # concurrent requests for one image share its fetch
+        self.stats = Counter()
+
+    # (digest, WebP bytes) for url shrunk to size, from the disk cache or fetched and resized once
+    async def get(self, url: str, size: str):
+        key = size + '|' + url
+        found = await asyncio.to_thread(self.cache.get, key)
+        if found is not None:
+            return found
+        return await self.flights.run(key, lambda: self.fetch(key, url, size))
+
+    async def fetch(self, key: str, url: str, size: str):
+        self.stats['fetches'] += 1
+        chunks, received = [], 0
+        async with self.client.stream('GET', url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                received += len(chunk)
+                if received > MAX_SOURCE_BYTES:
+                    raise ValueError('image over ' + str(MAX_SOURCE_BYTES) + ' bytes')
+                chunks.append(chunk)
+        self.stats['source_bytes'] += received
+        data = await asyncio.to_thread(resize, b''.join(chunks), SIZES[size])
+        digest = await asyncio.to_thread(self.cache.put, key, data)
+        return digest, data
+
+# the proxy for the running event loop
+def get_proxy():
+    loop = asyncio.get_running_loop()
+    if loop not in proxies:
+        proxies[loop] = ThumbnailProxy(get_disk_cache())
+    return proxies[loop]
@@ -0,0 +1,364 @@
+# request tracing: a span for each stage of a metasearch request (planner completions, container
+# hops, engine searches and their upstream attempts, CLIP encode, merge, render), tagged by engine
+# and sub-query
+# a trace's context crosses Modal function calls as a small dict (trace=tracing.context()), and each
+# container exports its finished spans when its outermost span for the trace ends, to
+#   a JSONL file (TRACE_FILE, rotated at TRACE_FILE_MAX_BYTES) and/or an OpenTelemetry collector (OTLP/HTTP JSON to OTEL_EXPORTER_OTLP_ENDPOINT)
+#   a Modal Queue partition per trace for ?debug=timing requests, so web_search can draw a waterfall
+# every span's duration also goes into per-container latency windows, published to a shared store so
+# collect_metrics can report p50/p95/p99 per stage and engine across containers
+import os
+import json
+import time
+import uuid
+import queue
+import random
+import asyncio
+import threading
+import contextlib
+import contextvars
+from collections import defaultdict, deque
+
+# where finished spans go (both off unless set)
+TRACE_FILE = os.environ.get('TRACE_FILE', '')
+TRACE_FILE_MAX_BYTES = int(os.environ.get('TRACE_FILE_MAX_BYTES', str(64 * 1024 * 1024)))
+OTLP_ENDPOINT = os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT', '')
+SERVICE_NAME = os.environ.get('OTEL_SERVICE_NAME', 'metasearch')
+
+# fraction of requests traced (debug requests always are)
+SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+
+# Modal Queue holding debug traces' spans, one partition per trace
+DEBUG_QUEUE = 'metasearch-traces'
+DEBUG_TTL = 3600
+
+# latency samples kept per stage in each container, and how often (in spans) they're published
+METRICS_WINDOW = 500
+PUBLISH_EVERY = 100
+
+# the span running in this task or thread
+current = contextvars.ContextVar('current_span', default=None)
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: str, debug: bool, local_root: bool, attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.debug = debug
+        self.local_root = local_root # outermost span of this trace in this container
+        self.attributes = attributes
+        self.start = time.time() # wall clock, since spans from different containers are lined up
+        self.end = None
+        self.status = 'ok'
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def duration(self):
+        return (self.end if self.end is not None else time.time()) - self.start
+
+    # what a Modal function needs to continue this trace (see span's parent argument)
+    def context(self):
+        return {'trace_id': self.trace_id, 'span_id': self.span_id, 'debug': self.debug}
+
+    def to_dict(self):
+        return {'name': self.name, 'trace_id': self.trace_id, 'span_id': self.span_id,
+                'parent_id': self.parent_id, 'start': self.start,
+                'end': self.end if self.end is not None else time.time(),
+                'status': self.status, 'attributes': self.attributes}
+
+# stage name for latency metrics: the span name, plus the engine when it's tagged with one
+def metric_key(name: str, attributes: dict):
+    return name + ':' + attributes['engine'] if attributes.get('engine') else name
+
+# spans finished in this container, held until the trace's outermost local span ends
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffers = defaultdict(list) # trace_id -> finished spans
+        self.open_roots = defaultdict(int) # trace_id -> local root spans still running
+        self.debug_spans = defaultdict(list) # trace_id -> spans of debug traces, for collect
+        self.samples = defaultdict(lambda: deque(maxlen=METRICS_WINDOW))
+        self.finished = 0
+        self.instance_id = uuid.uuid4().hex
+        self.sinks = None # built from the environment on first export
+        self.metrics_store = None
+        self.exports = None
+        self.worker = None
+
+    def started(self, span: Span):
+        if span.local_root:
+            with self.lock:
+                self.open_roots[span.trace_id] += 1
+
+    def finish(self, span: Span):
+        span.end = time.time()
+        with self.lock:
+            self.samples[metric_key(span.name, span.attributes)].append(span.end - span.start)
+            self.finished += 1
+            publish = self.finished % PUBLISH_EVERY == 0
+            self.buffers[span.trace_id].append(span)
+            if span.local_root:
+                self.open_roots[span.trace_id] -= 1
+            # spans that outlive the local root (e.g. a cancelled hedge) go out on their own
+            if self.open_roots[span.trace_id] > 0:
+                spans = None
+            else:
+                self.open_roots.pop(span.trace_id, None)
+                spans = self.buffers.pop(span.trace_id)
+        if spans:
+            self.export(spans)
+        if publish:
+            self.submit(self.publish_metrics)
+
+    # send spans to the sinks from a background thread; a debug trace's spans from anywhere but the
+    # root's container also go to the trace's Queue partition before returning, so they're there by
+    # the time the caller's Modal call returns
+    def export(self, spans: list):
+        records = [span.to_dict() for span in spans]
+        if spans[0].debug and not any(span.parent_id is None for span in spans):
+            self.publish_debug(spans[0].trace_id, records)
+        self.submit(lambda: self.write(records))
+
+    # blocking Queue put, from a thread so it's safe on an event loop
+    def publish_debug(self, trace_id: str, records: list):
+        def put():
+            try:
+                import modal
+                if modal.is_local(): # everything runs in this process, so collect reads debug_spans
+                    with self.lock:
+                        self.debug_spans[trace_id].extend(records)
+                    return
+                spans = modal.Queue.from_name(DEBUG_QUEUE, create_if_missing=True)
+                spans.put_many(records, partition=trace_id, partition_ttl=DEBUG_TTL)
+            except Exception as e:
+                print('Debug trace publish failed:', repr(e))
+        thread = threading.Thread(target=put, daemon=True)
+        thread.start()
+        thread.join(5.0)
+
+    def submit(self, job):
+        with self.lock:
+            if self.worker is None:
+                self.exports = queue.Queue()
+                self.worker = threading.Thread(target=self.run_exports, daemon=True)
+                self.worker.start()
+        self.exports.put(job)
+
+    def run_exports(self):
+        while True:
+            job = self.exports.get()
+            try:
+                job()
+            except Exception as e: # a broken sink shouldn't take requests down with it
+                print('Trace export failed:', repr(e))
+            finally:
+                self.exports.task_done()
+
+    # wait (up to timeout seconds) for queued exports, e.g. before a benchmark reads the JSONL file
+    def flush(self, timeout: float = 5.0):
+        if self.exports is None:
+            return
+        done = threading.Event()
+        self.exports.put(done.set)
+        done.wait(timeout)
+
+    def write(self, records: list):
+        if self.sinks is None:
+            self.sinks = default_sinks()
+        for sink in self.sinks:
+            sink.export(records)
+
+    def latency_samples(self):
+        with self.lock:
+            return {key: list(samples) for key, samples in self.samples.items()}
+
+    # share this container's latency windows (see collect_metrics)
+    def publish_metrics(self):
+        if self.metrics_store is None:
+            self.metrics_store = metrics_store()
+        asyncio.run(self.metrics_store.put('metrics:' + self.instance_id, (time.time(), self.latency_samples())))
+
+tracer = Tracer()
+
+# append spans to a JSONL file, one object per line
+class JSONLSink:
+    def __init__(self, path: str, max_bytes: int = TRACE_FILE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    # once the file reaches max_bytes it becomes path.1 (replacing the previous one) and a new file starts
+    def export(self, records: list):
+        try:
+            if os.path.getsize(self.path) >= self.max_bytes:
+                os.replace(self.path, self.path + '.1')
+        except FileNotFoundError:
+            pass
+        with open(self.path, 'a') as f:
+            f.write(''.join([json.dumps(record, default=str) + '\n' for record in records]))
+
+# post spans to an OpenTelemetry collector as OTLP/HTTP JSON
+class OTLPSink:
+    def __init__(self, endpoint: str, headers: dict = None, service: str = SERVICE_NAME):
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.headers = headers or {}
+        self.service = service
+
+    def export(self, records: list):
+        import httpx
+        response = httpx.post(self.url, json=otlp_payload(records, self.service), headers=self.headers, timeout=5.0)
+        response.raise_for_status()
+
+def otlp_value(value):
+    if type(value) is bool:
+        return {'boolValue': value}
+    if type(value) is int:
+        return {'intValue': str(value)}
+    if type(value) is float:
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+# OTLP's JSON encoding of a batch of span records
+def otlp_payload(records: list, service: str = SERVICE_NAME):
+    spans = []
+    for record in records:
+        span = {
+            'traceId': record['trace_id'],
+            'spanId': record['span_id'],
+            'name': record['name'],
+            'kind': 1, # internal
+            'startTimeUnixNano': str(int(record['start'] * 1e9)),
+            'endTimeUnixNano': str(int(record['end'] * 1e9)),
+            'attributes': [{'key': key, 'value': otlp_value(value)} for key, value in record['attributes'].items()],
+            'status': {'code': 1 if record['status'] == 'ok' else 2, 'message': record['status']},
+        }
+        if record['parent_id']:
+            span['parentSpanId'] = record['parent_id']
+        spans.append(span)
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service}}]},
+        'scopeSpans': [{'scope': {'name': 'metasearch.tracing'}, 'spans': spans}],
+    }]}
+
+# sinks configured by TRACE_FILE and OTEL_EXPORTER_OTLP_ENDPOINT (+ OTEL_EXPORTER_OTLP_HEADERS as k=v,k=v)
+def default_sinks():
+    sinks = []
+    if TRACE_FILE:
+        sinks.append(JSONLSink(TRACE_FILE))
+    if OTLP_ENDPOINT:
+        headers = dict(pair.split('=', 1) for pair in os.environ.get('OTEL_EXPORTER_OTLP_HEADERS', '').split(',') if '=' in pair)
+        sinks.append(OTLPSink(OTLP_ENDPOINT, headers))
+    return sinks
+
+# latency windows live in their own store: a Modal Dict when deployed, SQLite locally
+def metrics_store():
+    import modal
+    import result_cache
+    if modal.is_local():
+        return result_cache.SQLiteStore('/tmp/metasearch_metrics.sqlite')
+    return result_cache.ModalDictStore('metasearch-trace-metrics')
+
+# start a new trace (unless it isn't sampled, in which case every span inside is a no-op)
+@contextlib.contextmanager
+def start_trace(name: str, debug: bool = False, **attributes):
+    if not debug and random.random() >= SAMPLE_RATE:
+        yield None
+        return
+    root = {'trace_id': os.urandom(16).hex(), 'span_id': None, 'debug': debug}
+    with span(name, parent=root, **attributes) as root_span:
+        yield root_span
+
+# time a stage as a child of parent: a Span in this container, a context() dict from the calling
+# container, or by default the current span; yields None (and records nothing) outside a trace
+@contextlib.contextmanager
+def span(name: str, parent=None, **attributes):
+    if parent is None:
+        parent = current.get()
+        if parent is None:
+            yield None
+            return
+    if isinstance(parent, Span):
+        new = Span(name, parent.trace_id, parent.span_id, parent.debug, False, attributes)
+    else:
+        new = Span(name, parent['trace_id'], parent['span_id'], parent.get('debug', False), True, attributes)
+    tracer.started(new)
+
+    # restore by value rather than by token, since generators may resume in another context
+    previous = current.get()
+    current.set(new)
+    try:
+        yield new
+    except (asyncio.CancelledError, GeneratorExit):
+        new.status = 'cancelled'
+        raise
+    except BaseException as e:
+        new.status = 'error'
+        new.attributes['error'] = repr(e)
+        raise
+    finally:
+        current.set(previous)
+        tracer.finish(new)
+
+# context dict for span (by default the current one), to pass as a Modal function's trace argument
+# (None outside a trace)
+def context(span: Span = None):
+    span = span or current.get()
+    return span.context() if span is not None else None
+
+# add attributes to the current span, if there is one
+def annotate(**attributes):
+    span = current.get()
+    if span is not None:
+        span.set(**attributes)
+
+# every span of a debug trace so far: this container's (root's unfinished ones included) and the ones
+# other containers put on the trace's Queue partition
+def collect(root: Span):
+    with tracer.lock:
+        records = tracer.debug_spans.pop(root.trace_id, []) + [span.to_dict() for span in tracer.buffers.get(root.trace_id, [])]
+    records.append(root.to_dict())
+    try:
+        import modal
+        if not modal.is_local():
+            spans = modal.Queue.from_name(DEBUG_QUEUE, create_if_missing=True)
+            records += spans.get_many(10000, block=False, partition=root.trace_id)
+    except Exception as e:
+        print('Debug trace collect failed:', repr(e))
+
+    unique = {}
+    for record in records:
+        unique[record['span_id']] = record
+    return sorted(unique.values(), key=lambda record: record['start'])
+
+# count, p50, p95, p99 of a list of durations (seconds)
+def percentiles(samples: list):
+    ordered = sorted(samples)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+    return {'count': len(ordered), 'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99)}
+
+# p50/p95/p99 per stage from span records (e.g. read back from the JSONL sink)
+def summarize(records):
+    samples = defaultdict(list)
+    for record in records:
+        samples[metric_key(record['name'], record['attributes'])].append(record['end'] - record['start'])
+    return {key: percentiles(values) for key, values in samples.items()}
+
+def read_jsonl(path: str):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# p50/p95/p99 per stage across every container's published latency windows from the last max_age seconds
+async def collect_metrics(store, max_age: float = 3600):
+    samples = defaultdict(list)
+    for key, (published_at, windows) in await store.items('metrics:'):
+        if time.time() - published_at > max_age:
+            continue
+        for stage, values in windows.items():
+            samples[stage] += values
+    return {stage: percentiles(values) for stage, values in samples.items()}
+
+# collect_metrics with this container's latest samples included, for code not running on an event loop
+def latency_summary():
+    tracer.publish_metrics()
+    return asyncio.run(collect_metrics(tracer.metrics_store))
@@ -0,0 +1,163 @@
+# pluggable vector stores for TextEmbeddingModel
+# every store answers query(vector, top_k, include_metadata) with a Pinecone-shaped
+# {'matches': [{'id', 'score', 'metadata'}]} dict, so to_results works unchanged
+#   PineconeStore: the hosted Pinecone index
+#   LocalVectorStore: memory-mapped float32 matrix + JSONL metadata sidecar, exact top-k with
+#   argpartition, or an approximate IVF (inverted file) index for large collections
+import os
+import json
+
+import numpy as np
+
+class PineconeStore:
+    def __init__(self, index_name: str, api_key: str):
+        from pinecone import Pinecone
+        pc = Pinecone(api_key=api_key)
+        self.index = pc.Index(index_name)
+
+    def query(self, vector, top_k: int = 10, include_metadata: bool = True):
+        return self.index.query(vector=np.asarray(vector, dtype=np.float32).tolist(),
+                                top_k=top_k,
+                                include_metadata=include_metadata)
+
+# scale rows to unit length so a dot product is cosine similarity (Pinecone's metric for CLIP)
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+# indices of the top_k scores along the last axis, best first
+def top_k_indices(scores, top_k: int):
+    top_k = min(top_k, scores.shape[-1])
+    if top_k <= 0:
+        return np.zeros(scores.shape[:-1] + (0,), dtype=np.int64)
+    if top_k < scores.shape[-1]:
+        candidates = np.argpartition(-scores, top_k - 1, axis=-1)[..., :top_k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[-1]), scores.shape).copy()
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=-1), axis=-1)
+    return np.take_along_axis(candidates, order, axis=-1)
+
+# inverted file index: vectors bucketed by nearest k-means centroid, and a query only
+# scores the vectors in its nprobe closest buckets
+class IVFIndex:
+    def __init__(self, centroids, order, offsets):
+        self.centroids = centroids # (nlist, dim)
+        self.order = order # row ids grouped by list
+        self.offsets = offsets # list i is order[offsets[i]:offsets[i + 1]]
+
+    @classmethod
+    def build(cls, vectors, nlist: int = None, iterations: int = 10, sample: int = 50000, seed: int = 0):
+        count = vectors.shape[0]
+        nlist = nlist or max(1, int(np.sqrt(count)))
+        rng = np.random.default_rng(seed)
+
+        # spherical k-means on a sample is plenty to place centroids
+        training = np.asarray(vectors[rng.choice(count, size=min(sample, count), replace=False)])
+        centroids = training[rng.choice(len(training), size=nlist, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(training @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, training)
+            empty = np.bincount(assignments, minlength=nlist) == 0
+            sums[empty] = centroids[empty] # keep centroids that lost all their points
+            centroids = normalize_rows(sums)
+
+        # assign every vector in chunks to bound memory
+        assignments = np.concatenate([np.argmax(np.asarray(vectors[start:start + 65536]) @ centroids.T, axis=1)
+                                      for start in range(0, count, 65536)])
+        order = np.argsort(assignments, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=nlist))])
+        return cls(centroids, order, offsets)
+
+    def save(self, path: str):
+        np.savez(path, centroids=self.centroids, order=self.order, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path: str):
+        index = np.load(path)
+        return cls(index['centroids'], index['order'], index['offsets'])
+
+    # row ids of the vectors in the nprobe lists closest to vector
+    def candidates(self, vector, nprobe: int):
+        lists = top_k_indices(self.centroids @ vector, nprobe)
+        return np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+
+class LocalVectorStore:
+    def __init__(self, path: str, approximate: bool = False, nprobe: int = 8):
+        self.path = path
+        self.approximate = approximate
+        self.nprobe = nprobe
+
+        # vectors stay on disk and are paged in on demand
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.ids = []
+        self.metadata = []
+        with open(os.path.join(path, 'metadata.jsonl')) as metadata_file:
+            for line in metadata_file:
+                record = json.loads(line)
+                self.ids.append(record['id'])
+                self.metadata.append(record['metadata'])
+
+        self.ivf = None
+        ivf_path = os.path.join(path, 'ivf.npz')
+        if approximate:
+            if os.path.exists(ivf_path):
+                self.ivf = IVFIndex.load(ivf_path)
+            else:
+                self.ivf = IVFIndex.build(self.vectors)
+
+    # write a store: vectors (n, dim), a metadata dict per vector, and optional ids
+    @classmethod
+    def build(cls, path: str, vectors, metadata: list, ids: list = None, ivf: bool = False, nlist: int = None):
+        os.makedirs(path, exist_ok=True)
+        vectors = normalize_rows(vectors)
+        np.save(os.path.join(path, 'vectors.npy'), vectors)
+        ids = ids if ids is not None else [str(i) for i in range(len(vectors))]
+        with open(os.path.join(path, 'metadata.jsonl'), 'w') as metadata_file:
+            for id, record in zip(ids, metadata):
+                metadata_file.write(json.dumps({'id': id, 'metadata': record}) + '\n')
+        if ivf:
+            IVFIndex.build(vectors, nlist=nlist).save(os.path.join(path, 'ivf.npz'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def matches(self, rows, scores, include_metadata: bool):
+        matches = []
+        for row, score in zip(rows.tolist(), scores.tolist()):
+            match = {'id': self.ids[row], 'score': score}
+            if include_metadata:
+                match['metadata'] = self.metadata[row]
+            matches.append(match)
+        return {'matches': matches}
+
+    def query(self, vector, top_k: int = 10, include_metadata: bool = True):
+        vector = normalize_rows(vector)
+        if self.ivf is not None:
+            # sorted rows keep reads from the memory map sequential
+            rows = np.sort(self.ivf.candidates(vector, self.nprobe))
+            scores = np.asarray(self.vectors[rows]) @ vector
+            best = top_k_indices(scores, top_k)
+            return self.matches(rows[best], scores[best], include_metadata)
+        scores = np.asarray(self.vectors) @ vector
+        best = top_k_indices(scores, top_k)
+        return self.matches(best, scores[best], include_metadata)
+
+    # exact search for many vectors with one matrix multiply
+    def query_batch(self, vectors, top_k: int = 10, include_metadata: bool = True):
+        if self.ivf is not None:
+            return [self.query(vector, top_k, include_metadata) for vector in vectors]
+        scores = normalize_rows(vectors) @ np.asarray(self.vectors).T
+        best = top_k_indices(scores, top_k)
+        return [self.matches(rows, np.take(row_scores, rows), include_metadata)
+                for rows, row_scores in zip(best, scores)]
+
+# pick the backend from the environment: VECTOR_STORE=local uses the store at LOCAL_VECTOR_STORE_PATH
+# (VECTOR_STORE_APPROXIMATE=1 for the IVF index), anything else uses Pinecone
+def open_store(local_path: str = None):
+    if os.environ.get('VECTOR_STORE', 'pinecone') == 'local':
+        return LocalVectorStore(local_path or os.environ['LOCAL_VECTOR_STORE_PATH'],
+                                approximate=os.environ.get('VECTOR_STORE_APPROXIMATE') == '1',
+                                nprobe=int(os.environ.get('VECTOR_STORE_NPROBE', '8')))
+    return PineconeStore(os.environ['PINECONE_INDEX'], os.environ['PINECONE_API_KEY'])